@@ -0,0 +1,186 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4:
+"""状态日志耗时的异常检测：和基线比较，找出网关卡住的时段
+
+逐行的滚动统计都用累加和向量化计算，整个序列O(n)，不逐个窗口处理。
+基线按网关版本保存在文件中，每次分析后把正常时段的耗时合并进去。
+"""
+import cPickle as pickle
+import os
+
+import numpy as np
+
+from stats_util import StreamingStats
+
+# 基线文件格式的版本，变化时不读取以前的基线
+BASELINE_VERSION = 1
+
+
+def rolling_sums(values, window):
+    """各位置（含）之前最多window个值的和
+
+    :values: 数值数组
+    :window: 窗口的值个数
+    :returns: (各位置的和, 各位置窗口中的值个数)，开头不足window个时按实有的个数
+    """
+    values = np.asarray(values, dtype=np.float64)
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    ends = np.arange(1, len(values) + 1)
+    begins = np.maximum(ends - window, 0)
+    return sums[ends] - sums[begins], ends - begins
+
+
+def rolling_zscore(values, window, mean, std):
+    """各位置滚动窗口的平均值相对基线的z值
+
+    窗口中n个值的平均值的标准差为 std / sqrt(n) ，一个很大的值或一段都偏大的值都会使z值变大。
+
+    :values: 数值数组
+    :window: 窗口的值个数
+    :mean: 基线的平均值
+    :std: 基线的标准差，不大于0时按1计算
+    :returns: z值数组
+    """
+    sums, counts = rolling_sums(values, window)
+    return (sums / counts - mean) * np.sqrt(counts) / (std if std > 0 else 1.0)
+
+
+def rolling_exceedance(values, window, threshold):
+    """各位置滚动窗口中超过threshold（如基线的99%分位数）的值的比例
+
+    :values: 数值数组
+    :window: 窗口的值个数
+    :threshold: 阈值
+    :returns: 比例数组，0~1
+    """
+    sums, counts = rolling_sums(np.asarray(values) > threshold, window)
+    return sums / counts
+
+
+def stall_windows(values, window, baseline, z_limit, exceedance_limit, quantile, min_count=1):
+    """找出values中异常的时段
+
+    滚动窗口的z值不小于z_limit或超过分位数的比例不小于exceedance_limit的窗口为异常窗口，
+    异常窗口中超过基线分位数的值为异常值，相距不足window个值的异常值连成一个时段，
+    异常值少于min_count个的时段（如单个很慢的值）不算。
+
+    :values: 按时间排序的数值数组，如状态块的耗时
+    :window: 滚动窗口的值个数
+    :baseline: dict: mean、std 及 quantile 的值，如 StreamingStats.summary() 的结果
+    :z_limit: z值的阈值
+    :exceedance_limit: 超过分位数的比例的阈值
+    :quantile: baseline中作为阈值的分位数的键，如'p99'
+    :min_count: 时段中至少要有的异常值的个数
+    :returns: dict：first、last 各时段第一个、最后一个异常值的位置，peak_z 各时段的最大z值，
+        mean、max 各时段中所有值的平均值、最大值
+    """
+    values = np.asarray(values, dtype=np.float64)
+    positions = np.arange(len(values))
+    none = {'first': positions[:0], 'last': positions[:0], 'peak_z': values[:0], 'mean': values[:0], 'max': values[:0]}
+    if not len(values):
+        return none
+
+    threshold = baseline[quantile]
+    z = rolling_zscore(values, window, baseline['mean'], baseline['std'])
+    flagged = (z >= z_limit) | (rolling_exceedance(values, window, threshold) >= exceedance_limit)
+
+    # 位置i的值在以i至i + window - 1结尾的窗口中，其中有异常窗口即被覆盖
+    flagged_sums = np.concatenate(([0], np.cumsum(flagged)))
+    covered = flagged_sums[np.minimum(positions + window, len(values))] - flagged_sums[positions] > 0
+    slow = np.flatnonzero(covered & (values > threshold))
+    if not len(slow):
+        return none
+
+    breaks = np.flatnonzero(np.diff(slow) >= window)
+    starts = np.concatenate(([0], breaks + 1))
+    first = slow[starts]
+    last = slow[np.concatenate((breaks, [len(slow) - 1]))]
+    enough = np.diff(np.append(starts, len(slow))) >= min_count
+    if not enough.any():
+        return none
+    first = first[enough]
+    last = last[enough]
+
+    # 各时段[first, last]互不重叠，按(first, last + 1)交替分段归约，取偶数段。
+    # 末尾加一个值，使last + 1总是有效的位置
+    bounds = np.column_stack((first, last + 1)).ravel()
+    padded = np.append(values, 0)
+    # 覆盖时段内异常值的窗口以first至last + window - 1结尾，相邻时段间隔至少window个值，不会重叠
+    z_bounds = np.column_stack((first, np.minimum(last + window, len(values)))).ravel()
+    return {
+        'first' : first,
+        'last'  : last,
+        'peak_z': np.maximum.reduceat(np.append(z, 0), z_bounds)[::2],
+        'mean'  : np.add.reduceat(padded, bounds)[::2] / (last - first + 1),
+        'max'   : np.maximum.reduceat(padded, bounds)[::2],
+    }
+
+
+def excluded(length, first, last):
+    """去掉各时段后剩下的位置的掩码
+
+    :length: 数组长度
+    :first: 各时段第一个位置
+    :last: 各时段最后一个位置
+    :returns: 布尔数组，时段外为True
+    """
+    changes = np.zeros(length + 1, dtype=np.int64)
+    np.add.at(changes, first, 1)
+    np.add.at(changes, np.asarray(last) + 1, -1)
+    return np.cumsum(changes[:-1]) == 0
+
+
+class Baselines(object):
+
+    """各网关版本的状态日志耗时基线，每个版本一个 stats_util.StreamingStats ，用pickle保存
+
+    同时记下已合并的日志的标识，同一日志再次分析时不重复合并。
+    """
+
+    def __init__(self, filename):
+        """构造函数，文件存在时读取
+
+        :filename: 基线文件名
+        """
+        self.filename = filename
+        #: 版本 -> StreamingStats
+        self.stats = dict()
+        #: 已合并的日志的标识
+        self.merged = set()
+
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') == BASELINE_VERSION:
+                self.stats = data['baselines']
+                self.merged = data.get('merged', set())
+
+    def get(self, version, min_count=1):
+        """版本的基线，没有或个数少于min_count时为None"""
+        stats = self.stats.get(version)
+        return stats if stats is not None and stats.count >= min_count else None
+
+    def update(self, version, stats, identity=None):
+        """把一次分析的统计合并到版本的基线中
+
+        :version: 网关版本
+        :stats: StreamingStats
+        :identity: 日志的标识，如inode和文件开头的摘要。已合并过的日志不再合并，None表示不检查
+        :returns: 是否合并了
+        """
+        if identity is not None:
+            identity = tuple(identity)
+            if identity in self.merged:
+                return False
+            self.merged.add(identity)
+
+        self.stats.setdefault(version, StreamingStats()).merge(stats)
+        return True
+
+    def save(self):
+        """写入文件。先写临时文件再改名，中断时不损坏原来的基线"""
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            pickle.dump(
+                {'version': BASELINE_VERSION, 'baselines': self.stats, 'merged': self.merged},
+                f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_filename, self.filename)
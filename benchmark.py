@@ -0,0 +1,365 @@
+#!/usr/bin/env python2
+# vim: set fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4:
+"""TGW日志分析工具的性能测试
+
+生成指定大小的模拟TGW日志，测量解析及生成报告的速度、内存峰值和各分析器的耗时，
+结果保存为JSON，可以和以前的结果比较。需在本目录下运行（报告模板在当前目录）。
+"""
+
+# Imports
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+import tgw_log_analyzer
+from tgw_log_analyzer import TgwLogParser, HtmlReport, TextReport
+
+# 缺省生成的日志大小（MB）
+DEFAULT_LOG_SIZE = 50
+# 缺省的随机数种子，相同的种子生成相同的日志
+DEFAULT_SEED = 1
+# 缺省的结果文件
+DEFAULT_RESULT_FILENAME = 'benchmark.json'
+
+
+class LogGenerator(object):
+
+    """模拟TGW日志的生成器
+
+    包括状态日志块、连接的开始/成功/失败/断开/登出、WanM ERROR、网关停止及重启，
+    以及大量其他日志行。少量行为GBK编码，另有没有时间的续行。
+    """
+
+    gw_ids = ('GW01', 'GW02', 'GW03')
+    cs_addrs = ('10.0.0.2:9000', '10.0.0.3:9000', '10.0.0.4:9000')
+
+    #: 其他日志行的内容，(内容, 编码)
+    other_messages = (
+        (u'@2@sscc::gateway::OrderHandler@OnOrder@order.cpp@120@Order {0} accepted@', 'utf-8'),
+        (u'@2@sscc::gateway::OrderHandler@OnReport@order.cpp@188@Report {0}: 委托已确认@', 'utf-8'),
+        (u'@2@sscc::gateway::OrderHandler@OnReport@order.cpp@190@Report {0}: 撤单成功@', 'gbk'),
+        (u'@3@sscc::gateway::PbuHandler@Check@pbu.cpp@42@PBU {0} heartbeat delayed@', 'utf-8'),
+        (u'@2@sscc::gateway::Gateway@OnTimer@gw.cpp@77@Timer {0} fired@', 'utf-8'),
+    )
+
+    def __init__(self, seed=DEFAULT_SEED, start=datetime.datetime(2016, 12, 12, 8, 0, 0)):
+        """构造函数
+
+        :seed: 随机数种子
+        :start: 第一行日志的时间
+        """
+        self.random = random.Random(seed)
+        self.time = start
+        self.conn_id = 100
+        #: 连接ID -> (网关ID, TCS地址)
+        self.active = dict()
+        self.line_count = 0
+
+    def line(self, content, encoding='utf-8'):
+        self.line_count += 1
+        return (u']' + self.time.strftime('%Y-%m-%d %H:%M:%S.%f') + content + u'\n').encode(encoding)
+
+    def step(self, low, high):
+        self.time += datetime.timedelta(microseconds=self.random.randint(low, high))
+
+    def startup(self):
+        """网关启动时的几行"""
+        self.active.clear()
+        return [
+            self.line(u'@2@cppf::common::SzseApp::InitLog@app.cpp@10@Log init@'),
+            self.line(u'@2@cppf::common::SzseApp::Run@app.cpp@11@app started, Version Info: TGW RELEASE version:2.5.1 revision:4567 build 20161201@cmd line: tgw.exe -c conf.xml'),
+            self.line(u'@2@cppf::common::SysInfo@sys.cpp@12@osType:Windows, osVersion:6.1, cpuType:Intel Xeon , cpuBits:64, memorySize:16G@'),
+        ]
+
+    def status_block(self):
+        lines = [self.line(u'@2@sscc::gateway::Gateway@LogCurrentStatus@gw.cpp@1@Current Statuses:@')]
+        for i in xrange(self.random.randint(1, 6)):
+            # 偶尔有很慢的状态块
+            self.step(10, 300000 if self.random.random() < 0.02 else 3000)
+            lines.append(self.line(u'@2@sscc::gateway::Gateway@LogCurrentStatus@gw.cpp@1@  PBU {0}: {1} orders pending@'.format(
+                i, self.random.randint(0, 100))))
+
+        return lines
+
+    def connect(self):
+        gw_id = self.random.choice(self.gw_ids)
+        cs_addr = self.random.choice(self.cs_addrs)
+        lines = [self.line(u"@2@sscc::gateway::CsComm::Connect@cs.cpp@5@Begin to create server connection of tag '{0}' to {1}".format(gw_id, cs_addr))]
+
+        self.step(100, 5000)
+        self.conn_id += 1
+        if self.random.random() < 0.3:
+            if self.random.random() < 0.5:
+                lines.append(self.line(u'@2@sscc::gateway::CsComm@OnWanM@cs.cpp@7@WanM ERROR@Connection<{0}(x) - unknown to {1}> - connect timeout'.format(
+                    self.conn_id, cs_addr)))
+            lines.append(self.line(u'@2@sscc::gateway::CsComm::OnConnectFail@cs.cpp@6@Failed to create CsConnection of tag {0}. WanM error code: 10061:connection refused. Reconnecting after 5 seconds...@CsConnection {1}(CS_DisConnected) - unknown:0 to {2} to TCS'.format(
+                gw_id, self.conn_id, cs_addr)))
+        else:
+            lines.append(self.line(u'@2@sscc::gateway::CsComm::OnConnectOK@cs.cpp@6@Success: CsConnection {0}(CS_Connected) - 10.1.1.1:5000 to {1} of tag {2} to TCS@'.format(
+                self.conn_id, cs_addr, gw_id)))
+            self.active[self.conn_id] = (gw_id, cs_addr)
+
+        return lines
+
+    def disconnect(self):
+        conn_id = self.random.choice(sorted(self.active))
+        gw_id, cs_addr = self.active.pop(conn_id)
+        if self.random.random() < 0.5:
+            return [self.line(u'@2@sscc::gateway::CsComm::OnConnectionClose@cs.cpp@8@CsConnection {0}(CS_Closed) - 10.1.1.1:5000 to {1} of tag {2} to TCS is closed. WanM error code: 10054:connection reset by peer. Reconnecting after 5 seconds'.format(
+                conn_id, cs_addr, gw_id))]
+        else:
+            return [self.line(u'@2@sscc::gateway::CsConnection::HandleLogout@cs.cpp@9@Received logout message, code: 5, invalid password@Connection {0}(CS_Connected) - 10.1.1.1:5000 to {1} of tag {2}'.format(
+                conn_id, cs_addr, gw_id))]
+
+    def restart(self):
+        lines = [self.line(u'@2@cppf::common::StopAppFunc@app.cpp@20@Catch control event CTRL_C_EVENT(0), stopping@')]
+        self.step(1000000, 5000000)
+        return lines + self.startup()
+
+    def other(self):
+        content, encoding = self.random.choice(self.other_messages)
+        lines = [self.line(content.format(self.random.randint(1, 999999)), encoding)]
+        if self.random.random() < 0.01:
+            lines.append(b'    continuation line without timestamp\n')
+
+        return lines
+
+    def lines(self):
+        """依次产生日志行（已编码的字符串）的list，无穷无尽"""
+        yield self.startup()
+
+        while True:
+            self.step(100, 20000)
+            r = self.random.random()
+            if r < 0.05:
+                yield self.status_block()
+            elif r < 0.055:
+                yield self.connect()
+            elif r < 0.058 and self.active:
+                yield self.disconnect()
+            elif r < 0.05802:
+                yield self.restart()
+            else:
+                yield self.other()
+
+    def generate(self, f, size):
+        """生成约size字节的日志
+
+        :f: 以'wb'方式打开的文件
+        :size: 字节数，写完最后一组行为止
+        :returns: 实际的字节数
+        """
+        written = 0
+        for lines in self.lines():
+            data = b''.join(lines)
+            f.write(data)
+            written += len(data)
+            if written >= size:
+                return written
+
+
+def peak_rss():
+    """进程至今的内存峰值（KB）。不支持时为None"""
+    if resource is None:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS上是字节，Linux上是KB
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def instrument(parser, timings):
+    """统计各分析器parse()、finish()的耗时
+
+    :parser: TgwLogParser
+    :timings: 分析器名称 -> {'parse': 秒数, 'finish': 秒数}，在此累加
+    :returns: 无
+    """
+    def timed(name, method, func):
+        def wrapper(*args, **kwargs):
+            begin = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[name][method] += timer() - begin
+        return wrapper
+
+    for p in parser.parsers:
+        timings[p.parser_name] = {'parse': 0.0, 'finish': 0.0}
+        for method in ('parse', 'finish'):
+            setattr(p, method, timed(p.parser_name, method, getattr(p, method)))
+
+
+def run_once(args):
+    """在子进程中测一次，使内存峰值互不影响
+
+    :args: (日志文件名, 命令行参数dict)
+    :returns: 测量结果dict
+    """
+    filename, options = args
+    size = os.path.getsize(filename)
+    stats = dict()
+
+    parser = TgwLogParser(
+        filename, tgw_log_analyzer.DEFAULT_LOG_ENCODING.split(','),
+        datetime.time.min, datetime.time.max, streaming=options['streaming'])
+
+    parsers = dict()
+    if options['jobs'] == 1:
+        # 并行时各分析器在子进程中运行，不能这样统计
+        instrument(parser, parsers)
+
+    begin = timer()
+    result = parser.parse(jobs=options['jobs'])
+    elapsed = timer() - begin
+    stats['parse'] = {
+        'seconds'       : elapsed,
+        'lines'         : parser.line_count,
+        'lines_per_sec' : parser.line_count / elapsed,
+        'mb_per_sec'    : size / 1024.0 / 1024.0 / elapsed,
+        'peak_rss_kb'   : peak_rss(),
+    }
+    stats['parsers'] = parsers
+
+    if not options['no_report']:
+        output_dir = tempfile.mkdtemp(prefix='tgw_benchmark_')
+        begin = timer()
+        HtmlReport(output_dir).generate(result)
+        stats['html_report'] = {'seconds': timer() - begin, 'peak_rss_kb': peak_rss()}
+
+        begin = timer()
+        TextReport().generate(result)
+        stats['text_report'] = {'seconds': timer() - begin, 'peak_rss_kb': peak_rss()}
+
+    return stats
+
+
+def best_of(runs):
+    """多次测量中各项耗时最短的一次，内存峰值取最大"""
+    best = min(runs, key=lambda run: run['parse']['seconds'])
+    for stage in ('html_report', 'text_report'):
+        if stage in best:
+            best[stage] = min((run[stage] for run in runs), key=lambda s: s['seconds'])
+
+    for run in runs:
+        for stage, values in run.iteritems():
+            if 'peak_rss_kb' in values and values['peak_rss_kb'] is not None:
+                best[stage]['peak_rss_kb'] = max(best[stage]['peak_rss_kb'], values['peak_rss_kb'])
+
+    return best
+
+
+def print_report(stats, baseline=None):
+    """显示测量结果，有baseline时显示比值（大于1表示变慢）"""
+    def row(name, seconds, old_seconds, extra=u''):
+        ratio = u'{0:8.2f}x'.format(seconds / old_seconds) if old_seconds else u' ' * 9
+        print(u'{0:24s} {1:10.3f}s {2} {3}'.format(name, seconds, ratio, extra))
+
+    def old(*keys):
+        value = baseline
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+    parse = stats['parse']
+    print(u'Log file: {0} ({1:,} bytes, {2:,} lines)'.format(
+        stats['log']['filename'] or u'generated with seed {0}'.format(stats['options']['seed']), stats['log']['size'], parse['lines']))
+    row(u'parse', parse['seconds'], old('parse', 'seconds'), u'{0:,.0f} lines/s  {1:.1f} MB/s  peak RSS {2} KB'.format(
+        parse['lines_per_sec'], parse['mb_per_sec'], parse['peak_rss_kb']))
+
+    for name, times in sorted(stats['parsers'].iteritems()):
+        for method in ('parse', 'finish'):
+            row(u'  {0}.{1}'.format(name, method), times[method], old('parsers', name, method))
+
+    for stage in ('html_report', 'text_report'):
+        if stage in stats:
+            row(stage, stats[stage]['seconds'], old(stage, 'seconds'), u'peak RSS {0} KB'.format(stats[stage]['peak_rss_kb']))
+
+
+def main(**args):
+    filename = args['log']
+    if filename and os.path.exists(filename):
+        logging.info(u'Using existing log file "{0}"'.format(filename))
+    else:
+        if not filename:
+            fd, filename = tempfile.mkstemp(prefix='tgw_benchmark_', suffix='.log')
+            os.close(fd)
+
+        logging.info(u'Generating {0} MB log file "{1}"...'.format(args['size'], filename))
+        with open(filename, 'wb') as f:
+            LogGenerator(args['seed']).generate(f, int(args['size'] * 1024 * 1024))
+
+    size = os.path.getsize(filename)
+    try:
+        runs = list()
+        for i in xrange(args['repeat']):
+            logging.info(u'Run #{0}...'.format(i + 1))
+            pool = multiprocessing.Pool(1)
+            try:
+                runs.append(pool.apply(run_once, ((filename, args),)))
+            finally:
+                pool.terminate()
+                pool.join()
+    finally:
+        if not args['log']:
+            os.remove(filename)
+
+    stats = best_of(runs)
+    stats['version'] = tgw_log_analyzer.VERSION
+    stats['python'] = platform.python_version()
+    stats['platform'] = platform.platform()
+    stats['options'] = {key: args[key] for key in ('size', 'seed', 'jobs', 'repeat', 'streaming')}
+    stats['log'] = {'filename': args['log'] or '', 'size': size}
+
+    baseline = None
+    if args['compare']:
+        with open(args['compare'], 'rb') as f:
+            baseline = json.load(f)
+
+    print_report(stats, baseline)
+
+    with open(args['output'], 'wb') as f:
+        json.dump(stats, f, indent=2, sort_keys=True)
+    logging.info(u'Results are saved to "{0}"'.format(args['output']))
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=u"""\
+TGW日志分析工具的性能测试""")
+
+    parser.add_argument('-v', '--verbose', action="store_true", dest="verbose", default=False, help=u"显示调试日志")
+    parser.add_argument('-s', '--size', action="store", dest="size", type=float, default=DEFAULT_LOG_SIZE, help=u"生成的日志大小（MB），缺省为" + unicode(DEFAULT_LOG_SIZE))
+    parser.add_argument('--seed', action="store", dest="seed", type=int, default=DEFAULT_SEED, help=u"生成日志的随机数种子")
+    parser.add_argument('-l', '--log', action="store", dest="log", help=u"日志文件。已存在时直接使用，否则生成到此文件并保留")
+    parser.add_argument('-j', '--jobs', action="store", dest="jobs", type=int, default=1, help=u"解析日志的进程数。大于1时不统计各分析器的耗时")
+    parser.add_argument('-r', '--repeat', action="store", dest="repeat", type=int, default=1, help=u"重复次数，取最好的结果")
+    parser.add_argument('--streaming', action="store_true", dest="streaming", default=False, help=u"状态日志流式统计")
+    parser.add_argument('--no-report', action="store_true", dest="no_report", default=False, help=u"不测生成报告")
+    parser.add_argument('-o', '--output', action="store", dest="output", default=DEFAULT_RESULT_FILENAME, help=u"结果JSON文件，缺省为" + DEFAULT_RESULT_FILENAME)
+    parser.add_argument('-c', '--compare', action="store", dest="compare", help=u"与此前保存的结果JSON文件比较")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format=u"%(asctime)s %(levelname)s %(message)s")
+
+    sys.exit(main(**vars(args)))
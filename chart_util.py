@@ -1,19 +1,174 @@
 # vim: set fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4:
 import base64
+import hashlib
+import os
 import StringIO
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+import numpy as np
 
-def get_data_uri(fig, fmt='png'):
-    """返回一个matplotlib.figure对象的data-uri串
+# 图形的绘制方式变化时修改，使以前缓存的图形失效
+CHART_VERSION = 1
+# 缓存目录中最多保留的图形数，超过时删除最久没用的
+CHART_CACHE_MAX_FILES = 200
 
-    可以用于内联图形。
+
+def import_pyplot():
+    """导入并设置matplotlib.pyplot
+
+    导入pyplot较慢，只在需要绘图时调用，如只生成文本报告时不导入。
+
+    :returns: matplotlib.pyplot 模块
     """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    matplotlib.style.use('ggplot')
+    return plt
+
+
+def get_image(fig, fmt='png'):
+    """返回一个matplotlib.figure对象保存为fmt格式的内容"""
     output = StringIO.StringIO()
     fig.savefig(output, format=fmt)
+    return output.getvalue()
+
+
+def to_data_uri(image, fmt='png'):
+    """返回图形内容的data-uri串"""
     return "data:image/{format};base64,{content}".format(
         format=fmt,
-        content=base64.b64encode(output.getvalue()))
+        content=base64.b64encode(image))
+
+
+def get_data_uri(fig, fmt='png'):
+    """返回一个matplotlib.figure对象的data-uri串
+
+    可以用于内联图形。
+    """
+    return to_data_uri(get_image(fig, fmt), fmt)
+
+
+def envelope(x, y, columns):
+    """把按x排序的点按x等分为columns段，求各段y的最小值、最大值及90%分位数
+
+    点数远多于图形宽度的像素数时，画各段的包络代替画每个点。
+
+    :x: 整数数组，已排序，如datetime64[ns]的int64值
+    :y: 数值数组，和x一一对应
+    :columns: 段数，一般为图形的宽度（像素）
+    :returns: (各段中点的x, 最小值, 最大值, 90%分位数)，都是长为columns的数组。
+        没有点的段的值为NaN
+    """
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(x[0], x[-1], columns + 1)
+    centers = (edges[:-1] + edges[1:]) / 2
+
+    # 各点所在的段，最后一点计入最后一段
+    buckets = np.minimum(np.searchsorted(edges, x, side='right') - 1, columns - 1)
+    counts = np.bincount(buckets, minlength=columns)
+    nonempty = counts > 0
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    low = np.full(columns, np.nan)
+    high = np.full(columns, np.nan)
+    p90 = np.full(columns, np.nan)
+
+    # x已排序，各段的点是连续的
+    first = starts[nonempty]
+    low[nonempty] = np.minimum.reduceat(y, first)
+    high[nonempty] = np.maximum.reduceat(y, first)
+
+    # 和numpy.percentile()相同的线性插值。各段只做部分排序，比整体排序快
+    for i in np.flatnonzero(nonempty):
+        values = y[starts[i]:starts[i] + counts[i]]
+        position = (len(values) - 1) * 0.9
+        below = int(position)
+        above = min(below + 1, len(values) - 1)
+        values = np.partition(values, (below, above))
+        p90[i] = values[below] + (values[above] - values[below]) * (position - below)
+
+    return centers, low, high, p90
+
+
+class ChartCache(object):
+
+    """按数据内容的散列值缓存图形，数据不变时不再重新绘制
+
+    每个图形存为目录中的一个文件，文件名为散列值。
+    """
+
+    def __init__(self, directory, max_files=CHART_CACHE_MAX_FILES):
+        """构造函数
+
+        :directory: 缓存目录，没有时在第一次保存时创建
+        :max_files: 最多保留的图形数
+        """
+        self.directory = directory
+        self.max_files = max_files
+
+    @staticmethod
+    def key(name, arrays, **params):
+        """图形的散列值
+
+        :name: 图形的名称
+        :arrays: 绘图用的numpy数组的序列
+        :params: 其他影响图形的参数
+        :returns: 十六进制串
+        """
+        import matplotlib
+
+        digest = hashlib.sha1()
+        digest.update(repr((CHART_VERSION, name, matplotlib.__version__, sorted(params.items()))))
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            digest.update(repr((array.dtype.str, array.shape)))
+            digest.update(array.data)
+
+        return digest.hexdigest()
+
+    def filename(self, key, fmt='png'):
+        return os.path.join(self.directory, key + '.' + fmt)
+
+    def get(self, key, fmt='png'):
+        """缓存的图形内容，没有时返回None"""
+        filename = self.filename(key, fmt)
+        try:
+            with open(filename, 'rb') as f:
+                image = f.read()
+        except IOError:
+            return None
+
+        # 更新修改时间，清理时保留最近用过的
+        os.utime(filename, None)
+        return image
+
+    def put(self, key, image, fmt='png'):
+        """保存图形内容，并清理多余的旧图形"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # 先写临时文件再改名，避免并行生成报告时读到不完整的文件
+        filename = self.filename(key, fmt)
+        temp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            f.write(image)
+        os.rename(temp_filename, filename)
+
+        self.clean()
+
+    def clean(self):
+        """删除超过max_files个的最久没用的图形"""
+        filenames = [
+            os.path.join(self.directory, name) for name in os.listdir(self.directory)
+            if not name.endswith('.tmp')
+        ]
+        if len(filenames) <= self.max_files:
+            return
 
+        filenames.sort(key=os.path.getmtime)
+        for filename in filenames[:len(filenames) - self.max_files]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
@@ -0,0 +1,192 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4:
+"""按列存储分析器收集到的数据，代替每行一个dict"""
+import numpy as np
+
+# 列的类型：64位整数，如 DateTime.to_epoch() 格式的时间
+INT = 'int'
+# 列的类型：64位浮点数
+FLOAT = 'float'
+# 列的类型：字符串。相同的字符串只保存一份，存为编码，转为DataFrame时为Categorical
+STR = 'str'
+
+# 列的类型 -> 数组的类型
+DTYPES = {INT: np.int64, FLOAT: np.float64, STR: np.int32}
+
+# 列的初始容量，之后每次翻倍
+INITIAL_CAPACITY = 1024
+
+
+class ColumnStore(object):
+
+    """只追加的按列存储
+
+    整数、浮点数列存为int64、float64的numpy数组，字符串列存为int32编码的numpy数组加去重后的取值表。
+    数组按容量翻倍增长，to_frame() 直接使用数组的有效部分，不再逐行转换。
+    """
+
+    def __init__(self, columns):
+        """构造函数
+
+        :columns: (列名, 类型)的序列，类型为 INT 、 FLOAT 或 STR
+        """
+        #: 列名，按定义的顺序
+        self.names = [name for name, _ in columns]
+        #: 列名 -> 类型
+        self.kinds = dict(columns)
+        #: 列名 -> 数组。字符串列为编码，-1表示None
+        self.arrays = {
+            name: np.zeros(INITIAL_CAPACITY, dtype=DTYPES[kind])
+            for name, kind in columns
+        }
+        #: 字符串列名 -> 取值表
+        self.categories = {name: list() for name, kind in columns if kind == STR}
+        #: 字符串列名 -> {取值: 编码}
+        self.codes = {name: dict() for name, kind in columns if kind == STR}
+        self.size = 0
+
+    @classmethod
+    def from_arrays(cls, names, arrays, kinds=None):
+        """由各列的数组创建只有数值列的ColumnStore
+
+        :names: 列名的序列
+        :arrays: 和names对应的数值数组，长度相同
+        :kinds: 列名 -> INT 或 FLOAT ，没有的列为 INT
+        :returns: ColumnStore
+        """
+        kinds = kinds or dict()
+        columns = [(name, kinds.get(name, INT)) for name in names]
+        store = cls(columns)
+        store.size = len(arrays[0]) if arrays else 0
+        store.arrays = {
+            name: np.array(array, dtype=DTYPES[kind])
+            for (name, kind), array in zip(columns, arrays)
+        }
+        return store
+
+    def __getstate__(self):
+        # 只保存有效部分
+        state = self.__dict__.copy()
+        state['arrays'] = {name: self.column(name).copy() for name in self.names}
+        return state
+
+    def __len__(self):
+        return self.size
+
+    def encode(self, name, value):
+        """字符串列name中value的编码，新的取值加入取值表"""
+        if value is None:
+            return -1
+
+        codes = self.codes[name]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.categories[name])
+            self.categories[name].append(value)
+
+        return code
+
+    def reserve(self, size):
+        """保证各列至少能容纳size行"""
+        capacity = len(self.arrays[self.names[0]]) if self.names else size
+        if size <= capacity:
+            return
+
+        capacity = max(capacity, INITIAL_CAPACITY)
+        while capacity < size:
+            capacity *= 2
+
+        for name in self.names:
+            array = np.zeros(capacity, dtype=self.arrays[name].dtype)
+            array[:self.size] = self.arrays[name][:self.size]
+            self.arrays[name] = array
+
+    def append(self, values):
+        """追加一行
+
+        :values: 按列的顺序排列的各列的值
+        :returns: 新行的序号
+        """
+        self.reserve(self.size + 1)
+
+        i = self.size
+        for name, value in zip(self.names, values):
+            self.arrays[name][i] = self.encode(name, value) if name in self.codes else value
+        self.size += 1
+
+        return i
+
+    def append_dict(self, row):
+        """追加一行
+
+        :row: 列名 -> 值的dict。没有的列，数值为0，字符串为None
+        :returns: 新行的序号
+        """
+        return self.append([row.get(name, None if self.kinds[name] == STR else 0) for name in self.names])
+
+    def get(self, i, name):
+        value = self.arrays[name][i]
+        if name in self.codes:
+            return self.categories[name][value] if value >= 0 else None
+
+        return value.item()
+
+    def set(self, i, name, value):
+        self.arrays[name][i] = self.encode(name, value) if name in self.codes else value
+
+    def row(self, i):
+        """第i行，列名 -> 值的dict"""
+        return {name: self.get(i, name) for name in self.names}
+
+    def column(self, name):
+        """数值列的有效部分或字符串列的编码，不复制"""
+        return self.arrays[name][:self.size]
+
+    def extend(self, other, indices=None):
+        """追加另一个同样各列的ColumnStore中的行
+
+        :other: ColumnStore
+        :indices: 要追加的行的序号，按此顺序追加。None表示全部
+        :returns: 无
+        """
+        if indices is None:
+            indices = np.arange(len(other))
+        else:
+            indices = np.asarray(indices, dtype=np.int64)
+
+        self.reserve(self.size + len(indices))
+        end = self.size + len(indices)
+
+        for name in self.names:
+            values = other.column(name)[indices]
+            if name in self.codes:
+                # 换成本表的编码，-1保持不变
+                mapping = np.array(
+                    [self.encode(name, value) for value in other.categories[name]] + [-1],
+                    dtype=np.int32)
+                values = mapping[values]
+
+            self.arrays[name][self.size:end] = values
+
+        self.size = end
+
+    def take(self, indices):
+        """按indices的顺序取出各行，返回新的ColumnStore"""
+        store = ColumnStore([(name, self.kinds[name]) for name in self.names])
+        store.extend(self, indices)
+        return store
+
+    def to_frame(self):
+        """转为DataFrame
+
+        :returns: DataFrame。数值列为int64、float64，字符串列为Categorical，None为NaN
+        """
+        import pandas as pd
+
+        columns = dict()
+        for name in self.names:
+            if name in self.codes:
+                columns[name] = pd.Categorical.from_codes(self.column(name), categories=self.categories[name])
+            else:
+                columns[name] = self.column(name)
+
+        return pd.DataFrame(columns, columns=self.names)
@@ -0,0 +1,152 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4:
+"""按列保存、读取DataFrame，供其他工具分析，或不重新分析日志就生成报告
+
+有pyarrow时保存为Parquet；否则保存为压缩的npz，每列一个数组，不用pickle。
+时间列保存为带类型的时间戳，Categorical保留取值表，其他对象列保存为Categorical。
+"""
+import datetime
+import json
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# 保存格式
+PARQUET = 'parquet'
+NPZ = 'npz'
+
+# npz中记录各列名称、类型的数组名
+NPZ_COLUMNS_KEY = 'columns'
+
+
+def default_format():
+    """有pyarrow时为Parquet，否则为npz"""
+    return PARQUET if pyarrow is not None else NPZ
+
+
+def to_unicode(value):
+    """str按UTF-8转为unicode，其他值不变"""
+    return value.decode('utf-8') if isinstance(value, str) else value
+
+
+def unicode_columns(df):
+    """把对象列及Categorical取值表中的str转为unicode
+
+    分析器的结果中str和unicode混用，pyarrow按第一个值推断列的类型，
+    统一为unicode后保存为字符串类型，读回的也是unicode。
+
+    :df: DataFrame
+    :returns: 转换后的DataFrame，不修改df
+    """
+    df = df.copy(deep=False)
+    for name in df.columns:
+        column = df[name]
+        if hasattr(column, 'cat'):
+            if column.cat.categories.dtype.kind == 'O':
+                df[name] = column.cat.rename_categories([to_unicode(c) for c in column.cat.categories])
+        elif column.dtype.kind == 'O':
+            df[name] = column.map(to_unicode)
+
+    return df
+
+
+def write_table(df, path, fmt=None):
+    """保存DataFrame，不保存索引
+
+    :df: DataFrame
+    :path: 文件名，不含扩展名
+    :fmt: PARQUET 或 NPZ ，缺省见 default_format()
+    :returns: 保存的文件名，即path加格式的扩展名
+    """
+    fmt = fmt or default_format()
+    filename = path + '.' + fmt
+    df = unicode_columns(df)
+
+    if fmt == PARQUET:
+        if pyarrow is None:
+            raise ValueError(u'pyarrow is required to write Parquet files')
+
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+        pyarrow.parquet.write_table(table, filename)
+        return filename
+
+    columns = list()
+    arrays = dict()
+    for i, name in enumerate(df.columns):
+        column = df[name]
+        key = 'c{0}'.format(i)
+
+        if column.dtype.kind == 'M':
+            kind = 'datetime'
+            arrays[key] = column.values.view(np.int64)
+        elif column.dtype.kind in 'biuf':
+            kind = 'number'
+            arrays[key] = column.values
+        else:
+            # Categorical及其他对象列。None、NaN的编码为-1
+            kind = 'category'
+            categorical = column.values if hasattr(column, 'cat') else pd.Categorical(column.values)
+            arrays[key] = categorical.codes
+            categories = categorical.categories.values
+            arrays[key + '_categories'] = (
+                np.array(list(categories), dtype=np.unicode_)
+                if categories.dtype.kind == 'O' else categories)
+
+        columns.append((unicode(name), kind))
+
+    arrays[NPZ_COLUMNS_KEY] = np.array([json.dumps(columns)], dtype=np.unicode_)
+    with open(filename, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+    return filename
+
+
+def read_table(filename):
+    """读取 write_table() 保存的文件
+
+    :filename: 文件名，按扩展名确定格式
+    :returns: DataFrame
+    """
+    if filename.endswith('.' + PARQUET):
+        if pyarrow is None:
+            raise ValueError(u'pyarrow is required to read Parquet files')
+
+        return pyarrow.parquet.read_table(filename).to_pandas()
+
+    with np.load(filename, allow_pickle=False) as data:
+        columns = json.loads(data[NPZ_COLUMNS_KEY][0])
+
+        values = dict()
+        for i, (name, kind) in enumerate(columns):
+            key = 'c{0}'.format(i)
+            if kind == 'datetime':
+                values[name] = pd.to_datetime(data[key].view('datetime64[ns]'))
+            elif kind == 'number':
+                values[name] = data[key]
+            else:
+                values[name] = pd.Categorical.from_codes(data[key], categories=data[key + '_categories'])
+
+    return pd.DataFrame(values, columns=[name for name, _ in columns])
+
+
+def to_json(value):
+    """json.dump()的default参数，转换numpy数值及时间"""
+    if isinstance(value, datetime.datetime):
+        return {'__timestamp__': value.isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+def from_json(obj):
+    """json.load()的object_hook参数，还原 to_json() 转换的pandas.Timestamp"""
+    if '__timestamp__' in obj:
+        return pd.Timestamp(obj['__timestamp__'])
+
+    return obj
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import pandas as pd
+import datetime
 
 def thousands_sep(num, digits=None):
     """为数字加上千位符，可选保留小数位数
@@ -17,21 +17,38 @@ def thousands_sep(num, digits=None):
     else:
         return '{:,.{:}f}'.format(num, digits)
 
+def is_time(dt):
+    """dt是否为有效的时间。''、None、NaT都不是，不需要导入pandas"""
+    return isinstance(dt, datetime.datetime) and dt == dt
+
 def as_time(dt, default='--'):
-    if dt:
+    if is_time(dt):
         return str(dt.time())
     else:
         return default
 
 def as_datetime(dt, default='--'):
-    if dt:
+    if is_time(dt):
         return str(dt)
     else:
         return default
 
 def timedelta(dt, unit='1s'):
+    import pandas as pd
     return dt / pd.Timedelta(unit)
 
+def as_ms(us, digits=3, default='--'):
+    """微秒数转为毫秒数并加千位符，None、NaN时为default"""
+    if us is None or us != us:
+        return default
+    return thousands_sep(us / 1000.0, digits)
+
+def as_seconds(us, digits=1, default='--'):
+    """微秒数转为秒数并加千位符，None、NaN时为default"""
+    if us is None or us != us:
+        return default
+    return thousands_sep(us / 1000000.0, digits)
+
 def conn_status(status):
     if status == 'connected':
         return u'连接后未断开'
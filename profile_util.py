@@ -0,0 +1,168 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4:
+"""分段统计耗时，用于找出处理慢在哪里"""
+from timeit import default_timer as timer
+
+
+class Section(object):
+
+    """一段处理的调用次数、匹配次数及耗时"""
+
+    def __init__(self):
+        self.calls = 0
+        #: 返回值为真的次数，如分析器匹配了的行数
+        self.matches = 0
+        self.seconds = 0.0
+
+    def add(self, seconds, matched=False):
+        self.calls += 1
+        self.matches += bool(matched)
+        self.seconds += seconds
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.matches += other.matches
+        self.seconds += other.seconds
+
+
+class Timing(object):
+
+    """with语句中的代码计入Profiler的一段"""
+
+    def __init__(self, section):
+        self.section = section
+
+    def __enter__(self):
+        self.begin = timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.section.calls += 1
+        self.section.seconds += timer() - self.begin
+
+
+class NullTiming(object):
+
+    """不统计时代替Timing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMING = NullTiming()
+
+
+class Profiler(object):
+
+    """各段处理的耗时统计
+
+    段按名称区分，按首次出现的顺序排列。多个进程的统计可以合并，合并后的耗时为各进程之和。
+    """
+
+    def __init__(self):
+        #: 名称 -> Section
+        self.sections = dict()
+        #: 名称，按首次出现的顺序
+        self.names = list()
+
+    def get(self, name):
+        """名为name的段，没有时新建"""
+        section = self.sections.get(name)
+        if section is None:
+            section = self.sections[name] = Section()
+            self.names.append(name)
+
+        return section
+
+    def time(self, name):
+        """with语句中的代码计入名为name的段"""
+        return Timing(self.get(name))
+
+    def wrap(self, name, func):
+        """返回统计func的调用次数、返回值为真的次数及耗时的函数
+
+        :name: 段的名称
+        :func: 要统计的函数
+        :returns: 函数
+        """
+        section = self.get(name)
+
+        def wrapper(*args, **kwargs):
+            begin = timer()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                section.calls += 1
+                section.seconds += timer() - begin
+
+            if result:
+                section.matches += 1
+            return result
+
+        return wrapper
+
+    def merge(self, other):
+        """合并另一个Profiler的统计"""
+        for name in other.names:
+            self.get(name).merge(other.sections[name])
+
+    def to_dict(self):
+        """可保存为JSON的统计结果，名称 -> {calls, matches, seconds}"""
+        return {
+            name: {
+                'calls'     : section.calls,
+                'matches'   : section.matches,
+                'seconds'   : section.seconds,
+            }
+            for name, section in self.sections.iteritems()
+        }
+
+    def report(self, total_name='parse'):
+        """统计表
+
+        :total_name: 计算百分比的基准段的名称
+        :returns: 文本
+        """
+        total = self.sections[total_name].seconds if total_name in self.sections else 0
+
+        lines = [u'{0:32s} {1:>12s} {2:>12s} {3:>10s} {4:>7s}'.format(u'Section', u'Calls', u'Matches', u'Seconds', u'%')]
+        for name in self.names:
+            section = self.sections[name]
+            lines.append(u'{0:32s} {1:12,d} {2:12,d} {3:10.3f} {4:>7s}'.format(
+                name, section.calls, section.matches, section.seconds,
+                u'{0:.1f}'.format(section.seconds * 100 / total) if total else u''))
+
+        return u'\n'.join(lines)
+
+
+def time(profiler, name):
+    """profiler为None时不统计的 Profiler.time()"""
+    return profiler.time(name) if profiler else NULL_TIMING
+
+
+class TimedParser(object):
+
+    """代替分析器放入分派表，统计其parse()的调用次数、匹配次数及耗时"""
+
+    def __init__(self, parser, section):
+        """构造函数
+
+        :parser: 分析器
+        :section: 计入的 Section
+        """
+        self.parser = parser
+        self.section = section
+
+    def parse(self, line_time, line_content, key=None):
+        begin = timer()
+        try:
+            matched = self.parser.parse(line_time, line_content, key)
+        finally:
+            self.section.calls += 1
+            self.section.seconds += timer() - begin
+
+        if matched:
+            self.section.matches += 1
+        return matched
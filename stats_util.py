@@ -0,0 +1,264 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4:
+"""流式统计：不保留每个值，在线更新统计量，结果可以合并"""
+from collections import defaultdict
+import heapq
+import math
+
+import numpy as np
+
+# 分位数估计的缺省相对误差
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+# summary()给出的分位数
+SUMMARY_PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentile_name(percentile):
+    """分位数在summary中的名称，如90 -> 'p90'，99.9 -> 'p999'"""
+    return 'p' + '{0:g}'.format(percentile).replace('.', '')
+
+
+class QuantileSketch(object):
+
+    """可合并的分位数估计（DDSketch）
+
+    值按对数分桶，桶边界为gamma的整数次幂，gamma = (1 + a) / (1 - a)。
+    每个桶只记个数，估计值的相对误差不超过a，桶数只和值的数量级范围有关。
+    只适用于不小于0的值，不大于0的值都记在一个桶中，估计为0。
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        """构造函数
+
+        :relative_accuracy: 估计值的相对误差a
+        """
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+        #: 桶号 -> 个数。桶号为k的桶包含(gamma**(k-1), gamma**k]中的值
+        self.buckets = defaultdict(int)
+        #: 不大于0的值的个数
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value):
+        if value > 0:
+            self.buckets[int(math.ceil(math.log(value) / self.log_gamma))] += 1
+        else:
+            self.zero_count += 1
+
+        self.count += 1
+
+    def add_values(self, values):
+        """add()的批量版本
+
+        :values: 值的序列
+        :returns: 无
+        """
+        values = np.asarray(values, dtype=np.float64)
+        positive = values[values > 0]
+
+        keys, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] += count
+
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+
+    def merge(self, other):
+        """合并另一个估计，结果和把那边的值都加进来一样
+
+        :other: 相对误差相同的QuantileSketch
+        :returns: 无
+        """
+        if other.gamma != self.gamma:
+            raise ValueError(u'Cannot merge sketches with different relative accuracy')
+
+        for key, count in other.buckets.iteritems():
+            self.buckets[key] += count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def value(self, key):
+        """桶中值的估计，和桶内任何值的相对误差都不超过relative_accuracy"""
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantiles(self, qs):
+        """估计多个分位数
+
+        :qs: 0~1之间的分位数序列
+        :returns: 估计值的list。没有值时都为0
+        """
+        if not self.count:
+            return [0] * len(qs)
+
+        # 和numpy.percentile一样以q * (count - 1)为排名，取最接近的值
+        ranks = sorted((q * (self.count - 1), i) for i, q in enumerate(qs))
+        results = [0] * len(qs)
+
+        seen = self.zero_count
+        keys = iter(sorted(self.buckets))
+        key = None
+        for rank, i in ranks:
+            if rank < self.zero_count:
+                continue
+
+            while seen <= rank:
+                key = next(keys)
+                seen += self.buckets[key]
+            results[i] = self.value(key)
+
+        return results
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    def histogram(self, edges):
+        """按桶中值的估计分到各区间，用法同 numpy.histogram 的bins
+
+        :edges: 递增的区间边界
+        :returns: 各区间[edges[i], edges[i+1])中值的个数的list
+        """
+        counts = [0] * (len(edges) - 1)
+        for key, count in [(None, self.zero_count)] + list(self.buckets.iteritems()):
+            value = 0 if key is None else self.value(key)
+            i = int(np.searchsorted(edges, value, side='right')) - 1
+            if 0 <= i < len(counts):
+                counts[i] += count
+
+        return counts
+
+
+class StreamingStats(object):
+
+    """在线计算个数、均值、标准差（Welford算法）、最小最大值及分位数估计"""
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        """构造函数
+
+        :relative_accuracy: 分位数估计的相对误差
+        """
+        self.count = 0
+        self.mean = 0.0
+        #: 与均值之差的平方和
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    @classmethod
+    def from_values(cls, values, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        """由已有的值一次算出
+
+        :values: 值的序列
+        :relative_accuracy: 分位数估计的相对误差
+        :returns: StreamingStats
+        """
+        stats = cls(relative_accuracy)
+
+        values = np.asarray(values, dtype=np.float64)
+        if len(values):
+            stats.count = len(values)
+            stats.mean = values.mean()
+            stats.m2 = ((values - stats.mean) ** 2).sum()
+            stats.min = values.min()
+            stats.max = values.max()
+            stats.sketch.add_values(values)
+
+        return stats
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / float(self.count)
+        self.m2 += delta * (value - self.mean)
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        self.sketch.add(value)
+
+    def merge(self, other):
+        """合并另一组统计，结果和把那边的值都加进来一样
+
+        :other: StreamingStats
+        :returns: 无
+        """
+        if not other.count:
+            return
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / float(count)
+        self.m2 += other.m2 + delta * delta * self.count * other.count / float(count)
+        self.count = count
+
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+        self.sketch.merge(other.sketch)
+
+    @property
+    def std(self):
+        """样本标准差，和pandas一样以count - 1为分母"""
+        if self.count < 2:
+            return float('nan') if self.count else 0
+
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def percentiles(self, percentiles):
+        """估计多个百分位数
+
+        :percentiles: 0~100之间的百分位数序列
+        :returns: 估计值的list，限制在最小、最大值之间
+        """
+        return [
+            min(max(value, self.min), self.max) if self.count else 0
+            for value in self.sketch.quantiles([p / 100.0 for p in percentiles])
+        ]
+
+    def summary(self, percentiles=SUMMARY_PERCENTILES):
+        """和tgw_log_analyzer.summary()格式相同的统计信息
+
+        :percentiles: 要给出的百分位数，名称见 percentile_name()
+        :returns: dict
+        """
+        result = {
+            'count' : self.count,
+            'std'   : self.std,
+            'max'   : self.max if self.count else 0,
+            'min'   : self.min if self.count else 0,
+            'mean'  : self.mean,
+        }
+        result.update(zip(map(percentile_name, percentiles), self.percentiles(percentiles)))
+
+        return result
+
+
+class TopN(object):
+
+    """只保留最大的n项"""
+
+    def __init__(self, n):
+        self.n = n
+        #: (键, 项)的小顶堆
+        self.heap = list()
+
+    def add(self, key, item):
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, (key, item))
+        elif (key, item) > self.heap[0]:
+            heapq.heapreplace(self.heap, (key, item))
+
+    def merge(self, other):
+        for key, item in other.heap:
+            self.add(key, item)
+
+    def items(self):
+        """按键从大到小排列的各项"""
+        return [item for _, item in sorted(self.heap, reverse=True)]
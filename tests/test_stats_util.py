@@ -0,0 +1,77 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4:
+"""stats_util 中分位数估计的测试"""
+import unittest
+
+import numpy as np
+
+from stats_util import QuantileSketch
+
+QUANTILES = (0, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 0.999, 1)
+
+
+class QuantileSketchTest(unittest.TestCase):
+
+    """估计值和同一排名的实际值的相对误差不超过relative_accuracy，分块合并的结果和一起统计一样"""
+
+    def setUp(self):
+        # 耗时的分布大致是对数正态的，数量级范围很大
+        self.values = np.random.RandomState(12345).lognormal(mean=5, sigma=2, size=20000)
+
+    def assertWithinAccuracy(self, sketch, values):
+        exact = np.sort(values)
+        for q, estimate in zip(QUANTILES, sketch.quantiles(QUANTILES)):
+            expected = exact[int(q * (len(exact) - 1))]
+            self.assertLessEqual(
+                abs(estimate - expected), sketch.relative_accuracy * expected * (1 + 1e-9),
+                u'q={0}: {1} vs {2}'.format(q, estimate, expected))
+
+    def test_error_bounds(self):
+        for relative_accuracy in (0.01, 0.05):
+            sketch = QuantileSketch(relative_accuracy)
+            sketch.add_values(self.values)
+            self.assertEqual(sketch.count, len(self.values))
+            self.assertWithinAccuracy(sketch, self.values)
+
+    def test_add_same_as_add_values(self):
+        one_by_one = QuantileSketch()
+        for value in self.values[:1000]:
+            one_by_one.add(value)
+        batch = QuantileSketch()
+        batch.add_values(self.values[:1000])
+
+        self.assertEqual(dict(one_by_one.buckets), dict(batch.buckets))
+        self.assertEqual(one_by_one.quantiles(QUANTILES), batch.quantiles(QUANTILES))
+
+    def test_merge(self):
+        whole = QuantileSketch()
+        whole.add_values(self.values)
+
+        merged = QuantileSketch()
+        for chunk in np.array_split(self.values, 7):
+            sketch = QuantileSketch()
+            sketch.add_values(chunk)
+            merged.merge(sketch)
+
+        self.assertEqual(merged.count, whole.count)
+        self.assertEqual(merged.quantiles(QUANTILES), whole.quantiles(QUANTILES))
+        self.assertWithinAccuracy(merged, self.values)
+
+    def test_zeros(self):
+        values = np.concatenate((np.zeros(100), self.values[:100]))
+        sketch = QuantileSketch()
+        sketch.add_values(values)
+
+        self.assertEqual(sketch.zero_count, 100)
+        self.assertEqual(sketch.quantile(0.25), 0)
+        self.assertWithinAccuracy(sketch, values)
+
+    def test_merge_different_accuracy(self):
+        with self.assertRaises(ValueError):
+            QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+    def test_empty(self):
+        self.assertEqual(QuantileSketch().quantiles([0.5, 0.99]), [0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
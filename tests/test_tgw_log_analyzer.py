@@ -0,0 +1,366 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4:
+"""tgw_log_analyzer 中日志分块并行处理、按时间定位、解析缓存、跟踪模式的测试"""
+import cPickle as pickle
+import datetime
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import tgw_log_analyzer
+from tgw_log_analyzer import DateTime, HtmlReport, TextReport, TgwLogFollower, TgwLogParser, parse_chunk
+
+LOG_ENCODINGS = ['utf-8', 'gbk']
+
+# 两次启动之间有连接成功、失败、断开、登出，第二次启动时GW02的连接102还没有断开，
+# 日志结束时GW02又有一个活动连接105
+CONNECTION_LOG = [
+    u'08:00:00.000000@2@cppf::common::SzseApp::InitLog@app.cpp@10@Log init@',
+    u'08:00:00.000000@2@cppf::common::SzseApp::Run@app.cpp@11@app started, Version Info: TGW RELEASE version:1.2.3 revision:4567 build x@cmd line: tgw.exe -c conf.xml',
+    u'08:00:01.000000@2@sscc::gateway::CsComm::Connect@cs.cpp@5@Begin to create server connection of tag \'GW01\' to 10.0.0.1:9000',
+    u'08:00:01.100000@2@sscc::gateway::CsComm::OnConnectOK@cs.cpp@6@Success: CsConnection 101(CS_Connected) - 10.1.1.1:5000 to 10.0.0.1:9000 of tag GW01 to TCS@',
+    u'08:00:02.000000@2@sscc::gateway::CsComm::Connect@cs.cpp@5@Begin to create server connection of tag \'GW02\' to 10.0.0.2:9000',
+    u'08:00:02.200000@2@sscc::gateway::CsComm::OnConnectOK@cs.cpp@6@Success: CsConnection 102(CS_Connected) - 10.1.1.1:5001 to 10.0.0.2:9000 of tag GW02 to TCS@',
+    u'08:00:03.000000@2@sscc::gateway::CsComm::Connect@cs.cpp@5@Begin to create server connection of tag \'GW03\' to 10.0.0.3:9000',
+    u'08:00:03.300000@2@sscc::gateway::CsComm@OnWanM@cs.cpp@7@WanM ERROR@Connection<103(x) - unknown to 10.0.0.3:9000> - 连接超时 timeout',
+    u'08:00:03.400000@2@sscc::gateway::CsComm::OnConnectFail@cs.cpp@6@Failed to create CsConnection of tag GW03. WanM error code: 10061:拒绝连接 refused. Reconnecting after 5 seconds...@CsConnection 103(CS_DisConnected) - unknown:0 to 10.0.0.3:9000 to TCS',
+    u'08:00:04.000000@2@sscc::gateway::CsComm::OnConnectionClose@cs.cpp@8@CsConnection 101(CS_Closed) - 10.1.1.1:5000 to 10.0.0.1:9000 of tag GW01 to TCS is closed. WanM error code: 10054:对端关闭. Reconnecting after 5 seconds',
+    u'08:00:05.000000@2@cppf::common::SzseApp::InitLog@app.cpp@10@Log init@',
+    u'08:00:05.000000@2@cppf::common::SzseApp::Run@app.cpp@11@app started, Version Info: TGW RELEASE version:1.2.3 revision:4567 build x@cmd line: tgw.exe -c conf.xml',
+    u'08:00:06.000000@2@sscc::gateway::CsComm::Connect@cs.cpp@5@Begin to create server connection of tag \'GW01\' to 10.0.0.1:9000',
+    u'08:00:06.100000@2@sscc::gateway::CsComm::OnConnectOK@cs.cpp@6@Success: CsConnection 104(CS_Connected) - 10.1.1.1:5002 to 10.0.0.1:9000 of tag GW01 to TCS@',
+    u'08:00:07.000000@2@sscc::gateway::CsConnection::HandleLogout@cs.cpp@9@Received logout message, code: 5, 密码错误 bad pwd@Connection 104(CS_Connected) - 10.1.1.1:5002 to 10.0.0.1:9000 of tag GW01',
+    u'08:00:08.000000@2@sscc::gateway::CsComm::Connect@cs.cpp@5@Begin to create server connection of tag \'GW02\' to 10.0.0.2:9000',
+    u'08:00:08.200000@2@sscc::gateway::CsComm::OnConnectOK@cs.cpp@6@Success: CsConnection 105(CS_Connected) - 10.1.1.1:5003 to 10.0.0.2:9000 of tag GW02 to TCS@',
+]
+
+
+def write_log(filename, lines, date='2016-12-12', append=False):
+    """把各行（时间之后的部分）写成日志文件
+
+    :append: 为True时追加到文件末尾
+    :returns: 各行的开始位置
+    """
+    offsets = list()
+    with open(filename, 'ab' if append else 'wb') as f:
+        f.seek(0, os.SEEK_END)
+        for line in lines:
+            offsets.append(f.tell())
+            f.write(u']{0} {1}\n'.format(date, line).encode('utf-8'))
+
+    return offsets
+
+
+def status_log(blocks, pbus=3):
+    """blocks个状态块，每秒一个，耗时不等，之间夹着连接的行"""
+    lines = list()
+    for second in xrange(blocks):
+        lines.append(u'08:00:{0:02}.000000@2@sscc::gateway::Gateway@LogCurrentStatus@gw.cpp@1@Current Statuses:@'.format(second))
+        for pbu in xrange(pbus):
+            lines.append(
+                u'08:00:{0:02}.{3:06}@2@sscc::gateway::Gateway@LogCurrentStatus@gw.cpp@1@  PBU {1}: {2} orders pending@'.format(
+                    second, pbu + 1, second * 10 + pbu, (pbu + 1) * (second % 7 + 1) * 1000))
+        lines.append(
+            u'08:00:{0:02}.500000@2@sscc::gateway::CsComm::OnConnectOK@cs.cpp@6@Success: CsConnection {1}(CS_Connected) - 10.1.1.1:5000 to 10.0.0.1:9000 of tag GW01 to TCS@'.format(
+                second, 100 + second))
+
+    return lines
+
+
+def create_parser(filename, **kwargs):
+    return TgwLogParser(filename, LOG_ENCODINGS, datetime.time(0), datetime.time(23, 59, 59, 999999), **kwargs)
+
+
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.temp_dir, 'tgw.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+class ChunkMergeTest(TempDirTestCase):
+
+    """分块处理后合并的结果和顺序处理一样"""
+
+    def parse_chunks(self, boundaries):
+        """按boundaries把日志分块，逐块处理后合并
+
+        :boundaries: 各块的开始位置，第一个为0
+        """
+        parser = create_parser(self.filename)
+        state = pickle.dumps(parser, pickle.HIGHEST_PROTOCOL)
+        ends = list(boundaries[1:]) + [os.path.getsize(self.filename)]
+        for i, (begin, end) in enumerate(zip(boundaries, ends)):
+            parser.merge(parse_chunk((state, begin, end, i == 0)))
+
+        return parser.get_result()
+
+    def assertSameConnections(self, result, expected):
+        self.assertEqual(result['connections'].rows(), expected['connections'].rows())
+        self.assertEqual(result['connections'].summary, expected['connections'].summary)
+        self.assertEqual(result['startups'], expected['startups'])
+
+    def test_split_at_every_line(self):
+        offsets = write_log(self.filename, CONNECTION_LOG)
+        expected = create_parser(self.filename).parse()
+        self.assertEqual(len(expected['connections'].rows()), 5)
+
+        for i, offset in enumerate(offsets[1:], 1):
+            self.assertSameConnections(self.parse_chunks([0, offset]), expected)
+
+    def test_restart_and_close_in_later_chunks(self):
+        # 连接101、102在第一块中建立，101在第二块中断开，102因第三块中的重启而中止
+        offsets = write_log(self.filename, CONNECTION_LOG)
+        expected = create_parser(self.filename).parse()
+
+        result = self.parse_chunks([0, offsets[6], offsets[10]])
+        self.assertSameConnections(result, expected)
+
+        rows = {row['conn_id']: row for row in result['connections'].rows()}
+        self.assertEqual(rows[101]['status'], 'closed')
+        self.assertEqual(rows[101]['begin_time'], datetime.datetime(2016, 12, 12, 8, 0, 1))
+        self.assertEqual(rows[102]['status'], 'connected')
+        self.assertIsNone(rows[102]['close_time'])
+        # 连接失败前的WanM出错信息是真正的原因
+        self.assertEqual(rows[103]['code'], 'WanM')
+        self.assertEqual(rows[103]['reason'], u'连接超时 timeout')
+        self.assertEqual(rows[104]['status'], 'logout')
+        self.assertEqual(rows[105]['status'], 'connected')
+
+
+class SeekTimeTest(TempDirTestCase):
+
+    """按时间二分查找行的开始位置"""
+
+    SECONDS = 6
+    LINES_PER_SECOND = 200
+
+    def setUp(self):
+        super(SeekTimeTest, self).setUp()
+        lines = [
+            u'08:00:{0:02}.{1:06}@2@sscc::gateway::Other@Foo@x.cpp@3@some other message'.format(second, i * 1000)
+            for second in xrange(self.SECONDS) for i in xrange(self.LINES_PER_SECOND)
+        ]
+        self.offsets = write_log(self.filename, lines)
+        self.file_size = os.path.getsize(self.filename)
+
+        # 文件不大，缩小顺序查找的范围，使二分查找也起作用
+        self.seek_block_size = tgw_log_analyzer.SEEK_BLOCK_SIZE
+        tgw_log_analyzer.SEEK_BLOCK_SIZE = 256
+
+    def tearDown(self):
+        tgw_log_analyzer.SEEK_BLOCK_SIZE = self.seek_block_size
+        super(SeekTimeTest, self).tearDown()
+
+    def seek(self, t, use_index=False):
+        parser = create_parser(self.filename, use_index=use_index)
+        with open(self.filename, 'rb') as f:
+            return parser.seek_time(f, DateTime.time_of_day(t))
+
+    def check(self, use_index):
+        last_second = self.SECONDS - 1
+        self.assertEqual(self.seek(datetime.time(0), use_index), 0)
+        self.assertEqual(self.seek(datetime.time(8, 0, 0), use_index), 0)
+        self.assertEqual(self.seek(datetime.time(8, 0, 0, 1), use_index), self.offsets[1])
+        self.assertEqual(
+            self.seek(datetime.time(8, 0, last_second), use_index),
+            self.offsets[last_second * self.LINES_PER_SECOND])
+        self.assertEqual(
+            self.seek(datetime.time(8, 0, last_second, (self.LINES_PER_SECOND - 1) * 1000), use_index),
+            self.offsets[-1])
+        self.assertEqual(self.seek(datetime.time(8, 0, self.SECONDS), use_index), self.file_size)
+
+    def test_first_and_last_second(self):
+        self.check(use_index=False)
+
+    def test_first_and_last_second_with_index(self):
+        self.check(use_index=True)
+
+
+class RuleDispatchTest(TempDirTestCase):
+
+    """规则的关键字和内置分析器的关键字重叠时，各分析器都能收到相应的行"""
+
+    RULES = [
+        # 由pattern得出的关键字为@LogCurrentStatus@gw，包含状态日志的关键字LogCurrentStatus
+        {'name': 'pending', 'pattern': u'.*@LogCurrentStatus@gw.cpp@1@  PBU (?P<pbu>\\d+): (?P<pending>\\d+) orders pending@',
+         'types': {'pbu': 'int', 'pending': 'int'}, 'aggregate': ['pending'], 'group_by': 'pbu'},
+        # 关键字Connect是OnConnectOK的一部分
+        {'name': 'connects', 'pattern': u'.*@sscc::gateway::CsComm::(?P<event>OnConnect\\w*)@', 'keys': [u'Connect']},
+    ]
+
+    BLOCKS = 5
+
+    def test_overlapping_keys(self):
+        write_log(self.filename, status_log(self.BLOCKS))
+        expected = create_parser(self.filename).parse()
+        parser = create_parser(self.filename, rules=self.RULES)
+        self.assertIn('@LogCurrentStatus@gw', parser.dispatch_keys)
+        result = parser.parse()
+
+        # 内置分析器的结果不变
+        self.assertEqual(result['status'].rows(), expected['status'].rows())
+        self.assertEqual(len(result['status'].rows()), self.BLOCKS)
+        self.assertEqual(result['connections'].rows(), expected['connections'].rows())
+
+        self.assertEqual(len(result['pending'].rows()), self.BLOCKS * 3)
+        self.assertEqual(len(result['connects'].rows()), self.BLOCKS)
+        self.assertEqual(set(row['event'] for row in result['connects'].rows()), {'OnConnectOK'})
+
+    def test_text_report_with_int_group_by(self):
+        write_log(self.filename, status_log(self.BLOCKS))
+        report = TextReport().generate(create_parser(self.filename, rules=self.RULES).parse())
+
+        self.assertIn(u'Rule pending: {0} lines'.format(self.BLOCKS * 3), report)
+        for pbu in xrange(1, 4):
+            self.assertRegexpMatches(report, u'\\n{0} +pending +{1} '.format(pbu, self.BLOCKS))
+
+    def test_html_report_without_status(self):
+        write_log(self.filename, [line for line in status_log(self.BLOCKS) if 'LogCurrentStatus' not in line])
+        result = create_parser(self.filename, rules=self.RULES).parse()
+        self.assertEqual(HtmlReport.time_series(result), dict())
+
+        output_dir = os.path.join(self.temp_dir, 'result')
+        HtmlReport(output_dir).generate(result)
+        self.assertTrue(os.path.exists(os.path.join(output_dir, tgw_log_analyzer.HTML_REPORT_FILENAME)))
+
+
+class AggregateResultsTest(TempDirTestCase):
+
+    """多个日志文件的汇总"""
+
+    def test_single_log_status_same_as_log(self):
+        write_log(self.filename, status_log(20))
+        for streaming in (False, True):
+            result = create_parser(self.filename, streaming=streaming).parse()
+            status = tgw_log_analyzer.aggregate_results([result])['status']
+            for name in ('count', 'mean', 'std', 'min', 'max'):
+                self.assertAlmostEqual(status[name], result['status'].summary[name], msg=name)
+
+
+class FollowTest(TempDirTestCase):
+
+    """跟踪模式：日志追加、截断、轮转时的连接事件和滚动统计"""
+
+    def setUp(self):
+        super(FollowTest, self).setUp()
+        self.follower = TgwLogFollower(self.filename, LOG_ENCODINGS, window=60)
+        self.f = None
+
+    def tearDown(self):
+        if self.f:
+            self.f.close()
+        super(FollowTest, self).tearDown()
+
+    def poll(self):
+        """和 TgwLogFollower.follow() 一样处理新增的行，文件被轮转或截断后从新文件的开头处理
+
+        :returns: (连接事件的时间、事件的list, 滚动统计)
+        """
+        if self.f is None:
+            self.f = self.follower.open_log(True)
+
+        data = self.f.read()
+        if not data and self.follower.rotated(self.f):
+            self.f.close()
+            self.follower.reset_status()
+            self.f = self.follower.open_log(True)
+            data = self.f.read()
+
+        self.follower.parse_lines(io.BytesIO(data))
+        events = [(DateTime.to_datetime(t), event) for t, event, _ in self.follower.connection_parser.pop_events()]
+        return events, self.follower.rolling_stats()
+
+    def test_append_truncate_rename(self):
+        lines = status_log(5)
+        # 每个状态块和其后的连接共5行，状态块在下一个状态块开始时才结束
+        write_log(self.filename, lines[:15])
+        events, stats = self.poll()
+        self.assertEqual(events, [(datetime.datetime(2016, 12, 12, 8, 0, i, 500000), 'connected') for i in xrange(3)])
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['time'], DateTime.to_epoch('2016-12-12 08:00:02.500000'))
+
+        # 没有新的行时不再给出同样的统计
+        self.assertEqual(self.poll(), ([], None))
+
+        write_log(self.filename, lines[15:], append=True)
+        events, stats = self.poll()
+        self.assertEqual([t.second for t, _ in events], [3, 4])
+        self.assertEqual(stats['count'], 4)
+        self.assertEqual(stats['max'], 12000)
+
+        # 截断后重写，时间比原来的早，原来的状态块不在新的统计中
+        write_log(self.filename, lines[:10])
+        events, stats = self.poll()
+        self.assertEqual(len(events), 2)
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['max'], 3000)
+
+        # 改名后，新文件建立之前没有新的行
+        os.rename(self.filename, self.filename + '.1')
+        self.assertEqual(self.poll(), ([], None))
+        write_log(self.filename, lines[:20], date='2016-12-13')
+        events, stats = self.poll()
+        self.assertEqual([t for t, _ in events], [datetime.datetime(2016, 12, 13, 8, 0, i, 500000) for i in xrange(4)])
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['time'], DateTime.to_epoch('2016-12-13 08:00:03.500000'))
+
+
+class ParseCacheTest(TempDirTestCase):
+
+    """解析缓存：日志增长时从上次的位置继续，日志被改写时重新解析"""
+
+    def connections(self, use_cache):
+        return create_parser(self.filename, use_cache=use_cache).parse()['connections'].rows()
+
+    def rewrite(self, lines, replace=False):
+        """改写日志，长度不变
+
+        :replace: 为True时写到新文件再改名（inode不同），否则原地改写
+        """
+        size = os.path.getsize(self.filename)
+        temp_filename = self.filename + '.new'
+        write_log(temp_filename, lines)
+        self.assertEqual(os.path.getsize(temp_filename), size)
+
+        if replace:
+            os.rename(temp_filename, self.filename)
+        else:
+            with open(temp_filename, 'rb') as src, open(self.filename, 'r+b') as dst:
+                dst.write(src.read())
+            os.remove(temp_filename)
+
+    def test_resume_growing_log(self):
+        write_log(self.filename, CONNECTION_LOG[:8])
+        self.connections(use_cache=True)
+        self.assertTrue(os.path.exists(self.filename + tgw_log_analyzer.CACHE_SUFFIX))
+
+        write_log(self.filename, CONNECTION_LOG)
+        self.assertEqual(self.connections(use_cache=True), self.connections(use_cache=False))
+
+    def check_rewritten(self, replace):
+        write_log(self.filename, CONNECTION_LOG)
+        self.connections(use_cache=True)
+
+        # 网关ID换成等长的另一个，文件长度不变
+        self.rewrite([line.replace('GW01', 'GW09') for line in CONNECTION_LOG], replace)
+        connections = self.connections(use_cache=True)
+        self.assertEqual(connections, self.connections(use_cache=False))
+
+        gw_ids = set(row['gw_id'] for row in connections)
+        self.assertIn('GW09', gw_ids)
+        self.assertNotIn('GW01', gw_ids)
+
+    def test_rewritten_in_place_with_same_size(self):
+        self.check_rewritten(replace=False)
+
+    def test_replaced_with_same_size(self):
+        self.check_rewritten(replace=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,35 +2,56 @@
 # vim: set fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4:
 
 # Imports
+# 较慢的pandas、matplotlib、pyarrow只在用到的函数中导入，只生成文本报告时不导入
+from timeit import default_timer as timer
+#: 开始导入模块的时间， --timings 据此统计启动耗时
+IMPORT_BEGIN = timer()
+
 import argparse
 import bisect
 import codecs
-from collections import defaultdict
+import cProfile
+from collections import defaultdict, deque, OrderedDict
+import datetime
+from distutils.spawn import find_executable
 import exceptions
+import glob
+import gzip
+import hashlib
 import locale
 import logging
+import mmap
+import multiprocessing
+import cPickle as pickle
 
 import numpy as np
-import pandas as pd
 import re
+import sre_constants
+import sre_parse
 import os
+import subprocess
 import sys
 import inspect
+import io
+import itertools
+import json
+import time
 import jinja2
 from distutils.dir_util import mkpath
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-
+import anomaly
 import filters
 import chart_util
+from column_store import ColumnStore, FLOAT, INT, STR
+import profile_util
+from profile_util import Profiler, TimedParser
+from stats_util import percentile_name, StreamingStats, SUMMARY_PERCENTILES, TopN
+import timeline
 
-VERSION=u"20161212"
+#: 导入完成的时间
+IMPORT_END = timer()
 
-matplotlib.style.use('ggplot')
+VERSION=u"20161212"
 
 # 存放结果的目录
 DEFAULT_OUTPUT_DIR = 'result'
@@ -45,27 +66,187 @@ HTML_REPORT_FILENAME = 'index.html'
 TEXT_TEMPLATE_DIR = '.'
 TEXT_TEMPLATE_FILENAME = 'text_template.html'
 
-def summary(array):
+# 多个日志文件的汇总报告模板
+HTML_FLEET_TEMPLATE_FILENAME = 'html_fleet_template.html'
+TEXT_FLEET_TEMPLATE_FILENAME = 'text_fleet_template.html'
+# 生成报告时，模板输出的片段积累到这么多个再写入文件
+RENDER_BUFFER_SIZE = 64
+
+# --timings 的启动耗时预算（秒），即从开始导入到开始分析日志
+STARTUP_BUDGET = 0.5
+# --timings 时显示是否已导入的较慢的模块
+HEAVY_MODULES = ('pandas', 'matplotlib', 'matplotlib.pyplot', 'pyarrow')
+
+# 处理时间图中点数超过此数时，按像素列画最小值、最大值、90%分位数的包络，不再画每个点
+CHART_MAX_POINTS = 20000
+# 图形缓存的目录，在结果存放目录下
+CHART_CACHE_DIRNAME = '.chart_cache'
+# 模板编译结果的缓存目录，在用户的缓存目录（$XDG_CACHE_HOME，缺省为~/.cache）下
+TEMPLATE_CACHE_DIRNAME = os.path.join('tgw_log_analyzer', 'templates')
+# 交互式图形点数超过 CHART_MAX_POINTS 时，包络的段数
+INTERACTIVE_CHART_COLUMNS = 1000
+
+# 汇总报告中状态日志耗时分布的区间上限（微秒），最后一个区间没有上限
+LATENCY_BUCKETS = (1000, 10000, 100000, 500000)
+
+# 流式统计时保留的最慢状态块个数，即报告中“处理最慢的5笔”
+STATUS_TOP_N = 5
+# 最多记录WanM出错信息的未结束连接数，超过时丢弃连接ID较小的一半
+CONNECTION_MAX_ERRORS = 10000
+
+# 规则文件中的分析器不能用的名称，即分析结果中已有的键
+RESERVED_RESULT_NAMES = ('summary', 'profile', 'timeline', 'anomalies', 'status', 'connections', 'version', 'os', 'startups')
+# 由正则表达式得出的关键字的最短长度，太短的关键字使太多行交给分析器
+RULE_MIN_KEY_LENGTH = 4
+
+# 分时统计缺省的时间段长度，格式见 timeline.parse_interval()
+DEFAULT_BUCKET = '1m'
+# 报告中列出的最慢、连接失败最多的时间段个数
+TIMELINE_TOP_N = 10
+
+# 汇总报告中，同一TCS地址的连接断开、失败相隔不超过此时长的归为一次事件，格式见 timeline.parse_interval()
+DEFAULT_INCIDENT_WINDOW = '5s'
+# 涉及至少这么多网关（日志文件）的才列为事件
+INCIDENT_MIN_GATEWAYS = 2
+# 汇总报告中列出的事件个数，按涉及的网关数选取
+INCIDENT_TOP_N = 50
+# 每个事件最多列出的网关编号个数
+INCIDENT_MAX_GATEWAYS = 20
+
+# 异常检测的滚动窗口（状态块个数）
+ANOMALY_WINDOW = 20
+# 滚动窗口平均耗时相对基线的z值达到此值时为异常
+ANOMALY_Z_LIMIT = 4.0
+# 滚动窗口中超过基线分位数的状态块的比例达到此值时为异常
+ANOMALY_EXCEEDANCE_LIMIT = 0.25
+# 基线中作为超出阈值的分位数
+ANOMALY_QUANTILE = 'p99'
+# 异常时段中至少要有的超过基线分位数的状态块数，单个慢的状态块不算异常时段（见“处理最慢的5笔”）
+ANOMALY_MIN_STATUSES = 3
+# 保存的基线中状态块少于此数时不用，以本日志自身为基线
+BASELINE_MIN_COUNT = 1000
+# 没有保存的基线时，报告中状态日志耗时的警告阈值（微秒）
+STATUS_WARNING_LIMITS = {'mean': 100000, 'p90': 500000, 'max': 500000}
+
+# 时间索引文件名为日志文件名加此后缀
+INDEX_SUFFIX = '.tgwidx'
+# 时间索引每隔多少字节记录一项
+INDEX_INTERVAL = 16 * 1024 * 1024
+# 按时间二分查找到范围小于此字节数后改为顺序处理
+SEEK_BLOCK_SIZE = 64 * 1024
+# 逐块读取日志，每块检测一次编码。每块的字节数
+PARSE_BLOCK_SIZE = 1024 * 1024
+# 估计块中要分派的行的比例时，取样的字节数
+PREFILTER_SAMPLE_SIZE = 64 * 1024
+# 块中要分派的行（按关键字出现次数估计）超过此比例时，逐行处理比整块预筛选快
+PREFILTER_MAX_RATIO = 0.5
+
+# 解析缓存文件名为日志文件名加此后缀
+CACHE_SUFFIX = '.tgwcache'
+# 解析缓存的格式版本，分析器的状态有变化时要改
+CACHE_VERSION = 5
+# 判断日志文件是否被替换时，比较文件开头和缓存位置之前的字节数
+CACHE_CHECK_SIZE = 4096
+
+# 跟踪模式下滚动统计的时间窗口（分钟）
+DEFAULT_FOLLOW_WINDOW = 5
+# 跟踪模式下输出滚动统计的间隔（秒）
+DEFAULT_FOLLOW_INTERVAL = 10
+# 压缩的日志文件：(格式, 文件头, 扩展名, 解压到标准输出的命令，依次找可用的)
+COMPRESSIONS = (
+    ('gzip', '\x1f\x8b', '.gz', (('pigz', '-dc'), ('gzip', '-dc'))),
+    ('xz', '\xfd7zXZ\x00', '.xz', (('xz', '-dc', '-T0'),)),
+    ('zstd', '\x28\xb5\x2f\xfd', '.zst', (('zstd', '-dc'),)),
+)
+
+# 跟踪模式下检查文件增长的间隔（秒）
+FOLLOW_POLL_INTERVAL = 0.5
+# 跟踪模式下每次最多读取的字节数
+FOLLOW_READ_SIZE = 1024 * 1024
+# 跟踪模式下最多保留的未输出连接事件数，超过时丢弃最早的
+FOLLOW_MAX_EVENTS = 10000
+# 导出分析结果时，记录各表的文件名的文件
+EXPORT_MANIFEST_FILENAME = 'manifest.json'
+# 导出格式的版本，变化时不能读取以前导出的结果
+EXPORT_VERSION = 1
+
+def summary(array, ddof=0):
     """返回array的基本统计信息.
 
     :array: 输入的numpy.array
+    :ddof: 计算标准差的自由度修正，同 numpy.std()
     :returns: dict
 
     """
+    count = len(array)
+    if not count:
+        return {'count': 0, 'std': 0, 'max': 0, 'min': 0, 'mean': 0, 'p90': 0}
+
+    # 一次部分排序得到最小值、最大值和90%分位数两侧的值，插值方法同 numpy.percentile()
+    position = (count - 1) * 0.9
+    below = int(position)
+    above = min(below + 1, count - 1)
+    weight = position - below
+    ordered = np.partition(array, sorted({0, below, above, count - 1}))
+
+    # 只转换一次浮点数，离差的平方就地计算
+    values = array.astype(np.float64)
+    mean = values.mean()
+    if count > ddof:
+        deviations = np.subtract(values, mean, out=values)
+        std = np.sqrt(np.multiply(deviations, deviations, out=deviations).sum() / (count - ddof))
+    else:
+        std = np.nan
+
     return {
-        'count' : len(array),
-        'std'   : array.std(),
-        'max'   : array.max(),
-        'min'   : array.min(),
-        'mean'  : array.mean(),
-        'p90'   : np.percentile(array, 90),
+        'count' : count,
+        'std'   : std,
+        'max'   : ordered[count - 1],
+        'min'   : ordered[0],
+        'mean'  : mean,
+        'p90'   : ordered[below] * (1 - weight) + ordered[above] * weight,
     }
 
 
+def top_n(values, n):
+    """values中最大的n个的序号
+
+    用numpy.argpartition()选出候选，只对候选排序，不对整个数组排序。
+
+    :values: 数值数组
+    :n: 个数
+    :returns: 序号数组，按值从大到小，值相同时序号小的在前
+    """
+    values = np.asarray(values)
+    n = min(n, len(values))
+    if not n:
+        return np.array([], dtype=np.intp)
+
+    threshold = values[np.argpartition(values, len(values) - n)[len(values) - n]]
+    # 和第n大的值相同的可能不止一个，都作为候选，按序号取舍
+    candidates = np.flatnonzero(values >= threshold)
+    return candidates[np.lexsort((candidates, -values[candidates]))][:n]
+
+
 class DateTime(object):
 
     """日期、时间解释器"""
-    re_datetime = re.compile(r'(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2}) (?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d).(?P<microsecond>\d{6})')
+    re_datetime = re.compile(r'(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2}) (?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d)\.(?P<microsecond>\d{6})')
+
+    #: 一天的微秒数
+    US_PER_DAY = 86400 * 1000000
+
+    #: 1970-01-01的序数，用于计算天数
+    EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+    #: to_epoch()的0点
+    EPOCH = datetime.datetime(1970, 1, 1)
+
+    #: "YYYY-MM-DD HH:MM:SS" -> 该秒的微秒数。日志基本按时间顺序，命中率很高
+    second_cache = dict()
+
+    #: second_cache的最大条目数，超过后清空
+    SECOND_CACHE_SIZE = 100000
 
     @classmethod
     def from_string(cls, s):
@@ -86,23 +267,264 @@ class DateTime(object):
         return '{0:02}:{1:02}:{2:02}.{3:03}'.format(
             t / 10000000, t / 100000 % 100, t / 100 % 100, t % 1000)
 
+    @classmethod
+    def to_epoch(cls, s):
+        """解释YYYY-MM-DD HH:MM:SS.dddddd的字符串为1970-01-01以来的微秒数（不考虑时区）
+
+        日志时间的格式是固定的，前19个字符（到秒）相同的行共用缓存，
+        每行只需检查、解释最后的微秒部分。不符合固定格式的交给pandas解释。
+
+        :s: 日期、时间字符串
+        :returns: 以微秒为单位的整数。0保留用于表示“无时间”
+
+        """
+        if len(s) != 26 or s[19] != '.' or not s[20:26].isdigit():
+            return cls.from_string_slow(s)
+
+        base = cls.second_cache.get(s[:19])
+        if base is None:
+            m = cls.re_datetime.match(s)
+            if not m:
+                return cls.from_string_slow(s)
+
+            days = datetime.date(int(m.group('year')), int(m.group('month')), int(m.group('day'))).toordinal() - cls.EPOCH_ORDINAL
+            base = (((days * 24 + int(m.group('hour'))) * 60 + int(m.group('minute'))) * 60 + int(m.group('second'))) * 1000000
+
+            if len(cls.second_cache) >= cls.SECOND_CACHE_SIZE:
+                cls.second_cache.clear()
+            cls.second_cache[s[:19]] = base
+
+        return base + int(s[20:26])
+
+    @classmethod
+    def from_string_slow(cls, s):
+        """to_epoch()处理不了的格式，交给pandas解释"""
+        import pandas as pd
+        return cls.from_timestamp(pd.to_datetime(s))
+
+    @classmethod
+    def from_timestamp(cls, ts):
+        """把pandas.Timestamp转为to_epoch()格式的整数"""
+        return ts.value // 1000
+
+    @classmethod
+    def time_of_day(cls, t):
+        """把datetime.time转为当天的微秒数，可与 to_epoch() % US_PER_DAY 比较"""
+        return ((t.hour * 60 + t.minute) * 60 + t.second) * 1000000 + t.microsecond
+
+    @classmethod
+    def to_datetime(cls, t):
+        """把to_epoch()格式的整数转为datetime.datetime，0转为''"""
+        return cls.EPOCH + datetime.timedelta(microseconds=t) if t else ''
+
+
+class LogDecoder(object):
+
+    """日志文本的解码器
+
+    日志的固定结构（时间、@分隔符、组件名、函数名等）都是ASCII，可以直接按字节匹配，
+    只有要保存的文本才需要解码。编码按块检测：块中没有非ASCII字节，或者整块都能用
+    第一个编码解码时，块中的文本都直接用它解码；否则（混有多种编码）逐个文本按顺序尝试。
+    只适用于兼容ASCII的编码。
+    """
+
+    # 非ASCII字节
+    re_non_ascii = re.compile(r'[\x80-\xff]')
+
+    def __init__(self, encodings):
+        """构造函数
+
+        :encodings: 编码的list，按顺序尝试
+        """
+        self.encodings = encodings
+        #: 当前块的编码。None表示块中混有多种编码，要逐个尝试
+        self.block_encoding = None
+
+    def detect(self, block):
+        """检测一块日志的编码，之后 decode() 的文本都应来自这块
+
+        :block: 日志块的字节串
+        :returns: 块的编码，混有多种编码时为None
+        """
+        if not self.re_non_ascii.search(block):
+            self.block_encoding = 'ascii'
+        else:
+            try:
+                block.decode(self.encodings[0])
+                self.block_encoding = self.encodings[0]
+            except UnicodeDecodeError:
+                self.block_encoding = None
+
+        return self.block_encoding
+
+    def decode(self, s):
+        """解码当前块中的一段文本
+
+        :s: 字节串
+        :returns: unicode。各编码都不能解码时，以第一个编码解码并替换出错的字节
+        """
+        if self.block_encoding:
+            try:
+                return s.decode(self.block_encoding)
+            except UnicodeDecodeError:
+                # 截取的文本把多字节字符从中切开了
+                pass
+
+        for encoding in self.encodings:
+            try:
+                return s.decode(encoding)
+            except UnicodeDecodeError:
+                pass
+
+        logging.warning(u'  Error decoding {0!r}'.format(s))
+        return s.decode(self.encodings[0], 'replace')
+
 
 class Result(object):
-    def __init__(self, summary, details):
+    def __init__(self, summary, details, time_columns=('datetime',), stats=None):
         """初始化.
 
         details['datetime']就是对应的时间。
 
         参数:
             summary: 汇总dict
-            details: DataFrame，详细数据
+            details: DataFrame，详细数据。也可以是 column_store.ColumnStore ，
+                此时第一次用到details时才转为DataFrame，
+                只用 rows() 、 groups() 、 column() 时不需要pandas
+            time_columns: 以 DateTime.to_epoch() 整数表示的时间列，
+                转为DataFrame时一次性转为pandas.Timestamp
+            stats: 流式统计时的 stats_util.StreamingStats ，可用于合并多个结果。
+                此时details只是部分数据
         """
 
         self.summary = summary
-        self.details = pd.DataFrame(details)
+        self.stats = stats
+        self.time_columns = time_columns
+        #: durations() 的结果
+        self._durations = dict()
+
+        if isinstance(details, ColumnStore):
+            self.store = details
+            self._details = None
+        else:
+            self.store = None
+            self._details = self.to_frame(details)
+
+    def __len__(self):
+        """行数"""
+        return len(self.store) if self.store is not None else len(self._details)
+
+    def __getstate__(self):
+        # 有ColumnStore时不保存转换出的DataFrame
+        state = self.__dict__.copy()
+        if self.store is not None:
+            state['_details'] = None
+        return state
+
+    @property
+    def details(self):
+        """详细数据的DataFrame"""
+        if self._details is None:
+            self._details = self.to_frame(self.store.to_frame())
+        return self._details
+
+    def to_frame(self, details):
+        import pandas as pd
+
+        details = pd.DataFrame(details)
+        for column in self.time_columns:
+            if column in details and details[column].dtype.kind in 'iu':
+                values = details[column]
+                # 0表示无时间，转为NaT
+                details[column] = pd.to_datetime(values, unit='us').where(values != 0)
 
         if 'datetime' in details:
-            self.details = self.details.sort_values('datetime')
+            details = details.sort_values('datetime')
+
+        return details
+
+    def order(self):
+        """ColumnStore中各行按details的顺序排列的序号"""
+        if 'datetime' in self.store.kinds:
+            return np.argsort(self.store.column('datetime'), kind='mergesort')
+        return np.arange(len(self.store))
+
+    def rows(self):
+        """各行的dict的list，按details的顺序
+
+        时间列为datetime.datetime，无时间为None，不需要pandas。
+        """
+        if self.store is None:
+            return self.details.to_dict('records')
+
+        return list(self.iter_rows())
+
+    def iter_rows(self, positions=None):
+        """逐行生成 rows() 的各行
+
+        :positions: 只生成这些行，为按details的顺序的序号。缺省为所有行
+        """
+        if self.store is None:
+            details = self.details if positions is None else self.details.iloc[positions]
+            for row in details.to_dict('records'):
+                yield row
+            return
+
+        time_columns = [column for column in self.time_columns if column in self.store.kinds]
+        order = self.order()
+        for i in (order if positions is None else order[positions]):
+            row = self.store.row(i)
+            for column in time_columns:
+                row[column] = DateTime.to_datetime(row[column]) or None
+            yield row
+
+    def first_row(self):
+        """第一行的dict，没有数据时为None"""
+        if self.store is None:
+            return self.details.iloc[0].to_dict() if len(self.details) else None
+
+        return next(self.iter_rows(), None)
+
+    def durations(self, begin='begin', end='end'):
+        """各行begin列到end列的微秒数，按details的顺序
+
+        第一次调用时计算，图形和报告共用。
+        """
+        key = (begin, end)
+        if key not in self._durations:
+            self._durations[key] = self.column(end) - self.column(begin)
+        return self._durations[key]
+
+    def largest(self, values, n, name):
+        """values最大的n行
+
+        :values: 和各行一一对应的数值数组，如 durations()
+        :n: 行数
+        :name: values在返回的各行中的键名
+        :returns: 各行的dict的list，按values从大到小，见 rows()
+        """
+        positions = top_n(values, n)
+        rows = list(self.iter_rows(positions))
+        for row, value in zip(rows, values[positions]):
+            row[name] = value
+        return rows
+
+    def column(self, name):
+        """一列的numpy数组，按details的顺序
+
+        时间列为 DateTime.to_epoch() 格式的整数，无时间为0。
+        """
+        if self.store is None:
+            values = self.details[name]
+            if values.dtype.kind == 'M':
+                return np.where(values.isnull(), 0, values.values.view(np.int64) // 1000)
+            return values.values
+
+        if self.store.kinds[name] == STR:
+            categories = np.array(self.store.categories[name] + [None], dtype=object)
+            return categories[self.store.column(name)][self.order()]
+
+        return self.store.column(name)[self.order()]
 
     def summary(self):
         return self.summary
@@ -127,9 +549,55 @@ class Result(object):
 
         raise exceptions.ValueError
 
+    def groups(self, column):
+        """按列值分组，供模板逐组、逐行使用
+
+        :column: 分组的列
+        :returns: (列值, 组内各行的dict的list)的list，按列值排序，组内保持原来的顺序
+        """
+        if self.store is not None:
+            values = self.column(column)
+            values = values[values != np.array(None)]
+            if (values[:-1] <= values[1:]).all():
+                # 已按列值排序（如按网关ID排序的连接），逐组生成，不必一次生成所有行
+                return (
+                    (key, rows)
+                    for key, rows in itertools.groupby(self.iter_rows(), lambda row: row[column])
+                    if key is not None)
+
+            groups = OrderedDict()
+            for row in self.iter_rows():
+                if row[column] is not None:
+                    groups.setdefault(row[column], list()).append(row)
+            return sorted(groups.items())
+
+        return sorted(
+            (key, df.to_dict('records'))
+            for key, df in self.details.groupby(column, sort=False, observed=True))
+
 
 class ParserBase(object):
     """分析器的基类，定义几个接口方法"""
+
+    #: 本分析器关心的关键字，即日志行中的组件、函数名等固定字符串。
+    #: TgwLogParser 只把含有其中某个关键字的行交给 parse() 。
+    #: None表示每一行都要交给 parse()
+    keys = None
+
+    #: 为True时 parse() 收到的line_content是未解码的字节串，要保存的文本用 decode() 解码。
+    #: 没有re.UNICODE标志的正则表达式对字节串和unicode的匹配结果一样，只是GBK双字节字符的
+    #: 第二个字节可能落在ASCII范围内（0x40~0x7E，如@），会把字符从中切开。
+    #: 所以只有截取的文本都由不会是第二个字节的分隔符（如空格、逗号、句点）结束的分析器才能为True，
+    #: 截取任意文本（如 [^@]+ ）的分析器要为False
+    raw = False
+
+    #: 为True时匹配了一行后，这行不再交给后面的分析器。
+    #: 规则文件中的分析器为False，内置分析器已处理的行也交给它们
+    exclusive = True
+
+    #: 日志文本的解码器，由 TgwLogParser 设置
+    decoder = LogDecoder(DEFAULT_LOG_ENCODING.split(','))
+
     def __init__(self, parser_name):
         """初始化
 
@@ -138,15 +606,24 @@ class ParserBase(object):
         #: 分析器的名称，用于按名称取分析结果
         self.parser_name = parser_name
 
-    def parse(self, line_time, line_content):
+    def parse(self, line_time, line_content, key=None):
         """处理一行
 
-        :line_time: 行的时间
+        :line_time: 行的时间， DateTime.to_epoch() 格式的整数
         :line_content: 时间之后的内容
+        :key: 行中找到的、属于 keys 的关键字。 keys 为None时为None
         :returns: 是否匹配了这行
         """
         raise exceptions.NotImplemented
 
+    def decode(self, s):
+        """解码日志中的文本，None及已解码的unicode（非 raw 的分析器）保持不变"""
+        return s if s is None or isinstance(s, unicode) else self.decoder.decode(s)
+
+    def decode_groups(self, m):
+        """正则表达式匹配结果的各命名分组，解码后的dict"""
+        return {name: self.decode(value) for name, value in m.groupdict().iteritems()}
+
     def finish(self):
         """结果对文件的处理。
 
@@ -161,11 +638,29 @@ class ParserBase(object):
 
         可用于清理上一次启动留下的未结束的状态。
 
-        :kwargs: 相关的属性。其中的datetime已经是pandas.TimeStamp
+        :kwargs: 相关的属性。其中的datetime是 DateTime.to_epoch() 格式的整数
+        :returns: 无
+        """
+        pass
+
+    def begin_chunk(self):
+        """分块并行处理时，在处理非首块之前被调用。
+
+        此时前面的日志还没有处理，依赖前面状态的信息应记为待定，
+        由 merge() 在合并时补上。
+
         :returns: 无
         """
         pass
 
+    def merge(self, other):
+        """合并紧接在后面的一块日志的分析状态，结果和连续处理两块一样。
+
+        :other: 处理后一块日志的同类分析器，处理前已调用过 begin_chunk()
+        :returns: 无
+        """
+        raise exceptions.NotImplementedError
+
 
 class StatusParser(ParserBase):
 
@@ -178,21 +673,44 @@ class StatusParser(ParserBase):
     # LogCurrentStatus首行
     re_line_log_status_begin = re.compile(r'Current Statuses:')
 
-    def __init__(self, parser_name):
-        """构造函数 """
+    keys = ('LogCurrentStatus',)
+
+    # 不保存文本，不需要解码
+    raw = True
+
+    def __init__(self, parser_name, streaming=False, top_n=STATUS_TOP_N):
+        """构造函数
+
+        :parser_name: 分析器的名称
+        :streaming: 是否流式统计：不保留每个状态块，只在线更新耗时的统计量，
+            并保留最慢的top_n个状态块
+        :top_n: 流式统计时保留的最慢状态块个数
+        """
         super(StatusParser, self).__init__(parser_name)
 
-        self.status_begin_time = ''  # 状态开始时间。''表示不在状态块中
-        self.last_status_time = ''
-        self.statuses = list()
+        self.status_begin_time = 0  # 状态开始时间。0表示不在状态块中
+        self.last_status_time = 0
+        self.statuses = ColumnStore([('begin', INT), ('end', INT)])
+
+        self.streaming = streaming
+        #: 流式统计时耗时的统计量
+        self.stats = StreamingStats() if streaming else None
+        #: 流式统计时最慢的状态块，(开始时间, 结束时间)
+        self.slowest = TopN(top_n) if streaming else None
 
-    def parse(self, line_time, line_content):
+        #: 分块处理时，是否还没遇到第一个状态块的开始
+        self.in_leading = False
+        #: 第一个状态块开始之前的最后一行状态日志的时间，属于前一块未结束的状态块
+        self.leading_status_time = 0
+
+    def parse(self, line_time, line_content, key=None):
         """分析一行日志
 
         如果是状态行则更新内部的状态。
 
         :line_time: 行的时间
         :line_content: 时间之后的内容
+        :key: 行中找到的关键字
         :returns: 匹配上则返回True
 
         """
@@ -205,53 +723,337 @@ class StatusParser(ParserBase):
             self.__finish_last_status()
 
             self.status_begin_time = line_time
+            self.in_leading = False
+        elif self.in_leading:
+            self.leading_status_time = line_time
 
         self.last_status_time = line_time
         return True
 
+    def begin_chunk(self):
+        self.in_leading = True
+
+    def merge(self, other):
+        if other.leading_status_time:
+            # 延续本块最后一个状态块
+            self.last_status_time = other.leading_status_time
+
+        if other.in_leading:
+            # 后一块中没有新的状态块开始
+            return
+
+        self.__finish_last_status()
+        if self.streaming:
+            self.stats.merge(other.stats)
+            self.slowest.merge(other.slowest)
+        else:
+            self.statuses.extend(other.statuses)
+        self.status_begin_time = other.status_begin_time
+        self.last_status_time = other.last_status_time
+
     def finish(self):
         # 结束可能存在的最后一个状态块
         self.__finish_last_status()
 
-        df = pd.DataFrame.from_dict(self.statuses)
-        duration = (df['end'] - df['begin']) / pd.Timedelta('1us')
-        return Result(summary(duration), df)
+        if self.streaming:
+            slowest = np.array(self.slowest.items(), dtype=np.int64).reshape(-1, 2)
+            store = ColumnStore.from_arrays(
+                ('datetime', 'begin', 'end'), (slowest[:, 0], slowest[:, 0], slowest[:, 1]))
+            return Result(self.stats.summary(), store, time_columns=('datetime', 'begin', 'end'), stats=self.stats)
+
+        begin = self.statuses.column('begin')
+        end = self.statuses.column('end')
+        store = ColumnStore.from_arrays(('datetime', 'begin', 'end'), (begin, begin, end))
+        return Result(summary(end - begin, ddof=1), store, time_columns=('datetime', 'begin', 'end'))
 
     def __finish_last_status(self):
         """ 结束上一个状态块 """
         if self.status_begin_time:
-            self.statuses.append({
-                'datetime': self.status_begin_time,
-                'begin':    self.status_begin_time,
-                'end':      self.last_status_time,
-            })
+            self.add_status(self.status_begin_time, self.last_status_time)
 
             # 清一下状态，下次就不会重复进入
-            self.status_begin_time = ''
+            self.status_begin_time = 0
+
+    def add_status(self, begin, end):
+        """记录一个结束了的状态块
+
+        :begin: 开始时间
+        :end: 结束时间
+        :returns: 无
+        """
+        if self.streaming:
+            self.stats.add(end - begin)
+            self.slowest.add(end - begin, (begin, end))
+            return
+
+        self.statuses.append((begin, end))
+
+
+class RollingStatusParser(StatusParser):
+
+    """只保留最近一段时间内状态块的StatusParser，用于跟踪模式"""
+
+    def __init__(self, parser_name, window):
+        """构造函数
+
+        :parser_name: 分析器的名称
+        :window: 时间窗口，微秒
+        """
+        super(RollingStatusParser, self).__init__(parser_name)
+
+        self.window = window
+        #: 时间窗口内的状态块，(结束时间, 耗时)
+        self.recent = deque()
+
+    def add_status(self, begin, end):
+        self.recent.append((end, end - begin))
+        self.expire(end)
+
+    def expire(self, now):
+        """丢弃结束时间早于now减时间窗口的状态块"""
+        while self.recent and self.recent[0][0] < now - self.window:
+            self.recent.popleft()
+
+    def rolling_summary(self, now=None):
+        """时间窗口内状态块耗时的统计
+
+        :now: 时间窗口的结束时间，缺省为最后一行状态日志的时间
+        :returns: summary() 的结果
+        """
+        self.expire(self.last_status_time if now is None else now)
+        return summary(np.array([duration for _, duration in self.recent], dtype=np.int64))
 
 
 class RegexParser(ParserBase):
-    def __init__(self, parser_name, regex):
+    raw = True
+
+    #: 字段类型 -> (列的类型, 由解码后的字符串转换的函数)。time为 DateTime.to_epoch() 格式的时间
+    FIELD_TYPES = {
+        'str'   : (STR, None),
+        'int'   : (INT, int),
+        'float' : (FLOAT, float),
+        'time'  : (INT, DateTime.to_epoch),
+    }
+
+    def __init__(self, parser_name, regex, keys=None, types=None, aggregate=(), group_by=None, raw=True):
+        """构造函数
+
+        :parser_name: 分析器的名称
+        :regex: 匹配日志行内容的正则表达式，命名分组即为结果的列。raw为True时匹配未解码的字节串，匹配后才解码
+        :keys: 匹配的行中必然出现的固定字符串，见 ParserBase.keys
+        :types: 命名分组 -> 字段类型（见 FIELD_TYPES ），缺省为str。
+            转换失败的行当作不匹配，没有匹配的可选分组为0
+        :aggregate: 要在结果的summary中统计（见 summary() ）的数值字段
+        :group_by: 按此字段的值分别统计aggregate中的字段。None表示不分组
+        :raw: 见 ParserBase.raw 。命名分组截取任意文本时要为False
+        """
         super(RegexParser, self).__init__(parser_name)
 
-        self.details = list()
         self.re = re.compile(regex)
+        self.keys = keys
+        self.raw = raw
+
+        types = types or dict()
+        for name, field_type in types.iteritems():
+            if name not in self.re.groupindex or field_type not in self.FIELD_TYPES:
+                raise ValueError(u'{0}: invalid type {1!r} of field {2!r}'.format(parser_name, field_type, name))
+        for name in aggregate:
+            if types.get(name) not in ('int', 'float'):
+                raise ValueError(u'{0}: aggregated field {1!r} must be int or float'.format(parser_name, name))
+        if group_by is not None and group_by not in self.re.groupindex:
+            raise ValueError(u'{0}: unknown group_by field {1!r}'.format(parser_name, group_by))
+
+        self.types = types
+        self.init_converters()
+        self.aggregate = tuple(aggregate)
+        self.group_by = group_by
+
+        # 各命名分组为字符串列，没有datetime分组时另有日志行的时间
+        columns = [(name, self.FIELD_TYPES[types.get(name, 'str')][0]) for name in sorted(self.re.groupindex)]
+        if 'datetime' not in self.re.groupindex:
+            columns.append(('datetime', INT))
+        self.details = ColumnStore(columns)
+        #: 时间列，见 Result
+        self.time_columns = ('datetime',) + tuple(
+            sorted(name for name, field_type in types.iteritems() if field_type == 'time' and name != 'datetime'))
+
+    def init_converters(self):
+        #: 需要转换的字段 -> 转换函数
+        self.converters = {
+            name: self.FIELD_TYPES[field_type][1]
+            for name, field_type in self.types.iteritems() if self.FIELD_TYPES[field_type][1]
+        }
+
+    def __getstate__(self):
+        # 绑定方法（如 DateTime.to_epoch ）不能pickle，不保存
+        state = self.__dict__.copy()
+        del state['converters']
+        return state
 
-    def parse(self, line_time, line_content):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_converters()
+
+    def parse(self, line_time, line_content, key=None):
         m = self.re.match(line_content)
         if not m:
             return False
 
-        d = m.groupdict()
+        d = self.decode_groups(m)
         if not 'datetime' in d:
             # 如果没有datetime，就取日志行的时间
             d['datetime'] = line_time
 
-        self.details.append(d)
+        for name, converter in self.converters.iteritems():
+            if d[name] is None:
+                d[name] = 0
+                continue
+
+            try:
+                d[name] = converter(d[name])
+            except ValueError:
+                logging.debug(u'    {0}: invalid {1} {2!r}'.format(self.parser_name, name, d[name]))
+                return False
+
+        self.details.append_dict(d)
         return True
 
+    def merge(self, other):
+        self.details.extend(other.details)
+
     def finish(self):
-        return Result(None, self.details)
+        result = Result(None, self.details, time_columns=self.time_columns)
+        if self.aggregate:
+            result.summary = {'count': len(self.details), 'stats': self.aggregate_stats(result)}
+        return result
+
+    def aggregate_stats(self, result):
+        """aggregate中各字段的统计
+
+        :result: 本分析器的结果
+        :returns: summary() 的结果的list，另有field 字段名，key group_by字段的值（不分组时为None），
+            按key、aggregate中的顺序排列
+        """
+        if self.group_by is None:
+            groups = [(None, slice(None))]
+        else:
+            keys = result.column(self.group_by)
+            groups = [(key, keys == key) for key in sorted(set(keys))]
+
+        stats = list()
+        for key, selector in groups:
+            for name in self.aggregate:
+                stat = summary(result.column(name)[selector])
+                stat.update(field=name, key=key)
+                stats.append(stat)
+
+        return stats
+
+
+#: 规则文件中分析器的类型 -> 由规则创建分析器的函数，见 register_parser_type()
+PARSER_TYPES = dict()
+
+
+def register_parser_type(name):
+    """注册规则文件中的一种分析器类型，用作创建函数的装饰器
+
+    创建函数的参数为规则（规则文件中的一项，dict），返回 ParserBase 的子类的实例，
+    parser_name为规则的name。
+
+    :name: 类型名，即规则中的type
+    """
+    def register(factory):
+        PARSER_TYPES[name] = factory
+        return factory
+
+    return register
+
+
+def regex_keys(regex):
+    """正则表达式匹配的行中必然出现的最长的固定字符串，用作 ParserBase.keys
+
+    只取不在分支、重复中的连续字面字符，不够 RULE_MIN_KEY_LENGTH 个字符时返回None。
+    忽略大小写（如(?i)）的正则表达式匹配的行中不一定有这样的字符串，也返回None。
+
+    :regex: 正则表达式
+    :returns: 只有一个关键字的tuple或None
+    """
+    def literal_runs(pattern):
+        runs = [[]]
+        for op, value in pattern:
+            if op == sre_constants.LITERAL:
+                runs[-1].append(chr(value))
+            elif op == sre_constants.SUBPATTERN:
+                runs.extend(literal_runs(value[-1]))
+                runs.append([])
+            else:
+                runs.append([])
+        return runs
+
+    pattern = sre_parse.parse(regex)
+    if pattern.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return None
+
+    runs = [''.join(run) for run in literal_runs(pattern)]
+    key = max(runs, key=len)
+    return (key,) if len(key) >= RULE_MIN_KEY_LENGTH else None
+
+
+@register_parser_type('regex')
+def create_regex_parser(rule):
+    """由规则创建 RegexParser
+
+    规则中pattern为正则表达式，keys为匹配的行中必然出现的固定字符串的list（缺省由pattern得出，
+    见 regex_keys() ），types、aggregate、group_by见 RegexParser 。
+    规则中的命名分组可能截取任意文本，分析器不是 ParserBase.raw 的，匹配解码后的行。
+    """
+    regex = rule['pattern']
+    keys = tuple(key.encode('utf-8') for key in rule['keys']) if rule.get('keys') else regex_keys(regex.encode('utf-8'))
+    if not keys:
+        raise ValueError(u'{0}: keys are required, no fixed string found in the pattern or the pattern ignores case'.format(rule['name']))
+
+    return RegexParser(
+        rule['name'], regex, keys=keys,
+        types=rule.get('types'), aggregate=rule.get('aggregate', ()), group_by=rule.get('group_by'), raw=False)
+
+
+def load_rules(filename):
+    """读取规则文件
+
+    规则文件为JSON，{"parsers": [规则, ...]}，规则为dict：name 分析器的名称，即结果中的键；
+    type 分析器类型（见 PARSER_TYPES ），缺省为regex；其他项由相应类型的创建函数使用。
+
+    :filename: 规则文件名
+    :returns: 规则的list。检查了名称和类型，各规则都能创建分析器
+    """
+    with io.open(filename, encoding='utf-8') as f:
+        rules = json.load(f).get('parsers', [])
+
+    names = set(RESERVED_RESULT_NAMES)
+    for rule in rules:
+        name = rule.get('name')
+        if not name or name in names:
+            raise ValueError(u'{0}: missing or duplicate parser name {1!r}'.format(filename, name))
+        names.add(name)
+
+        if rule.get('type', 'regex') not in PARSER_TYPES:
+            raise ValueError(u'{0}: unknown parser type {1!r}'.format(name, rule.get('type')))
+
+    # 尽早发现规则中的错误
+    create_rule_parsers(rules)
+    return rules
+
+
+def create_rule_parsers(rules):
+    """由 load_rules() 读取的规则创建各分析器
+
+    规则中的分析器不独占所匹配的行（见 ParserBase.exclusive ），可以统计内置分析器处理的行，
+    如状态日志中的各行。
+    """
+    parsers = [PARSER_TYPES[rule.get('type', 'regex')](rule) for rule in rules]
+    for parser in parsers:
+        parser.exclusive = False
+    return parsers
 
 
 class ConnectionParser(ParserBase):
@@ -273,62 +1075,157 @@ class ConnectionParser(ParserBase):
     re_wanm_error = re.compile(
         r'.*@sscc::gateway::CsComm.*@WanM ERROR@(?:Ssl )?Connection<(?P<conn_id>\d+)\([^)]+\) - \S+ to (?P<cs_addr>[0-9:.]+)> - (?P<reason>.+)')
 
-    def __init__(self, parser_name='connections'):
+    # 按原来逐个尝试正则表达式的顺序排列
+    keys = (
+        'Begin to create server connection',
+        'OnConnectOK',
+        'OnConnectFail',
+        'WanM ERROR',
+        'HandleLogout',
+        'OnConnectionClose',
+    )
+
+    # 登出原因（ [^@]+ ）和WanM错误原因截取任意文本，GBK字符的第二个字节可能是@，匹配解码后的行
+    raw = False
+
+    #: 已结束的连接的各列
+    COLUMNS = (
+        ('gw_id', STR),
+        ('conn_id', INT),
+        ('status', STR),
+        ('begin_time', INT),
+        ('connect_time', INT),
+        ('close_time', INT),
+        ('gw_addr', STR),
+        ('cs_addr', STR),
+        ('code', STR),
+        ('reason', STR),
+    )
+
+    #: 分块处理时，开始连接时间在前一块中、待定
+    PENDING_TIME = -1
+
+    def __init__(self, parser_name='connections', max_errors=CONNECTION_MAX_ERRORS):
+        """构造函数
+
+        :parser_name: 分析器的名称
+        :max_errors: 最多记录WanM出错信息的未结束连接数
+        """
         super(ConnectionParser, self).__init__(parser_name)
-        #: 网关ID -> 连接信息。连接信息为详细信息的列表
-        self.connections = defaultdict(list)
+        #: 已结束的连接。同一网关的连接按结束的顺序排列
+        self.connections = ColumnStore(self.COLUMNS)
+        #: 网关ID -> 该网关已结束连接的(连接ID, 在connections中的序号)的list，按连接ID排序。
+        #: 连接ID基本递增，一般只是追加，结束时不用再排序
+        self.gw_index = defaultdict(list)
         #: 当前连接上当前活动的连接。连接ID -> 连接信息
         self.active_conns = dict()
         #: 网关ID -> 开始连接时间
-        self.begin_time = defaultdict(str)
-        #: 记录每个连接首次WanM出错信息
+        self.begin_time = dict()
+        #: 未结束的连接首次WanM出错信息，连接结束时删除
         self.wanm_error_conns = dict()
+        self.max_errors = max_errors
+
+        #: 没有找到开始连接时间时使用的值。分块处理时为 PENDING_TIME
+        self.default_begin_time = 0
+        #: 分块处理时，是否还没遇到网关重启，即前一块留下的活动连接是否可能还在
+        self.inherited = False
+        #: 分块处理时，对前一块留下的活动连接的操作，合并时依次执行
+        self.pending = list()
+        #: 分块处理时，连接失败的连接在connections中的序号及其连接ID。
+        #: 合并时要用前一块的WanM出错信息更新
+        self.failed_conns = None
+
+        self.init_handlers()
+
+    def init_handlers(self):
+        #: 关键字 -> 处理方法
+        self.handlers = dict(zip(self.keys, (
+            self.parse_begin_conn,
+            self.parse_connect_ok,
+            self.parse_connect_fail,
+            self.parse_wanm_error,
+            self.parse_connection_logout,
+            self.parse_connection_close,
+        )))
+
+    def __getstate__(self):
+        # 绑定方法不能pickle，不保存
+        state = self.__dict__.copy()
+        del state['handlers']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_handlers()
+
+    def parse(self, line_time, line_content, key=None):
+        if key is None:
+            # 没有经过分派，逐个尝试
+            for key in self.keys:
+                if self.handlers[key](line_time, line_content):
+                    return True
+
+            return False
+
+        return self.handlers[key](line_time, line_content)
 
-    def parse(self, line_time, line_content):
+    def parse_begin_conn(self, line_time, line_content):
         m = self.re_begin_conn.match(line_content)
         if m:
-            self.begin_time[m.group('gw_id')] = line_time
+            d = self.decode_groups(m)
+            self.begin_time[d['gw_id']] = line_time
 
-            logging.debug(u'    {datetime}: Gateway "{gw_id}" begin to connect {cs_addr}'.format(datetime=line_time, **m.groupdict()))
+            logging.debug(u'    {datetime}: Gateway "{gw_id}" begin to connect {cs_addr}'.format(datetime=line_time, **d))
             return True
 
+        return False
+
+    def parse_connect_ok(self, line_time, line_content):
         m = self.re_connect_ok.match(line_content)
         if m:
-            gw_id = m.group('gw_id')
-            conn_id = m.group('conn_id')
+            d = self.decode_groups(m)
+            gw_id = d['gw_id']
+            conn_id = d['conn_id']
 
-            conn = {
+            if self.inherited and conn_id not in self.active_conns:
+                # 前一块中同ID的活动连接会被覆盖
+                self.pending.append(('drop', conn_id))
+
+            self.open_connection({
                 'conn_id' : conn_id,
                 'gw_id' : gw_id,
-                'begin_time' : self.begin_time[gw_id],
+                'begin_time' : self.begin_time.get(gw_id, self.default_begin_time),
                 'connect_time' : line_time,
-                'close_time' : '',
-                'gw_addr' : m.group('gw_addr'),
-                'cs_addr' : m.group('cs_addr'),
+                'close_time' : 0,
+                'gw_addr' : d['gw_addr'],
+                'cs_addr' : d['cs_addr'],
                 'code' : '',
                 'reason' : '',
                 'status' : 'connected',
-            }
-            self.active_conns[conn_id] = conn
+            })
 
-            logging.debug(u'    {begin_time}: Gateway "{gw_id}" (#{conn_id}) connected to {cs_addr}'.format(**conn))
+            logging.debug(u'    {begin_time}: Gateway "{gw_id}" (#{conn_id}) connected to {cs_addr}'.format(**self.active_conns[conn_id]))
             return True
 
+        return False
+
+    def parse_connect_fail(self, line_time, line_content):
         m = self.re_connect_fail.match(line_content)
         if m:
-            gw_id = m.group('gw_id')
-            conn_id = m.group('conn_id')
+            d = self.decode_groups(m)
+            gw_id = d['gw_id']
+            conn_id = d['conn_id']
 
             conn = {
                 'conn_id' : conn_id,
                 'gw_id' : gw_id,
-                'begin_time' : self.begin_time[gw_id],
-                'connect_time' : '',
+                'begin_time' : self.begin_time.get(gw_id, self.default_begin_time),
+                'connect_time' : 0,
                 'close_time' : line_time,
                 'gw_addr' : '',
-                'cs_addr' : m.group('cs_addr'),
-                'code' : 'WanM_' + m.group('code'),
-                'reason' : m.group('reason'),
+                'cs_addr' : d['cs_addr'],
+                'code' : 'WanM_' + d['code'],
+                'reason' : d['reason'],
                 'status' : 'failed',
             }
 
@@ -336,31 +1233,53 @@ class ConnectionParser(ParserBase):
                 # 此连接之前已经报错，之前的出错信息才是真正的原因
                 conn.update(self.wanm_error_conns[conn_id])
 
-            self.connections[gw_id].append(conn)
+            i = self.add_connection(conn)
+            if self.failed_conns is not None:
+                self.failed_conns.append((i, conn_id))
 
             logging.debug(u'    {close_time}: Gateway "{gw_id}" (#{conn_id}) failed to connect to {cs_addr}: {code}, {reason}'.format(**conn))
             return True
 
+        return False
+
+    def parse_wanm_error(self, line_time, line_content):
         m = self.re_wanm_error.match(line_content)
         if m:
-            d = m.groupdict()
+            d = self.decode_groups(m)
             if d['conn_id'] not in self.wanm_error_conns:
                 self.wanm_error_conns[d['conn_id']] = {
                     'close_time' : line_time,
                     'code' : 'WanM',
                     'reason' : d['reason'],
                 }
+                self.limit_errors()
 
             return True
 
+        return False
+
+    def limit_errors(self):
+        """出错信息超过max_errors个时，丢掉较早的一半
+
+        出错后一直没有结束的连接（如出错信息在连接结束之后）的信息不会被删除，
+        连接ID是递增的，较早的不会再用到。
+        """
+        if len(self.wanm_error_conns) > self.max_errors:
+            for conn_id in sorted(self.wanm_error_conns, key=int)[:self.max_errors // 2]:
+                del self.wanm_error_conns[conn_id]
+
+    def parse_connection_logout(self, line_time, line_content):
         m = self.re_connection_logout.match(line_content)
         if m:
-            self.close_connection(line_time, 'logout:', m.groupdict(), 'logout')
+            self.close_connection(line_time, 'logout:', self.decode_groups(m), 'logout')
             return True
 
+        return False
+
+    def parse_connection_close(self, line_time, line_content):
         m = self.re_connection_close.match(line_content)
         if m:
-            self.close_connection(line_time, 'WanM:', m.groupdict(), 'closed')
+            self.close_connection(line_time, 'WanM:', self.decode_groups(m), 'closed')
             return True
 
         return False
@@ -370,36 +1289,281 @@ class ConnectionParser(ParserBase):
 
         if conn_id in self.active_conns:
             # 本连接前面还没有找到断开原因。
-            conn = self.active_conns[conn_id]
-
-            conn.update({
-                'close_time' : line_time,
-                'code' : code_prefix + (m['code'] if 'code' in m else ''),
-                'reason' : m['reason'],
-                'status' : status,
-            })
-            self.connections[conn['gw_id']].append(conn)
-            del self.active_conns[conn_id]
+            conn = self.active_conns.pop(conn_id)
+            self.update_closed(conn, line_time, code_prefix, m, status)
+            self.add_connection(conn)
 
             logging.debug(u'    {close_time}: Gateway "{gw_id}" (#{conn_id}) disconnected from {cs_addr}: {code}, {reason}'.format(**conn))
+        elif self.inherited:
+            # 可能是前一块留下的活动连接
+            self.pending.append(('close', conn_id, self.positions(), (line_time, code_prefix, m, status)))
+
+    @staticmethod
+    def update_closed(conn, line_time, code_prefix, m, status):
+        conn.update({
+            'close_time' : line_time,
+            'code' : code_prefix + (m['code'] if 'code' in m else ''),
+            'reason' : m['reason'],
+            'status' : status,
+        })
+
+    def positions(self):
+        """各网关已结束连接的个数，用于合并时确定插入位置"""
+        return {gw_id: len(conns) for gw_id, conns in self.gw_index.iteritems()}
+
+    def begin_chunk(self):
+        self.default_begin_time = self.PENDING_TIME
+        self.inherited = True
+        self.failed_conns = list()
+
+    def merge(self, other):
+        # 补上待定的开始连接时间和WanM出错信息
+        conns = other.connections
+        for i in np.flatnonzero(conns.column('begin_time') == self.PENDING_TIME):
+            conns.set(i, 'begin_time', self.begin_time.get(conns.get(i, 'gw_id'), self.default_begin_time))
+        for conn in other.active_conns.itervalues():
+            if conn['begin_time'] == self.PENDING_TIME:
+                conn['begin_time'] = self.begin_time.get(conn['gw_id'], self.default_begin_time)
+
+        for i, conn_id in other.failed_conns or ():
+            if conn_id in self.wanm_error_conns:
+                for name, value in self.wanm_error_conns[conn_id].iteritems():
+                    conns.set(i, name, value)
+        # 在后一块中结束的连接不再需要出错信息
+        for conn_id in conns.column('conn_id'):
+            self.wanm_error_conns.pop(str(conn_id), None)
+
+        # 按顺序执行对本块活动连接的操作，得到要插入后一块结果中的连接
+        inserts = defaultdict(list)
+        for op in other.pending:
+            if op[0] == 'drop':
+                self.active_conns.pop(op[1], None)
+            elif op[0] == 'close':
+                _, conn_id, positions, args = op
+                conn = self.active_conns.pop(conn_id, None)
+                if conn:
+                    self.update_closed(conn, *args)
+                    inserts[conn['gw_id']].append((positions.get(conn['gw_id'], 0), conn))
+            else:   # startup
+                positions = op[1]
+                for conn in self.active_conns.itervalues():
+                    inserts[conn['gw_id']].append((positions.get(conn['gw_id'], 0), conn))
+                self.active_conns.clear()
+
+        # 要插入的连接放在后一块中该网关的第pos个连接之前
+        counts = defaultdict(int)
+        indices = list()
+        for i in (xrange(len(conns)) if inserts else ()):
+            gw_id = conns.get(i, 'gw_id')
+            pending = inserts.get(gw_id)
+            while pending and pending[0][0] <= counts[gw_id]:
+                self.extend_connections(conns, indices)
+                indices = list()
+                self.add_connection(pending.pop(0)[1])
+
+            indices.append(i)
+            counts[gw_id] += 1
+
+        self.extend_connections(conns, indices if inserts else None)
+        for pending in inserts.itervalues():
+            for _, conn in pending:
+                self.add_connection(conn)
+
+        self.active_conns.update(other.active_conns)
+        for gw_id, t in other.begin_time.iteritems():
+            self.begin_time[gw_id] = t
+        for conn_id, error in other.wanm_error_conns.iteritems():
+            self.wanm_error_conns.setdefault(conn_id, error)
+        self.limit_errors()
 
     def finish(self):
         self.on_startup()
 
-        # 按连接ID排序，基本上就是按时间
-        for gw_id in self.connections:
-            self.connections[gw_id] = sorted(self.connections[gw_id], key=lambda conn: int(conn['conn_id']))
+        # 按网关ID、连接ID排列，同一网关的连接基本上就是按时间
+        order = np.array(
+            [i for gw_id in sorted(self.gw_index) for _, i in self.gw_index[gw_id]], dtype=np.intp)
+        connections = self.connections.take(order)
+        return Result(
+            {'count': len(connections), 'endpoints': self.endpoint_stats(connections)},
+            connections, time_columns=('begin_time', 'connect_time', 'close_time'))
+
+    @staticmethod
+    def endpoint_stats(conns):
+        """按网关ID、TCS地址统计连接情况，用于发现反复重连等问题
+
+        :conns: 已结束连接的 ColumnStore
+        :returns: 各网关ID、TCS地址的统计dict的list，按网关ID、TCS地址排序。
+            时间都是微秒数，没有相应的连接时为None：
+            connections 连接次数，connected 连接成功次数，failures 连接失败次数，
+            failures_per_minute 从第一次开始连接到最后一个事件之间平均每分钟失败次数，
+            max_failures_per_minute 失败最多的一分钟内的失败次数，
+            connect_time_mean / connect_time_max 从开始连接到连接成功的平均/最长时间，
+            uptime_mean / uptime_min / uptime_max 连接成功到断开的平均/最短/最长时间
+        """
+        if not len(conns):
+            return list()
+
+        gw_ids = np.array(conns.categories['gw_id'], dtype=object)
+        cs_addrs = np.array(conns.categories['cs_addr'], dtype=object)
+        keys = conns.column('gw_id').astype(np.int64) * len(cs_addrs) + conns.column('cs_addr')
+        unique_keys, groups = np.unique(keys, return_inverse=True)
+        size = len(unique_keys)
+
+        begin = conns.column('begin_time')
+        connect = conns.column('connect_time')
+        close = conns.column('close_time')
+        statuses = conns.categories['status']
+        failed = conns.column('status') == (statuses.index('failed') if 'failed' in statuses else -2)
+
+        def group_max(mask, values, initial=-np.inf):
+            result = np.full(size, initial)
+            np.maximum.at(result, groups[mask], values[mask])
+            return result
+
+        def group_mean(mask, values):
+            counts = np.bincount(groups[mask], minlength=size)
+            sums = np.bincount(groups[mask], weights=values[mask], minlength=size)
+            return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+        connected = connect != 0
+        failures = np.bincount(groups, weights=failed, minlength=size)
+
+        # 各组第一个和最后一个事件的时间
+        first_time = np.where(begin > 0, begin, np.where(connected, connect, close))
+        last_time = np.maximum(connect, close)
+        first = -group_max(first_time > 0, -first_time.astype(np.float64))
+        last = group_max(last_time > 0, last_time.astype(np.float64))
+        minutes = np.maximum((last - first) / 60e6, 1)
+
+        # 每组每分钟的失败次数
+        minute_keys, minute_counts = np.unique(
+            groups[failed].astype(np.int64) << 32 | (close[failed] // 60000000), return_counts=True)
+        max_failures = np.zeros(size)
+        np.maximum.at(max_failures, minute_keys >> 32, minute_counts)
+
+        connect_mask = connected & (begin > 0)
+        connect_times = connect - begin
+        uptime_mask = connected & (close != 0)
+        uptimes = (close - connect).astype(np.float64)
+
+        columns = {
+            'connections'               : np.bincount(groups, minlength=size),
+            'connected'                 : np.bincount(groups, weights=connected, minlength=size),
+            'failures'                  : failures,
+            'failures_per_minute'       : failures / minutes,
+            'max_failures_per_minute'   : max_failures,
+            'connect_time_mean'         : group_mean(connect_mask, connect_times),
+            'connect_time_max'          : group_max(connect_mask, connect_times),
+            'uptime_mean'               : group_mean(uptime_mask, uptimes),
+            'uptime_min'                : -group_max(uptime_mask, -uptimes),
+            'uptime_max'                : group_max(uptime_mask, uptimes),
+        }
+
+        stats = list()
+        for i, key in enumerate(unique_keys):
+            endpoint = {'gw_id': gw_ids[key // len(cs_addrs)], 'cs_addr': cs_addrs[key % len(cs_addrs)]}
+            for name, values in columns.iteritems():
+                value = values[i]
+                endpoint[name] = None if np.isinf(value) or np.isnan(value) else value.item()
+            stats.append(endpoint)
 
-        return self.connections
+        return sorted(stats, key=lambda endpoint: (endpoint['gw_id'], endpoint['cs_addr']))
 
     def on_startup(self, **kwargs):
+        if self.inherited:
+            # 前一块留下的活动连接也要移到connections中
+            self.pending.append(('startup', self.positions()))
+            self.inherited = False
+
         # 每次网关重启，都把之前的连接信息移到connections中
         for conn_id in self.active_conns:
-            conn = self.active_conns[conn_id]
-            self.connections[conn['gw_id']].append(conn)
+            self.add_connection(self.active_conns[conn_id])
+
+        self.active_conns.clear()
+
+    def open_connection(self, conn):
+        """记录一个连接成功的连接
+
+        :conn: 连接信息
+        :returns: 无
+        """
+        self.active_conns[conn['conn_id']] = conn
+
+    def add_connection(self, conn):
+        """记录一个结束了（失败、断开或因重启而中止）的连接
+
+        :conn: 连接信息
+        :returns: 在connections中的序号
+        """
+        # 连接已结束，不再需要它的WanM出错信息
+        self.wanm_error_conns.pop(conn['conn_id'], None)
+
+        conn_id = int(conn['conn_id'])
+        i = self.connections.append_dict(dict(conn, conn_id=conn_id))
+        self.index_connection(conn['gw_id'], conn_id, i)
+        return i
+
+    def extend_connections(self, conns, indices=None):
+        """把另一块的已结束连接追加到connections中，参数同 ColumnStore.extend()"""
+        begin = len(self.connections)
+        self.connections.extend(conns, indices)
+
+        gw_ids = self.connections.categories['gw_id']
+        codes = self.connections.column('gw_id')[begin:]
+        conn_ids = self.connections.column('conn_id')[begin:]
+        for i, (code, conn_id) in enumerate(zip(codes, conn_ids), begin):
+            self.index_connection(gw_ids[code], int(conn_id), i)
+
+    def index_connection(self, gw_id, conn_id, i):
+        """在 gw_index 中记录connections中的第i个连接"""
+        conns = self.gw_index[gw_id]
+        if not conns or conns[-1] < (conn_id, i):
+            conns.append((conn_id, i))
+        else:
+            bisect.insort(conns, (conn_id, i))
+
+
+class ConnectionEventParser(ConnectionParser):
+
+    """不保存连接历史、只产生连接事件的ConnectionParser，用于跟踪模式"""
+
+    def __init__(self, parser_name='connections', max_events=FOLLOW_MAX_EVENTS):
+        """构造函数
+
+        :parser_name: 分析器的名称
+        :max_events: 最多保留的未取走事件数，也是最多记录WanM出错信息的连接数
+        """
+        super(ConnectionEventParser, self).__init__(parser_name, max_errors=max_events)
+
+        #: 未取走的事件，(时间, 事件, 连接信息)。事件为连接的status或'reset'。
+        #: 连接信息是事件发生时的副本，之后连接的变化不影响它
+        self.events = deque(maxlen=max_events)
+
+    def open_connection(self, conn):
+        super(ConnectionEventParser, self).open_connection(conn)
+        self.events.append((conn['connect_time'], conn['status'], dict(conn)))
+
+    def add_connection(self, conn):
+        # 连接已结束，不再需要它的WanM出错信息
+        self.wanm_error_conns.pop(conn['conn_id'], None)
+        self.events.append((conn['close_time'], conn['status'], dict(conn)))
+
+    def on_startup(self, **kwargs):
+        # 网关重启，未断开的连接都中止了
+        for conn in self.active_conns.itervalues():
+            self.events.append((kwargs['datetime'], 'reset', dict(conn)))
 
         self.active_conns.clear()
 
+    def pop_events(self):
+        """取走目前为止的事件
+
+        :returns: 事件的list，按发生顺序
+        """
+        events = list(self.events)
+        self.events.clear()
+        return events
+
 
 class StartupParser(ParserBase):
     """分析网关关闭时间、原因
@@ -407,62 +1571,266 @@ class StartupParser(ParserBase):
     re_shutdown_win = re.compile(
         r'.*@cppf::common::StopAppFunc@.*@Catch control event (?P<reason>\w+).*, stopping@.*')
 
+    keys = ('StopAppFunc',)
+
+    raw = True
+
     def __init__(self, parser_name='startups'):
         super(StartupParser, self).__init__(parser_name)
         self.startups = list()
-        self.last_startup_time = ''
+        self.last_startup_time = 0
 
-    def parse(self, line_time, line_content):
+    def parse(self, line_time, line_content, key=None):
         m = self.re_shutdown_win.match(line_content)
         if m:
             self.startups.append({
                 'startup_time': self.last_startup_time,
                 'shutdown_time' : line_time,
-                'shutdown_reason' : m.group('reason'),
+                'shutdown_reason' : self.decode(m.group('reason')),
             })
-            self.last_startup_time = ''
+            self.last_startup_time = 0
             return True
 
     def on_startup(self, **kwargs):
         self.last_startup_time = kwargs['datetime']
 
+    def begin_chunk(self):
+        # None表示启动时间在前一块中
+        self.last_startup_time = None
+
+    def merge(self, other):
+        for startup in other.startups:
+            if startup['startup_time'] is None:
+                startup['startup_time'] = self.last_startup_time
+
+        self.startups.extend(other.startups)
+        if other.last_startup_time is not None:
+            self.last_startup_time = other.last_startup_time
+
     def finish(self):
         if self.last_startup_time:  # 最后一次启动没有关闭
             self.startups.append({
                 'startup_time': self.last_startup_time,
-                'shutdown_time' : '',
+                'shutdown_time' : 0,
                 'shutdown_reason' : '',
             })
-        return self.startups
 
+        for startup in self.startups:
+            for column in ('startup_time', 'shutdown_time'):
+                startup[column] = DateTime.to_datetime(startup[column])
 
-class TgwLogParser(object):
+        return self.startups
 
-    """TGW日志解释类"""
 
-    re_line = re.compile(r'^\](?P<datetime>\d{4}-[^@]+)(?P<content>@.*)$')
+class TimeIndex(object):
 
-    # 网关重启后的第一行
-    re_startup = re.compile(r'.*@cppf::common::SzseApp(:?::|@)InitLog@.*')
+    """日志文件的时间索引
 
-    def __init__(self, filename, encoding, from_time, to_time):
-        """构造函数.
+    每隔 INDEX_INTERVAL 字节记录其后第一个带时间的行的位置和时间，
+    用于按时间快速定位。可保存为日志文件旁的索引文件，下次直接使用；
+    日志文件变长时只需补上新增部分的索引。
+    """
+
+    def __init__(self, filename, interval=INDEX_INTERVAL):
+        """构造函数
+
+        :filename: 日志文件名
+        :interval: 索引项的间隔字节数
+        """
+        self.filename = filename
+        self.index_filename = filename + INDEX_SUFFIX
+        self.interval = interval
+        #: [(行开始位置, 行时间)]，按位置排列。时间为 DateTime.to_epoch() 格式
+        self.entries = list()
+        #: 已建立索引的文件长度
+        self.size = 0
+        #: 日志文件的inode，用于判断文件是否被替换
+        self.inode = 0
+
+    @staticmethod
+    def line_at(f, pos, end):
+        """找pos及之后第一个带时间的行
+
+        pos不是行首时从下一行开始找。
+
+        :f: 以'rb'方式打开的文件
+        :pos: 开始位置
+        :end: 只找在此位置之前开始的行
+        :returns: (行开始位置, 行时间)，没有则返回None
+        """
+        if pos > 0:
+            # 从前一个字节开始找换行，pos刚好是行首时从pos开始
+            f.seek(pos - 1)
+            f.readline()
+        else:
+            f.seek(0)
+
+        while True:
+            start = f.tell()
+            if start >= end:
+                return None
+
+            line = f.readline()
+            if not line:
+                return None
+
+            m = TgwLogParser.re_line.match(line)
+            if m:
+                return start, DateTime.to_epoch(m.group('datetime'))
+
+    def load(self, f):
+        """读取索引文件。索引文件不存在、格式不对或日志文件已被替换时不读取
+
+        :f: 以'rb'方式打开的日志文件
+        :returns: 是否读取了已有的索引
+        """
+        try:
+            with open(self.index_filename, 'rb') as index_file:
+                index = json.load(index_file)
+
+            stat = os.fstat(f.fileno())
+            if index['interval'] != self.interval or index['inode'] != stat.st_ino or index['size'] > stat.st_size:
+                return False
+
+            entries = [tuple(entry) for entry in index['entries']]
+            if entries and self.line_at(f, entries[-1][0], stat.st_size) != entries[-1]:
+                # 内容已经变了
+                return False
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return False
+
+        self.entries = entries
+        self.size = index['size']
+        self.inode = index['inode']
+        return True
+
+    def update(self, f, file_size):
+        """补上文件新增部分的索引
+
+        :f: 以'rb'方式打开的日志文件
+        :file_size: 文件长度
+        :returns: 是否有新增的索引项
+        """
+        count = len(self.entries)
+        # 上次已处理到self.size之前的各个索引位置
+        pos = (self.size + self.interval - 1) // self.interval * self.interval
+
+        for pos in xrange(pos, file_size, self.interval):
+            entry = self.line_at(f, pos, file_size)
+            if entry and (not self.entries or entry[0] > self.entries[-1][0]):
+                self.entries.append(entry)
+
+        self.size = file_size
+        self.inode = os.fstat(f.fileno()).st_ino
+        return len(self.entries) != count
+
+    def save(self):
+        """保存索引文件，保存失败只记录警告
+
+        :returns: 无
+        """
+        try:
+            with open(self.index_filename, 'wb') as index_file:
+                json.dump({
+                    'interval'  : self.interval,
+                    'inode'     : self.inode,
+                    'size'      : self.size,
+                    'entries'   : self.entries,
+                }, index_file)
+        except (IOError, OSError) as e:
+            logging.warning(u'  Error saving time index "{0}": {1}'.format(self.index_filename, e))
+
+    def lookup(self, time_of_day, file_size):
+        """根据索引确定第一个不早于time_of_day的行所在的范围
+
+        :time_of_day: 当天的微秒数
+        :file_size: 文件长度
+        :returns: (开始位置, 结束位置)
+        """
+        begin, end = 0, file_size
+        for pos, t in self.entries:
+            if t % DateTime.US_PER_DAY < time_of_day:
+                begin = pos
+            else:
+                end = pos
+                break
+
+        return begin, end
+
+
+class TgwLogParser(object):
+
+    """TGW日志解释类"""
+
+    re_line = re.compile(r'^\](?P<datetime>\d{4}-[^@]+)(?P<content>@.*)$')
+
+    # 在整块中匹配一行，和对单独一行用re_line的结果相同
+    re_block_line = re.compile(r'^\](?P<datetime>\d{4}-[^@\n]+)(?P<content>@.*)$', re.MULTILINE)
+
+    # 块中re_line能匹配的各行（首行除外）之前的换行。以固定字符开头的正则表达式查找起来快得多
+    re_block_line_start = re.compile(r'\n(?=\]\d{4}-[^@\n]+@)')
+
+    # 网关重启后的第一行
+    re_startup = re.compile(r'.*@cppf::common::SzseApp(:?::|@)InitLog@.*')
 
-        :filename: 要解释的日志文件名
+    # re_startup的关键字
+    STARTUP_KEY = 'InitLog'
+
+    def __init__(self, filename, encoding, from_time, to_time, use_index=False, use_cache=False, streaming=False, profile=False, rules=None):
+        """构造函数.
+
+        :filename: 要解释的日志文件名。可以是同一日志轮转出的各段文件名的list，按时间顺序，
+            各段连成一个日志处理，见 parse_segments() 。日志文件可以是压缩的，见 LogStream
         :encoding: 日志文件的字符编码。可以为list，会依次用
         :from_time: 日志的开始时间
         :to_time: 日志的结束时间
+        :use_index: 按时间定位时是否使用并保存时间索引文件
+        :use_cache: 是否使用并保存解析缓存，下次只处理文件新增的部分
+        :streaming: 状态日志是否流式统计，见 StatusParser
+        :profile: 是否统计各段处理的耗时，结果在分析结果的profile中
+        :rules: load_rules() 读取的规则，由此创建的分析器加在内置分析器之后，
+            关键字并入同一个分派表，不增加每行的扫描次数
         """
-        self.filename = filename
+        #: 各段处理的耗时统计。None表示不统计
+        self.profiler = Profiler() if profile else None
+        self.rules = list(rules or ())
+        if isinstance(filename, basestring):
+            filename = [filename]
+        #: 轮转的各段日志文件名，按时间顺序
+        self.segments = list(filename)
+        #: 日志文件名。有多段时为最后一段，即当前的日志
+        self.filename = self.segments[-1]
+        self.use_index = use_index
+        self.use_cache = use_cache
+        self.streaming = streaming
+        self.cache_filename = self.filename + CACHE_SUFFIX
         self.from_time = from_time
         self.to_time = to_time
+        # 用于和 DateTime.to_epoch() % DateTime.US_PER_DAY 比较
+        self.from_us = DateTime.time_of_day(from_time)
+        self.to_us = DateTime.time_of_day(to_time)
         if isinstance(encoding, str):
             self.log_encodings = [encoding,]
         else:
             self.log_encodings = encoding
+        self.decoder = LogDecoder(self.log_encodings)
+
+        self.parsers = self.create_parsers()
+        self.init_dispatch()
+
+        self.first_time = 0
+        self.last_time = 0
+        self.line_count = 0
+        #: 是否因超出时间区间而停止处理
+        self.stopped = False
 
-        self.parsers = (
-            StatusParser('status'),
+    def create_parsers(self):
+        """创建各分析器
+
+        :returns: 分析器的tuple。每行按此顺序尝试
+        """
+        return (
+            StatusParser('status', streaming=self.streaming),
             ConnectionParser('connections'),
             RegexParser(
                 'version',
@@ -472,120 +1840,1497 @@ class TgwLogParser(object):
                     r'.*',
                     r'cmd line:\s*(?P<cmdline>.*)',
                     r'$'
-                ])),
+                ]),
+                keys=('app started, Version Info:',)),
             RegexParser(
                 'os',
-                r'.*osType:(?P<type>.*), osVersion:(?P<version>.*), cpuType:(?P<cpu>.*), cpuBits:(?P<bits>.*), memorySize:(?P<memory>\w+).*'),
+                r'.*osType:(?P<type>.*), osVersion:(?P<version>.*), cpuType:(?P<cpu>.*), cpuBits:(?P<bits>.*), memorySize:(?P<memory>\w+).*',
+                keys=('osType:',)),
             StartupParser(),
-        )
-        self.first_time = ''
-        self.last_time = ''
-        self.line_count = 0
+        ) + tuple(create_rule_parsers(self.rules))
+
+    def init_dispatch(self):
+        """根据各分析器的keys建立分派表
+
+        所有关键字合成一个正则表达式，每行只扫描一次，
+        再按找到的关键字把行交给相应的分析器。
+        """
+        #: 关键字 -> [(分析器序号, 关键字在分析器keys中的序号, 分析器, 关键字, 是否不需解码, 是否独占)]
+        self.dispatch = defaultdict(list)
+        #: keys为None，每行都要处理的分析器
+        self.catch_all_parsers = list()
+
+        for parser_idx, parser in enumerate(self.parsers):
+            parser.decoder = self.decoder
+            keys = parser.keys
+            raw = parser.raw
+            exclusive = parser.exclusive
+            if self.profiler:
+                parser = TimedParser(parser, self.profiler.get('parser:' + parser.parser_name))
+
+            if keys is None:
+                self.catch_all_parsers.append((parser_idx, 0, parser, None, raw, exclusive))
+                continue
+
+            for key_idx, key in enumerate(keys):
+                self.dispatch[key].append((parser_idx, key_idx, parser, key, raw, exclusive))
+
+        keys = set(self.dispatch)
+        keys.add(self.STARTUP_KEY)
+        #: 所有关键字，用于 prefilter()
+        self.dispatch_keys = sorted(keys)
+        # 长的优先，避免被短的前缀抢先匹配
+        self.re_dispatch = re.compile(
+            '|'.join(re.escape(key) for key in sorted(keys, key=lambda k: (-len(k), k))))
+
+        # findall()在每个位置只找出一个关键字，和它重叠的关键字（如规则中含有内置关键字的关键字）
+        # 会被它遮住。这些关键字要另外检查行中有没有
+        #: 关键字 -> 可能被它遮住的其他关键字：它包含的，或开头和它的末尾重叠的
+        self.dispatch_hidden = dict()
+        for key in keys:
+            hidden = tuple(sorted(
+                other for other in keys
+                if other != key and (other in key or any(
+                    key.endswith(other[:n]) for n in xrange(1, min(len(key), len(other)))))))
+            if hidden:
+                self.dispatch_hidden[key] = hidden
+
+    def dispatch_line(self, line_time, line_content):
+        """把一行交给相应的分析器
+
+        分析器的调用顺序和逐个尝试时的顺序一致，直到有一个 ParserBase.exclusive 的分析器匹配为止，
+        之后只再交给不独占的分析器。只有交给非 ParserBase.raw 的分析器时才解码。
 
-    def parse(self, progress_callback=None):
+        :line_time: 行的时间
+        :line_content: 时间之后的内容，未解码的字节串
+        :returns: 是否有分析器匹配了这行
+        """
+        keys = self.re_dispatch.findall(line_content)
+        if not keys and not self.catch_all_parsers:
+            # 绝大部分行不含任何关键字
+            return False
+
+        if self.dispatch_hidden:
+            # 补上被找到的关键字遮住的关键字，新补上的也可能遮住别的
+            for key in keys:
+                for other in self.dispatch_hidden.get(key, ()):
+                    if other not in keys and other in line_content:
+                        keys.append(other)
+
+        if self.STARTUP_KEY in keys:
+            m = self.re_startup.match(line_content)
+            if m:   # 检测到网关重启
+                logging.debug(u'  Gateway startup at {datetime}'.format(datetime=line_time, **m.groupdict()))
+
+                d = m.groupdict()
+                d['datetime'] = line_time
+
+                for parser in self.parsers:
+                    parser.on_startup(**d)
+
+                return True
+
+        if len(keys) == 1 and not self.catch_all_parsers:
+            # 最常见的情况
+            candidates = self.dispatch.get(keys[0], ())
+        else:
+            candidates = list(self.catch_all_parsers)
+            for key in set(keys):
+                candidates.extend(self.dispatch.get(key, ()))
+            candidates.sort(key=lambda c: c[:2])
+
+        text = None
+        matched = False
+        for _, _, parser, key, raw, exclusive in candidates:
+            if matched and exclusive:
+                continue
+
+            if raw:
+                content = line_content
+            else:
+                if text is None:
+                    text = self.decoder.decode(line_content)
+                content = text
+
+            if parser.parse(line_time, content, key):
+                matched = True
+
+        return matched
+
+    def parse(self, progress_callback=None, jobs=1):
         """解释一个日志文件
 
         :progress_callback: 进度回调。两个参数：总字节数，当前字节数
+        :jobs: 并行处理的进程数。大于1时把文件分块，由多个进程处理后合并
         :returns: 无
         """
-        last_line_time = None
-
         logging.info(u'Analyzing log file "{0}"...'.format(self.filename))
+        parse_begin = timer()
+
+        # 并行处理时各块都从未处理过的状态开始
+        fresh_state = pickle.dumps(self, pickle.HIGHEST_PROTOCOL) if jobs > 1 else None
+
+        if len(self.segments) > 1 or detect_compression(self.filename):
+            self.parse_segments(fresh_state, jobs, progress_callback)
+            return self.finish_parse(parse_begin)
 
         with open(self.filename, 'rb') as f:
-            file_size = 0
-
-            if 'seekable' in dir(f):
-                # 取文件长度
-                f.seek(0, os.SEEK_END)
-                file_size = f.tell()
-                f.seek(0, os.SEEK_BEGIN)
-
-            line_num = 0
-            last_encoding_idx = 0
-            encoding_count = len(self.log_encodings)
-
-            for line in f:
-                line_num += 1
-
-                # 尝试每种编码，从上次成功的开始尝试
-                for i in xrange(encoding_count):
-                    try:
-                        encoding_idx = (last_encoding_idx + i) % encoding_count
-                        line = line.decode(self.log_encodings[encoding_idx])
-
-                        if i > 0:
-                            logging.debug(u'    Encoding is changed from {0} to {1}'.format(
-                                self.log_encodings[last_encoding_idx], self.log_encodings[encoding_idx]))
-                            last_encoding_idx = encoding_idx
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            reader = map_file(f)
+
+            begin = self.load_cache(f, file_size) if self.use_cache else None
+            resumed = begin is not None
+            if not resumed:
+                begin = self.seek_time(f, self.from_us)
+
+            # 最后不完整的一行可能还在写，不记入缓存
+            end = self.complete_size(f, file_size) if self.use_cache else file_size
+
+            if self.stopped or begin >= end:
+                pass
+            elif jobs > 1:
+                self.parse_parallel(f, fresh_state, jobs, begin, end, resumed, progress_callback)
+            else:
+                reader.seek(begin)
+                self.parse_lines(
+                    reader, end,
+                    on_block=(lambda: progress_callback(file_size, reader.tell())) if progress_callback else None)
+
+            if self.use_cache:
+                self.save_cache(f, end)
+
+            if end < file_size and not self.stopped:
+                reader.seek(end)
+                self.parse_lines(reader)
+
+            if reader is not f:
+                reader.close()
+
+        return self.finish_parse(parse_begin)
+
+    def finish_parse(self, parse_begin):
+        """结束 parse() ，返回分析结果
+
+        :parse_begin: 开始处理的时间，用于统计耗时
+        :returns: get_result() 的结果
+        """
+        result = self.get_result()
+        if self.profiler:
+            self.profiler.get('parse').add(timer() - parse_begin)
+
+        return result
+
+    def parse_segments(self, state, jobs, progress_callback=None):
+        """依次处理轮转的各段日志，压缩的边读边解压
+
+        各段连成一个日志，分析器的状态（如未断开的连接）延续到下一段。
+        不能随机访问，不按时间定位，也不使用时间索引和解析缓存。
+        jobs大于1且有多段时，各段由多个进程分别处理后合并。
+
+        :state: 未处理过任何行的TgwLogParser的pickle串，并行处理时各段都从此状态开始
+        :jobs: 进程数
+        :progress_callback: 进度回调。两个参数：各段文件的总字节数，已处理的字节数。压缩文件按压缩后的大小
+        :returns: 无
+        """
+        if self.use_index or self.use_cache:
+            logging.warning(u'  Time index and cache are not used for compressed or rotated logs')
+        if len(self.segments) > 1:
+            logging.info(u'  Log segments: {0}'.format(u', '.join(self.segments)))
+
+        sizes = [os.path.getsize(filename) for filename in self.segments]
+        total = sum(sizes)
+
+        if jobs > 1 and len(self.segments) > 1:
+            logging.info(u'  Parsing {0} segments with {1} processes...'.format(len(self.segments), jobs))
+
+            pool = multiprocessing.Pool(min(jobs, len(self.segments)))
+            try:
+                tasks = [(state, filename, i == 0) for i, filename in enumerate(self.segments)]
+                for i, chunk in enumerate(pool.imap(parse_segment, tasks)):
+                    self.merge(chunk)
+
+                    if progress_callback:
+                        progress_callback(total, sum(sizes[:i + 1]))
+
+                    if self.stopped:
+                        # 已经超出时间区间，后面各段的结果不要
                         break
-                    except Exception as e:
-                        pass
-                else:
-                    logging.warning(u'  Error decoding line #{0}: {1}'.format(line_num, e))
+            finally:
+                pool.terminate()
+                pool.join()
+
+            return
+
+        done = 0
+        for filename, size in zip(self.segments, sizes):
+            self.parse_stream(
+                filename,
+                (lambda position: progress_callback(total, done + position)) if progress_callback else None)
+            done += size
+
+            if self.stopped:
+                break
+
+    def parse_stream(self, filename, progress_callback=None):
+        """从头到尾顺序处理一个日志文件，压缩的边读边解压
+
+        :filename: 日志文件名
+        :progress_callback: 进度回调，每读一块调用一次。一个参数：已读的（压缩后的）字节数
+        :returns: 无
+        """
+        stream = LogStream(filename)
+        try:
+            self.parse_lines(
+                stream.file,
+                on_block=(lambda: progress_callback(stream.position())) if progress_callback else None)
+        finally:
+            stream.close(complete=not self.stopped)
+
+    @staticmethod
+    def complete_size(f, file_size):
+        """文件中最后一个完整的行（以换行结束）之后的位置
+
+        :f: 以'rb'方式打开的文件
+        :file_size: 文件长度
+        :returns: 位置
+        """
+        pos = file_size
+        while pos > 0:
+            size = min(pos, SEEK_BLOCK_SIZE)
+            f.seek(pos - size)
+            i = f.read(size).rfind('\n')
+            if i >= 0:
+                return pos - size + i + 1
+
+            pos -= size
+
+        return 0
+
+    def file_identity(self, f, offset):
+        """文件前offset字节的标识，用于判断文件是否被替换、截断或改写
+
+        :f: 以'rb'方式打开的文件
+        :offset: 位置
+        :returns: (inode, 文件开头的摘要, offset之前的摘要)
+        """
+        f.seek(0)
+        head = f.read(min(offset, CACHE_CHECK_SIZE))
+        f.seek(max(offset - CACHE_CHECK_SIZE, 0))
+        tail = f.read(min(offset, CACHE_CHECK_SIZE))
+
+        return (
+            os.fstat(f.fileno()).st_ino,
+            hashlib.md5(head).hexdigest(),
+            hashlib.md5(tail).hexdigest(),
+        )
+
+    def log_identity(self):
+        """日志的标识：第一段文件的inode及开头的摘要（见 file_identity() ），日志增长后不变
+
+        :returns: [inode, 摘要]
+        """
+        with open(self.segments[0], 'rb') as f:
+            return list(self.file_identity(f, CACHE_CHECK_SIZE)[:2])
+
+    def cache_settings(self):
+        """影响解析结果的设置。和缓存中的不同时缓存失效"""
+        return (
+            CACHE_VERSION,
+            tuple(self.log_encodings),
+            self.from_us,
+            self.to_us,
+            self.streaming,
+            tuple((type(parser).__name__, parser.parser_name) for parser in self.parsers),
+            json.dumps(self.rules, sort_keys=True),
+        )
+
+    def load_cache(self, f, file_size):
+        """读取解析缓存，恢复上次处理完时的状态
+
+        :f: 以'rb'方式打开的日志文件
+        :file_size: 文件长度
+        :returns: 上次处理到的位置。缓存不存在或已失效时返回None
+        """
+        if not os.path.exists(self.cache_filename):
+            return None
+
+        try:
+            with open(self.cache_filename, 'rb') as cache_file:
+                cache = pickle.load(cache_file)
+
+            offset = cache['offset']
+            if cache['settings'] != self.cache_settings():
+                logging.info(u'  Settings changed, ignoring cache "{0}"'.format(self.cache_filename))
+                return None
+            elif offset > file_size or cache['identity'] != self.file_identity(f, offset):
+                logging.info(u'  Log file is truncated or replaced, ignoring cache "{0}"'.format(self.cache_filename))
+                return None
+        except Exception as e:
+            logging.warning(u'  Error loading cache "{0}": {1}'.format(self.cache_filename, e))
+            return None
+
+        state = cache['state']
+        self.first_time = state['first_time']
+        self.last_time = state['last_time']
+        self.line_count = state['line_count']
+        self.stopped = state['stopped']
+        self.parsers = state['parsers']
+        self.init_dispatch()
+
+        logging.info(u'  Resuming from offset {0} of {1}'.format(offset, file_size))
+        return offset
+
+    def save_cache(self, f, offset):
+        """保存处理到offset时的状态，保存失败只记录警告
+
+        :f: 以'rb'方式打开的日志文件
+        :offset: 已处理到的位置
+        :returns: 无
+        """
+        cache = {
+            'settings'  : self.cache_settings(),
+            'identity'  : self.file_identity(f, offset),
+            'offset'    : offset,
+            'state'     : {
+                'first_time'    : self.first_time,
+                'last_time'     : self.last_time,
+                'line_count'    : self.line_count,
+                'stopped'       : self.stopped,
+                'parsers'       : self.parsers,
+            },
+        }
+
+        # 先写临时文件，避免中断时留下不完整的缓存
+        temp_filename = self.cache_filename + '.tmp'
+        try:
+            with open(temp_filename, 'wb') as cache_file:
+                pickle.dump(cache, cache_file, pickle.HIGHEST_PROTOCOL)
 
-                m = self.re_line.match(line)
+            if os.path.exists(self.cache_filename):
+                os.remove(self.cache_filename)
+            os.rename(temp_filename, self.cache_filename)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            logging.warning(u'  Error saving cache "{0}": {1}'.format(self.cache_filename, e))
+
+    def seek_time(self, f, time_of_day):
+        """找第一个时间不早于time_of_day的行的开始位置
+
+        日志时间基本是递增的，按位置二分查找，不用从头处理。
+        使用时间索引时先由索引缩小范围。
+
+        :f: 以'rb'方式打开的文件
+        :time_of_day: 当天的微秒数
+        :returns: 该行的开始位置，在此之前的行都早于time_of_day。没有则为文件长度
+        """
+        if time_of_day <= 0:
+            return 0
+
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+
+        begin, end = 0, file_size
+        if self.use_index:
+            index = TimeIndex(self.filename)
+            index.load(f)
+            if index.update(f, file_size) or not os.path.exists(index.index_filename):
+                index.save()
+            begin, end = index.lookup(time_of_day, file_size)
+
+        while end - begin > SEEK_BLOCK_SIZE:
+            middle = (begin + end) // 2
+            line = TimeIndex.line_at(f, middle, end)
+            if line is None or line[1] % DateTime.US_PER_DAY >= time_of_day:
+                end = middle
+            else:
+                begin = line[0]
+
+        # 剩下的范围不大，顺序找到确切的行
+        while True:
+            line = TimeIndex.line_at(f, begin, file_size)
+            if line is None:
+                begin = file_size
+                break
+            elif line[1] % DateTime.US_PER_DAY >= time_of_day:
+                begin = line[0]
+                break
+
+            begin = line[0] + 1
+
+        logging.debug(u'  Seek to offset {0} for time {1}'.format(begin, time_of_day))
+        return begin
+
+    def parse_lines(self, f, end=None, on_block=None):
+        """处理文件中从当前位置开始的各行
+
+        按 PARSE_BLOCK_SIZE 逐块读取，每块检测一次编码。行在解码前按字节匹配，
+        绝大部分行不会被解码。
+
+        不按时间过滤、也没有处理每一行的分析器，且块中要分派的行不多时，只对整块计数行数，
+        用关键字在整块中找出要分派的行（见 prefilter() ），其他行不再逐行处理。
+
+        :f: 以'rb'方式打开的文件， map_file() 的结果，或 LogStream.file
+        :end: 处理到此字节位置（不含）之前开始的行为止。None表示到文件末尾
+        :on_block: 每读一块调用一次，无参数，用于报告进度
+        :returns: 无
+        """
+        # 管道不能tell()，处理到末尾时也用不着位置
+        offset = f.tell() if end is not None else 0
+        filtered = self.from_us > 0 or self.to_us < DateTime.US_PER_DAY - 1
+        use_prefilter = not filtered and not self.catch_all_parsers
+
+        match_line = self.re_line.match
+        count_lines = self.count_lines
+        prefilter = self.prefilter
+        to_epoch = DateTime.to_epoch
+        detect = self.decoder.detect
+        dispatch_line = self.dispatch_line
+        if self.profiler:
+            # 只在统计耗时时换成统计的版本，平时没有额外开销
+            match_line = self.profiler.wrap('re_line', match_line)
+            count_lines = self.profiler.wrap('re_line', count_lines)
+            prefilter = self.profiler.wrap('prefilter', prefilter)
+            to_epoch = self.profiler.wrap('timestamp', to_epoch)
+            detect = self.profiler.wrap('detect encoding', detect)
+            dispatch_line = self.profiler.wrap('dispatch', dispatch_line)
+
+        while end is None or offset < end:
+            block = f.read(PARSE_BLOCK_SIZE if end is None else min(PARSE_BLOCK_SIZE, end - offset))
+            if not block:
+                break
+            if not block.endswith('\n'):
+                # 补全块的最后一行
+                block += f.readline()
+            offset += len(block)
+
+            detect(block)
+
+            if on_block:
+                on_block()
+
+            if use_prefilter and self.sparse(block):
+                count = count_lines(block)
+                if not count:
+                    continue
+
+                self.line_count += count
+                if not self.first_time:
+                    self.first_time = to_epoch(self.re_block_line.search(block).group('datetime'))
+                self.last_time = self.last_line_time(block)
+
+                for m in prefilter(block):
+                    dispatch_line(to_epoch(m.group('datetime')), m.group('content'))
+
+                continue
+
+            for line in block.split('\n'):
+                m = match_line(line)
                 if not m:
                     continue
 
-                line_time = pd.to_datetime(m.group('datetime'))
+                line_time = to_epoch(m.group('datetime'))
                 line_content = m.group('content')
 
                 # 根据时间过滤日志行
-                t = line_time.time()
-                if t < self.from_time:
+                t = line_time % DateTime.US_PER_DAY
+                if t < self.from_us:
                     # 跳过未到时间的日志
                     continue
-                elif t > self.to_time:
+                elif t > self.to_us:
                     # 不再处理时间区间外的日志
-                    break
+                    self.stopped = True
+                    return
 
                 self.line_count += 1
 
-                if last_line_time is None:   # 首行
+                if not self.first_time:   # 首行
                     self.first_time = line_time
 
-                last_line_time = line_time
+                self.last_time = line_time
 
-                m = self.re_startup.match(line_content)
-                if m:   # 检测到网关重启
-                    logging.debug(u'  Gateway startup at {datetime}'.format(datetime=line_time, **m.groupdict()))
+                dispatch_line(line_time, line_content)
 
-                    d = m.groupdict()
-                    d['datetime'] = line_time
+    def count_lines(self, block):
+        """块中带时间的行数，即re_line能匹配的行数"""
+        return len(self.re_block_line_start.findall(block)) + bool(self.re_block_line.match(block))
 
-                    for parser in self.parsers:
-                        parser.on_startup(**d)
+    def last_line_time(self, block):
+        """块中最后一个带时间的行的时间，没有则为0"""
+        pos = len(block)
+        while pos > 0:
+            start = block.rfind('\n', 0, pos - 1) + 1
+            m = self.re_block_line.match(block, start)
+            if m:
+                return DateTime.to_epoch(m.group('datetime'))
+            pos = start
 
-                    continue
+        return 0
 
-                for parser in self.parsers:
-                    if parser.parse(line_time, line_content):
-                        break
+    def sparse(self, block):
+        """根据块开头的一段估计块中要分派的行是否不多，此时 prefilter() 比逐行处理快"""
+        size = min(len(block), PREFILTER_SAMPLE_SIZE)
+        hits = sum(block.count(key, 0, size) for key in self.dispatch_keys)
+        return hits <= block.count('\n', 0, size) * PREFILTER_MAX_RATIO
+
+    def prefilter(self, block):
+        """用分派的关键字在整块中找出可能有分析器处理的行
+
+        对每个关键字用 str.find() 查找，比用re_dispatch逐个位置尝试快得多。
+
+        :block: 日志块的字节串
+        :returns: 这些行的re_block_line匹配结果的list，按行的顺序
+        """
+        find = block.find
+        rfind = block.rfind
+        starts = set()
+        for key in self.dispatch_keys:
+            i = find(key)
+            while i >= 0:
+                starts.add(rfind('\n', 0, i) + 1)
+
+                # 同一行中不用再找这个关键字
+                line_end = find('\n', i)
+                if line_end < 0:
+                    break
+                i = find(key, line_end)
+
+        block_line_match = self.re_block_line.match
+        return [m for m in (block_line_match(block, start) for start in sorted(starts)) if m]
 
-            if not last_line_time is None:   # 有末行
-                self.last_time = last_line_time
+    def parse_parallel(self, f, state, jobs, begin, end, continuation=False, progress_callback=None):
+        """把文件按行边界分块，用多个进程处理后按顺序合并
 
+        :f: 以'rb'方式打开的文件
+        :state: 未处理过任何行的TgwLogParser的pickle串，各块都从此状态开始
+        :jobs: 进程数
+        :begin: 开始位置
+        :end: 结束位置
+        :continuation: begin之前是否已经有处理过的状态
+        :progress_callback: 进度回调。两个参数：总字节数，当前字节数
+        :returns: 无
+        """
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+
+        # 只处理时间区间内的部分
+        stop_at_end = False
+        if self.to_us + 1 < DateTime.US_PER_DAY:
+            window_end = max(self.seek_time(f, self.to_us + 1), begin)
+            if window_end < end:
+                end = window_end
+                stop_at_end = True
 
-        return self.get_result()
+        # 多分几块，各进程的负载更均衡
+        chunks = self.split_chunks(f, begin, end, jobs * 4)
+
+        logging.info(u'  Parsing {0} chunks with {1} processes...'.format(len(chunks), jobs))
+
+        pool = multiprocessing.Pool(jobs)
+        try:
+            tasks = [(state, begin, end, i == 0 and not continuation) for i, (begin, end) in enumerate(chunks)]
+            for chunk, (begin, end) in zip(pool.imap(parse_chunk, tasks), chunks):
+                self.merge(chunk)
+
+                if progress_callback:
+                    progress_callback(file_size, end)
+
+                if self.stopped:
+                    # 已经超出时间区间，后面各块的结果不要
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if stop_at_end:
+            self.stopped = True
+
+    @staticmethod
+    def split_chunks(f, begin, end, count):
+        """把文件中[begin, end)的部分按行边界分成大约count块
+
+        :f: 以'rb'方式打开的文件
+        :returns: [(块开始位置, 块结束位置)]
+        """
+        offsets = [begin]
+        for i in xrange(1, count):
+            pos = begin + (end - begin) * i // count
+            if pos <= offsets[-1]:
+                continue
+
+            # 从前一个字节开始找换行，pos刚好是行首时块就从pos开始
+            f.seek(pos - 1)
+            f.readline()
+            pos = f.tell()
+            if pos >= end:
+                break
+            if pos > offsets[-1]:
+                offsets.append(pos)
+
+        offsets.append(end)
+        return zip(offsets[:-1], offsets[1:])
+
+    def merge(self, other):
+        """合并处理紧接在后面一块日志的 TgwLogParser 的状态
+
+        :other: 处理后一块日志的 TgwLogParser
+        :returns: 无
+        """
+        if other.line_count:
+            if not self.first_time:
+                self.first_time = other.first_time
+            self.last_time = other.last_time
+        self.line_count += other.line_count
+        self.stopped = other.stopped
+        if self.profiler and other.profiler:
+            self.profiler.merge(other.profiler)
+
+        for parser, other_parser in zip(self.parsers, other.parsers):
+            parser.merge(other_parser)
 
     def get_result(self):
         result = {}
         result['summary'] = {
             'filename'   : self.filename,
-            'first_time' : self.first_time,
-            'last_time'  : self.last_time,
+            'first_time' : DateTime.to_datetime(self.first_time),
+            'last_time'  : DateTime.to_datetime(self.last_time),
             'line_count' : self.line_count,
+            'identity'   : self.log_identity(),
         }
+        if self.rules:
+            result['summary']['rules'] = [rule['name'] for rule in self.rules]
 
         for parser in self.parsers:
-            result[parser.parser_name] = parser.finish()
+            with profile_util.time(self.profiler, 'finish:' + parser.parser_name):
+                result[parser.parser_name] = parser.finish()
+
+        if self.profiler:
+            result['profile'] = self.profiler
 
         logging.info(u'  Done')
 
         return result
 
 
+class TgwLogFollower(TgwLogParser):
+
+    """跟踪增长中的日志文件（类似tail -F），给出状态日志耗时的滚动统计和实时的连接事件
+
+    只保留时间窗口内的状态块和未取走的事件，内存占用不随日志增长。
+    """
+
+    def __init__(self, filename, encoding, window=DEFAULT_FOLLOW_WINDOW * 60):
+        """构造函数
+
+        :filename: 要跟踪的日志文件名
+        :encoding: 日志文件的字符编码。可以为list，会依次用
+        :window: 滚动统计的时间窗口，秒
+        """
+        self.window = window
+        super(TgwLogFollower, self).__init__(filename, encoding, datetime.time.min, datetime.time.max)
+        #: 上次取走滚动统计时最后一行的时间，见 rolling_stats()
+        self.reported_time = 0
+
+    def create_parsers(self):
+        #: 状态日志耗时的滚动统计
+        self.status_parser = RollingStatusParser('status', self.window * 1000000)
+        #: 连接事件
+        self.connection_parser = ConnectionEventParser('connections')
+
+        replacements = {
+            self.status_parser.parser_name      : self.status_parser,
+            self.connection_parser.parser_name  : self.connection_parser,
+        }
+        return tuple(
+            replacements.get(parser.parser_name, parser)
+            for parser in super(TgwLogFollower, self).create_parsers())
+
+    def reset_status(self):
+        """日志文件被轮转或截断后，重新开始状态日志耗时的滚动统计
+
+        新文件的时间可能比旧文件最后的时间早，按时间丢弃不掉旧文件的状态块，所以换一个新的分析器。
+        """
+        self.status_parser = RollingStatusParser('status', self.window * 1000000)
+        self.parsers = tuple(
+            self.status_parser if parser.parser_name == self.status_parser.parser_name else parser
+            for parser in self.parsers)
+        self.init_dispatch()
+        self.last_time = 0
+        self.reported_time = 0
+
+    def rolling_stats(self):
+        """取走状态日志耗时的滚动统计
+
+        :returns: RollingStatusParser.rolling_summary() 的结果，另有time 最后一行的时间。
+            还没有处理过日志行，或自上次取走以来没有新的行时为None，不重复输出同样的统计
+        """
+        if not self.last_time or self.last_time == self.reported_time:
+            return None
+
+        self.reported_time = self.last_time
+        stats = self.status_parser.rolling_summary()
+        stats['time'] = self.last_time
+        return stats
+
+    def follow(self, callback, interval=DEFAULT_FOLLOW_INTERVAL, from_start=False):
+        """跟踪日志文件，直到被中断（Ctrl-C）
+
+        日志文件被轮转（同名文件换成了新文件）或截断后，从新文件的开头继续。
+
+        :callback: 回调。两个参数：连接事件的list，状态日志耗时的滚动统计（见 rolling_stats() ）。
+            有新事件时或每隔interval秒有新的行时调用，不到输出统计的时候或没有新的行时统计为None
+        :interval: 输出滚动统计的间隔，秒
+        :from_start: 是否从文件开头开始处理，否则只处理新增的行
+        :returns: 无
+        """
+        logging.info(u'Following log file "{0}"...'.format(self.filename))
+
+        f = None
+        # 文件末尾不完整的一行，等写完后再处理
+        partial = ''
+        next_report = time.time() + interval
+
+        try:
+            while True:
+                if f is None:
+                    f = self.open_log(from_start)
+                    partial = ''
+                    # 以后出现的新文件都从头处理
+                    from_start = True
+
+                data = f.read(FOLLOW_READ_SIZE) if f else ''
+                if data:
+                    data = partial + data
+                    end = data.rfind('\n') + 1
+                    partial = data[end:]
+                    self.parse_lines(io.BytesIO(data[:end]))
+                elif f and self.rotated(f):
+                    logging.info(u'  Log file "{0}" is rotated or truncated'.format(self.filename))
+                    if partial:
+                        self.parse_lines(io.BytesIO(partial))
+                    f.close()
+                    f = None
+                    self.reset_status()
+                    continue
+                else:
+                    time.sleep(FOLLOW_POLL_INTERVAL)
+
+                events = self.connection_parser.pop_events()
+                stats = self.rolling_stats() if time.time() >= next_report else None
+                if stats:
+                    next_report = time.time() + interval
+
+                if events or stats:
+                    callback(events, stats)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if f:
+                f.close()
+
+    def open_log(self, from_start):
+        """打开日志文件
+
+        :from_start: 是否从文件开头处理，否则定位到文件末尾
+        :returns: 文件对象。文件不存在时返回None
+        """
+        try:
+            # 内置的file读到文件末尾后留下stdio的EOF标志，之后追加的内容也读不到，用io模块的文件
+            f = io.open(self.filename, 'rb')
+        except IOError:
+            return None
+
+        if not from_start:
+            f.seek(0, os.SEEK_END)
+
+        return f
+
+    def rotated(self, f):
+        """日志文件是否已被轮转或截断
+
+        :f: 正在读的文件
+        :returns: 同名文件已换成新文件，或长度比已读的位置小时返回True
+        """
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            # 旧文件已改名，新文件还没建立
+            return False
+
+        return stat.st_ino != os.fstat(f.fileno()).st_ino or stat.st_size < f.tell()
+
+
+def parse_chunk(args):
+    """在子进程中处理日志文件的一块
+
+    :args: (未处理过的TgwLogParser的pickle串, 块开始位置, 块结束位置, 是否首块)
+    :returns: 处理后的TgwLogParser
+    """
+    state, begin, end, first = args
+    parser = pickle.loads(state)
+
+    if not first:
+        for p in parser.parsers:
+            p.begin_chunk()
+
+    with open(parser.filename, 'rb') as f:
+        reader = map_file(f)
+        reader.seek(begin)
+        parser.parse_lines(reader, end)
+        if reader is not f:
+            reader.close()
+
+    return parser
+
+
+def parse_segment(args):
+    """在子进程中处理轮转日志的一段
+
+    :args: (未处理过的TgwLogParser的pickle串, 段的文件名, 是否第一段)
+    :returns: 处理后的TgwLogParser
+    """
+    state, filename, first = args
+    parser = pickle.loads(state)
+
+    if not first:
+        for p in parser.parsers:
+            p.begin_chunk()
+
+    parser.parse_stream(filename)
+    return parser
+
+
+def detect_compression(f):
+    """根据文件头判断日志文件的压缩格式
+
+    :f: 文件名，或以'rb'方式打开的文件（读后回到开头）
+    :returns: COMPRESSIONS 中的一项，未压缩时为None
+    """
+    if isinstance(f, basestring):
+        with open(f, 'rb') as f:
+            return detect_compression(f)
+
+    head = f.read(max(len(magic) for _, magic, _, _ in COMPRESSIONS))
+    f.seek(0)
+
+    for compression in COMPRESSIONS:
+        if head.startswith(compression[1]):
+            return compression
+
+    return None
+
+
+class LogStream(object):
+
+    """顺序读取日志文件，压缩的边读边解压
+
+    压缩文件由外部解压命令在另一个进程中解压，解压和分析同时进行；
+    gzip没有可用的解压命令时用gzip模块解压。
+    """
+
+    def __init__(self, filename):
+        """构造函数
+
+        :filename: 日志文件名
+        """
+        self.filename = filename
+        self.raw = open(filename, 'rb')
+        #: 解压进程，没有时为None
+        self.process = None
+
+        compression = detect_compression(self.raw)
+        if compression is None:
+            #: 读取解压后内容的文件对象
+            self.file = self.raw
+            return
+
+        name, _, _, commands = compression
+        for command in commands:
+            if find_executable(command[0]):
+                # 解压进程和本进程共用文件位置， position() 可以得到它读到了哪里
+                self.process = subprocess.Popen(command, stdin=self.raw, stdout=subprocess.PIPE, bufsize=-1)
+                self.file = self.process.stdout
+                break
+        else:
+            if name != 'gzip':
+                self.raw.close()
+                raise IOError(u'Cannot decompress "{0}": command "{1}" not found'.format(filename, commands[0][0]))
+
+            self.file = gzip.GzipFile(fileobj=self.raw, mode='rb')
+
+    def position(self):
+        """已读取的原文件字节数"""
+        return os.lseek(self.raw.fileno(), 0, os.SEEK_CUR)
+
+    def close(self, complete=True):
+        """关闭文件，结束解压进程
+
+        :complete: 是否已读到末尾。没有读完时直接结束解压进程
+        :returns: 无
+        """
+        self.file.close()
+        if self.process:
+            if not complete and self.process.poll() is None:
+                self.process.kill()
+
+            returncode = self.process.wait()
+            if complete and returncode:
+                logging.warning(u'  Error decompressing "{0}", exit code {1}'.format(self.filename, returncode))
+
+        self.raw.close()
+
+
+def group_rotated(filenames):
+    """把同一日志轮转出的各段文件分为一组
+
+    轮转出的文件名是原文件名加序号（tgw.log.1，越大越早）或日期（tgw.log-20161212），
+    可能还有压缩的扩展名（tgw.log.2.gz）。原文件本身是最新的一段。
+
+    :filenames: 文件名列表
+    :returns: 各组的list，按各组第一次出现的顺序。组内为各段的文件名，按时间顺序；只有一段时就是文件名
+    """
+    extensions = '|'.join(re.escape(extension) for _, _, extension, _ in COMPRESSIONS)
+    re_rotated = re.compile(r'^(?P<base>.+?)(?:[.-](?P<suffix>\d+))?(?:' + extensions + r')?$')
+
+    def order(suffix):
+        if suffix is None:
+            return (1, 0)
+        elif len(suffix) >= 8:
+            # 日期
+            return (0, int(suffix))
+        else:
+            return (0, -int(suffix))
+
+    groups = OrderedDict()
+    for filename in filenames:
+        m = re_rotated.match(filename)
+        groups.setdefault(m.group('base'), list()).append((order(m.group('suffix')), filename))
+
+    return [
+        [filename for _, filename in sorted(group)] if len(group) > 1 else group[0][1]
+        for group in groups.itervalues()
+    ]
+
+
+def map_file(f):
+    """把文件只读映射到内存
+
+    mmap有和文件一样的read()、readline()、seek()、tell()，可以代替文件交给
+    TgwLogParser.parse_lines() ，读取时少一次复制。空文件不能映射，返回文件本身。
+
+    :f: 以'rb'方式打开的文件
+    :returns: mmap或f
+    """
+    if not os.fstat(f.fileno()).st_size:
+        return f
+
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def expand_log_files(paths):
+    """展开命令行中的日志文件参数
+
+    :paths: 文件名、通配符或目录的列表。目录取其中的所有文件
+    :returns: 按参数顺序排列、去掉重复的文件名列表
+    """
+    filenames = list()
+    for path in paths:
+        if os.path.isdir(path):
+            names = sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if os.path.isfile(os.path.join(path, name)))
+        elif glob.has_magic(path):
+            names = sorted(name for name in glob.glob(path) if os.path.isfile(name))
+        else:
+            names = [path]
+
+        if not names:
+            logging.warning(u'  No log file matches "{0}"'.format(path))
+
+        for name in names:
+            if name not in filenames:
+                filenames.append(name)
+
+    return filenames
+
+
+def parse_file(args):
+    """在子进程中分析一个日志文件
+
+    :args: (文件名或轮转的各段文件名的list, TgwLogParser构造函数的其他参数dict)
+    :returns: 分析结果。出错时返回None
+    """
+    filename, kwargs = args
+    try:
+        return TgwLogParser(filename, **kwargs).parse()
+    except Exception:
+        logging.exception(u'  Error analyzing log file "{0}"'.format(filename))
+        return None
+
+
+def parse_files(filenames, jobs=1, **kwargs):
+    """分析多个日志文件
+
+    :filenames: 日志文件名列表。其中一项可以是轮转的各段文件名的list，见 group_rotated()
+    :jobs: 并行处理的进程数，每个进程一次处理一个文件
+    :kwargs: TgwLogParser构造函数的其他参数
+    :returns: 各文件的分析结果列表，顺序和filenames一致。出错的文件为None
+    """
+    tasks = [(filename, kwargs) for filename in filenames]
+    if jobs <= 1:
+        return [parse_file(task) for task in tasks]
+
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        return pool.map(parse_file, tasks, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def build_timeline(result, interval):
+    """按时间段统计状态日志耗时和连接事件，用于找出网关卡住或频繁断线的时间
+
+    :result: 一个日志文件的分析结果
+    :interval: 时间段长度，微秒
+    :returns: Result，每个有状态块或连接事件的时间段一行：datetime 开始时间，
+        count 状态块个数，mean、p90、max 状态块耗时（微秒），
+        connects、failures、closes 连接成功、失败、断开（含登录失败）次数。
+        状态日志流式统计时没有每个状态块的耗时，状态块的各列都为0，summary['status']为False
+    """
+    groups = list()
+
+    status = result['status']
+    has_status = status.stats is None
+    if has_status:
+        stats = timeline.bucket_stats(status.column('begin'), status.durations(), interval)
+        start = stats.pop('start')
+        for name in ('mean', 'p90'):
+            stats[name] = np.round(stats[name]).astype(np.int64)
+        stats['max'] = stats['max'].astype(np.int64)
+        groups.append((start, stats))
+
+    conns = result['connections']
+    connect_time = conns.column('connect_time')
+    close_time = conns.column('close_time')
+    conn_status = conns.column('status')
+    for name, times in (
+            ('connects', connect_time[connect_time != 0]),
+            ('failures', close_time[conn_status == 'failed']),
+            ('closes', close_time[(conn_status == 'closed') | (conn_status == 'logout')])):
+        start, counts = timeline.bucket_counts(times, interval)
+        groups.append((start, {name: counts}))
+
+    starts, columns = timeline.align(*groups)
+    names = ['datetime', 'count', 'mean', 'p90', 'max', 'connects', 'failures', 'closes']
+    store = ColumnStore.from_arrays(
+        names,
+        [starts] + [columns.get(name, np.zeros(len(starts), dtype=np.int64)) for name in names[1:]])
+
+    return Result(
+        {'interval': interval, 'interval_name': timeline.format_interval(interval), 'status': has_status},
+        store)
+
+
+def gateway_version(result):
+    """日志中第一次启动记录的网关版本，没有时为None"""
+    version = result['version'].first_row()
+    return version['version'] if version is not None else None
+
+
+def detect_anomalies(result, baselines=None):
+    """和基线比较，找出状态日志耗时异常（网关卡住）的时段，方法见 anomaly.stall_windows()
+
+    :result: 一个日志文件的分析结果
+    :baselines: anomaly.Baselines ，用其中本日志网关版本的基线。
+        None或其中没有足够的数据时以本日志自身的耗时为基线
+    :returns: Result，每个时段一行：datetime、end 开始、结束时间，
+        first、last 第一个、最后一个异常状态块在details中的位置，statuses 状态块数，
+        mean、max 平均、最长耗时（微秒），peak_z 最大的z值。
+        summary：status 同 build_timeline() ，version 网关版本，stored 是否用保存的基线，
+        baseline 基线的统计，limits 报告中平均、90%、最长耗时的警告阈值
+    """
+    status = result['status']
+    has_status = status.stats is None
+    durations = status.durations() if has_status else np.array([], dtype=np.int64)
+
+    version = gateway_version(result)
+    stored = baselines.get(version, BASELINE_MIN_COUNT) if baselines is not None and version else None
+    if stored is not None:
+        baseline = stored.summary()
+        limits = {'mean': baseline['p90'], 'p90': baseline[ANOMALY_QUANTILE], 'max': baseline['max']}
+    else:
+        baseline = summary(durations, ddof=1)
+        baseline[ANOMALY_QUANTILE] = np.percentile(durations, float(ANOMALY_QUANTILE[1:])) if len(durations) else 0
+        limits = dict(STATUS_WARNING_LIMITS)
+
+    windows = anomaly.stall_windows(
+        durations, ANOMALY_WINDOW, baseline, ANOMALY_Z_LIMIT, ANOMALY_EXCEEDANCE_LIMIT, ANOMALY_QUANTILE,
+        ANOMALY_MIN_STATUSES)
+    first, last = windows['first'], windows['last']
+    store = ColumnStore.from_arrays(
+        ['datetime', 'end', 'first', 'last', 'statuses', 'mean', 'max', 'peak_z'],
+        [status.column('begin')[first], status.column('end')[last], first, last, last - first + 1, np.round(windows['mean']), windows['max'], windows['peak_z']],
+        kinds={'peak_z': FLOAT})
+
+    return Result(
+        {
+            'status'    : has_status,
+            'version'   : version,
+            'stored'    : stored is not None,
+            'baseline'  : {name: baseline[name] for name in ('count', 'mean', 'std', 'p90', ANOMALY_QUANTILE)},
+            'limits'    : limits,
+        },
+        store, time_columns=('datetime', 'end'))
+
+
+def normal_stats(result, anomalies):
+    """异常时段以外的状态日志耗时的统计，用于更新基线，不把卡住时的耗时算进基线
+
+    :result: 一个日志文件的分析结果
+    :anomalies: detect_anomalies() 的结果
+    :returns: stats_util.StreamingStats 。流式统计时没有每个状态块的耗时，不能去掉异常时段，为None
+    """
+    status = result['status']
+    if status.stats is not None:
+        return None
+
+    durations = status.durations()
+    return StreamingStats.from_values(
+        durations[anomaly.excluded(len(durations), anomalies.column('first'), anomalies.column('last'))])
+
+
+def report_context(result):
+    """模板除分析结果外用到的数据，都已算好，模板中只需逐行输出
+
+    :result: 一个日志文件的分析结果
+    :returns: dict：slowest_statuses 最慢的状态块，
+        slowest_intervals 最慢（按最长耗时）的时间段，failing_intervals 连接失败最多的时间段，
+        后两项在没有 build_timeline() 的结果时为空；
+        status_percentiles 状态日志耗时的summary中90%以外的分位数的(百分位数, 键)，流式统计时才有；
+        stall_windows 耗时异常的时段，status_limits 状态日志耗时的警告阈值，
+        没有 detect_anomalies() 的结果时为空和 STATUS_WARNING_LIMITS ；
+        rule_results 规则文件中各分析器的(名称, 结果)
+    """
+    status = result['status']
+    context = {
+        'slowest_statuses'  : status.largest(status.durations(), STATUS_TOP_N, 'duration'),
+        'status_percentiles': [
+            (percentile, percentile_name(percentile)) for percentile in SUMMARY_PERCENTILES
+            if percentile != 90 and percentile_name(percentile) in status.summary
+        ],
+        'slowest_intervals' : list(),
+        'failing_intervals' : list(),
+        'stall_windows'     : list(),
+        'status_limits'     : STATUS_WARNING_LIMITS,
+        'rule_results'      : [(name, result[name]) for name in result['summary'].get('rules', ()) if name in result],
+    }
+
+    anomalies = result.get('anomalies')
+    if anomalies is not None:
+        context['stall_windows'] = anomalies.rows()
+        context['status_limits'] = anomalies.summary['limits']
+
+    buckets = result.get('timeline')
+    if buckets is not None:
+        if buckets.summary['status']:
+            context['slowest_intervals'] = buckets.largest(buckets.column('max'), TIMELINE_TOP_N, 'max')
+        failures = buckets.column('failures')
+        context['failing_intervals'] = [
+            row for row in buckets.largest(failures, TIMELINE_TOP_N, 'failures') if row['failures']
+        ]
+
+    return context
+
+
+def correlate_failures(results, window):
+    """关联各日志文件（网关）的连接断开、失败，找出同一TCS地址在相近时间内使多个网关断线的事件
+
+    各文件的断开、失败合并后按(TCS地址, 时间)排序，用 timeline.cluster_events() 聚类，
+    不两两比较，日志文件很多时也只是一次排序。
+
+    :results: 各文件的分析结果
+    :window: 同一事件中相邻两次断线相隔的最长时间，微秒
+    :returns: 涉及网关最多的 INCIDENT_TOP_N 个事件的dict的list，按开始时间排序：
+        cs_addr TCS地址，begin、end 第一次、最后一次断线的时间，events 断线次数，failures 其中连接失败的次数，
+        gateways 涉及的网关数，至少为 INCIDENT_MIN_GATEWAYS ，
+        gateway_indexes 涉及的网关的编号（从1开始，即在results中的顺序），最多 INCIDENT_MAX_GATEWAYS 个
+    """
+    all_times, all_addrs, all_failed, all_gateways = list(), list(), list(), list()
+    for i, result in enumerate(results):
+        conns = result['connections']
+        close_time = conns.column('close_time')
+        status = np.asarray(conns.column('status'), dtype=object)
+        failed = status == 'failed'
+        events = (failed | (status == 'closed') | (status == 'logout')) & (close_time != 0)
+
+        all_times.append(close_time[events])
+        all_addrs.append(np.asarray(conns.column('cs_addr'), dtype=object)[events])
+        all_failed.append(failed[events])
+        all_gateways.append(np.full(np.count_nonzero(events), i, dtype=np.int64))
+
+    times = np.concatenate(all_times) if all_times else np.array([], dtype=np.int64)
+    if not len(times):
+        return list()
+
+    addrs, codes = np.unique(np.concatenate(all_addrs), return_inverse=True)
+    order, clusters, firsts = timeline.cluster_events(codes, times, window)
+    codes = codes[order]
+    times = times[order]
+    lasts = np.append(firsts[1:], len(order)) - 1
+    failures = np.add.reduceat(np.concatenate(all_failed)[order].astype(np.int64), firsts)
+
+    # 各簇涉及的网关：(簇号, 网关序号)去重后按簇号排序
+    pairs = np.unique(clusters * len(results) + np.concatenate(all_gateways)[order])
+    pair_clusters = pairs // len(results)
+    gateway_counts = np.bincount(pair_clusters, minlength=len(firsts))
+
+    selected = top_n(gateway_counts, INCIDENT_TOP_N)
+    selected = selected[gateway_counts[selected] >= INCIDENT_MIN_GATEWAYS]
+    selected = selected[np.argsort(times[firsts[selected]], kind='mergesort')]
+
+    incidents = list()
+    for cluster in selected:
+        gateways = pairs[np.searchsorted(pair_clusters, cluster):np.searchsorted(pair_clusters, cluster, 'right')]
+        incidents.append({
+            'cs_addr'           : addrs[codes[firsts[cluster]]],
+            'begin'             : DateTime.to_datetime(times[firsts[cluster]]),
+            'end'               : DateTime.to_datetime(times[lasts[cluster]]),
+            'events'            : lasts[cluster] - firsts[cluster] + 1,
+            'failures'          : failures[cluster],
+            'gateways'          : gateway_counts[cluster],
+            'gateway_indexes'   : [index + 1 for index in gateways[:INCIDENT_MAX_GATEWAYS] % len(results)],
+        })
+
+    return incidents
+
+
+def aggregate_results(results, incident_window=None):
+    """汇总多个日志文件（多个网关）的分析结果
+
+    :results: 各文件的分析结果
+    :incident_window: 见 correlate_failures() 的window，缺省为 DEFAULT_INCIDENT_WINDOW
+    :returns: dict。gateways为各文件的概况，status为所有状态日志耗时的统计及分布，
+        failures为按TCS地址和错误码统计的连接失败次数，
+        incidents为多个网关同时断线的事件，见 correlate_failures()
+    """
+    if incident_window is None:
+        incident_window = timeline.parse_interval(DEFAULT_INCIDENT_WINDOW)
+
+    bucket_edges = [0] + list(LATENCY_BUCKETS) + [np.inf]
+
+    gateways = list()
+    all_durations = list()
+    # 有流式统计的结果时，汇总也用流式统计
+    streaming = any(result['status'].stats is not None for result in results)
+    all_stats = StreamingStats()
+    failures = dict()
+
+    for result in results:
+        stats = result['status'].stats
+        if stats is None:
+            durations = result['status'].column('end') - result['status'].column('begin')
+            buckets = list(np.histogram(durations, bins=bucket_edges)[0])
+            if streaming:
+                all_stats.merge(StreamingStats.from_values(durations))
+            else:
+                all_durations.append(durations)
+        else:
+            buckets = stats.sketch.histogram(bucket_edges)
+            all_stats.merge(stats)
+
+        conns = result['connections'].rows()
+        gateway = {
+            'filename'  : result['summary']['filename'],
+            'first_time': result['summary']['first_time'],
+            'last_time' : result['summary']['last_time'],
+            'line_count': result['summary']['line_count'],
+            'version'   : gateway_version(result) or '',
+            'gw_ids'    : sorted(set(conn['gw_id'] for conn in conns)),
+            'status'    : result['status'].summary,
+            'buckets'   : buckets,
+            'failures'  : 0,
+        }
+        gateways.append(gateway)
+
+        failed = [conn for conn in conns if conn['status'] != 'connected']
+        gateway['failures'] = len(failed)
+
+        for conn in failed:
+            cs_addr, code, reason = conn['cs_addr'], conn['code'], conn['reason']
+            key = (cs_addr, code)
+            if key not in failures:
+                failures[key] = {
+                    'cs_addr'   : cs_addr,
+                    'code'      : code,
+                    'reason'    : reason,
+                    'count'     : 0,
+                    'gateways'  : set(),
+                }
+            failures[key]['count'] += 1
+            failures[key]['gateways'].add(gateway['filename'])
+
+    if streaming:
+        status = all_stats.summary()
+    else:
+        durations = np.concatenate(all_durations) if all_durations else np.array([])
+        status = summary(durations, ddof=1)
+        if len(durations):
+            status['p50'], status['p99'] = np.percentile(durations, [50, 99])
+        else:
+            status['p50'] = status['p99'] = 0
+
+    failures = sorted(failures.values(), key=lambda f: (-f['count'], f['cs_addr'], f['code']))
+    for failure in failures:
+        failure['gateways'] = len(failure['gateways'])
+
+    return {
+        'gateways'      : gateways,
+        'status'        : status,
+        'buckets'       : [sum(counts) for counts in zip(*[gateway['buckets'] for gateway in gateways])] or [0] * (len(bucket_edges) - 1),
+        'bucket_labels' : ['< {0:,}'.format(edge) for edge in LATENCY_BUCKETS] + ['>= {0:,}'.format(LATENCY_BUCKETS[-1])],
+        'failures'      : failures,
+        'incidents'     : correlate_failures(results, incident_window),
+        'incident_window_name': timeline.format_interval(incident_window),
+    }
+
+
+def report_dir_name(index, filename):
+    """多个日志文件时，各文件报告的子目录名"""
+    return u'{0:03}_{1}'.format(index + 1, re.sub(r'[^\w.-]', '_', os.path.basename(filename)))
+
+
+def export_result(result, directory, fmt=None):
+    """把一个日志文件的分析结果导出到目录，供其他工具分析或用 load_result() 读回
+
+    各分析器的details各存为一个文件（格式见 data_export ），
+    启动记录的list转为DataFrame保存，流式统计用pickle保存，
+    概况及各表的文件名记在 EXPORT_MANIFEST_FILENAME 中。
+
+    :result: TgwLogParser.parse() 的结果
+    :directory: 存放的目录，没有时创建
+    :fmt: data_export.PARQUET 或 data_export.NPZ ，缺省见 data_export.default_format()
+    :returns: 无
+    """
+    import pandas as pd
+    import data_export
+
+    mkpath(directory)
+
+    tables = dict()
+    for name, value in result.iteritems():
+        if name in ('summary', 'profile'):
+            continue
+
+        if isinstance(value, Result):
+            table = {'kind': 'result', 'summary': value.summary}
+            df = value.details
+            if value.stats is not None:
+                table['stats'] = name + '.stats'
+                with open(os.path.join(directory, table['stats']), 'wb') as f:
+                    pickle.dump(value.stats, f, pickle.HIGHEST_PROTOCOL)
+        else:
+            # 如启动记录，dict的list。''表示的无时间转为NaT，以便保存为时间列
+            df = pd.DataFrame(value)
+            time_columns = [
+                column for column in df
+                if any(isinstance(v, datetime.datetime) for v in df[column])
+            ]
+            for column in time_columns:
+                df[column] = pd.to_datetime(df[column].replace('', pd.NaT))
+            table = {'kind': 'records', 'time_columns': time_columns}
+
+        table['file'] = os.path.basename(data_export.write_table(df, os.path.join(directory, name), fmt))
+        tables[name] = table
+
+    manifest = {
+        'version'   : EXPORT_VERSION,
+        'summary'   : result['summary'],
+        'tables'    : tables,
+    }
+    with open(os.path.join(directory, EXPORT_MANIFEST_FILENAME), 'wb') as f:
+        json.dump(manifest, f, default=data_export.to_json, indent=2, sort_keys=True)
+
+
+def export_results(results, directory, fmt=None):
+    """导出多个日志文件的分析结果，各文件存在以 report_dir_name() 命名的子目录中
+
+    只有一个结果时直接存在directory中。
+
+    :results: 各文件的分析结果
+    :directory: 存放的目录
+    :fmt: 见 export_result()
+    :returns: 无
+    """
+    if len(results) == 1:
+        return export_result(results[0], directory, fmt)
+
+    log_dirs = [report_dir_name(i, result['summary']['filename']) for i, result in enumerate(results)]
+    for log_dir, result in zip(log_dirs, results):
+        export_result(result, os.path.join(directory, log_dir), fmt)
+
+    mkpath(directory)
+    with open(os.path.join(directory, EXPORT_MANIFEST_FILENAME), 'wb') as f:
+        json.dump({'version': EXPORT_VERSION, 'logs': log_dirs}, f, indent=2)
+
+
+def load_manifest(directory):
+    """读取导出目录中的 EXPORT_MANIFEST_FILENAME ，版本不符时抛出ValueError"""
+    import data_export
+
+    with open(os.path.join(directory, EXPORT_MANIFEST_FILENAME), 'rb') as f:
+        manifest = json.load(f, object_hook=data_export.from_json)
+
+    if manifest.get('version') != EXPORT_VERSION:
+        raise ValueError(u'Unsupported export version {0} in "{1}"'.format(manifest.get('version'), directory))
+
+    return manifest
+
+
+def load_result(directory):
+    """读回 export_result() 导出的一个日志文件的分析结果
+
+    :directory: 导出的目录
+    :returns: 和 TgwLogParser.parse() 的结果相同格式的dict
+    """
+    import pandas as pd
+    import data_export
+
+    manifest = load_manifest(directory)
+
+    result = {'summary': manifest['summary']}
+    for name, table in manifest['tables'].iteritems():
+        df = data_export.read_table(os.path.join(directory, table['file']))
+
+        if table['kind'] == 'result':
+            stats = None
+            if 'stats' in table:
+                with open(os.path.join(directory, table['stats']), 'rb') as f:
+                    stats = pickle.load(f)
+            result[name] = Result(table['summary'], df, stats=stats)
+        else:
+            records = df.to_dict('records')
+            for column in table['time_columns']:
+                for record in records:
+                    if pd.isnull(record[column]):
+                        record[column] = ''
+            result[name] = records
+
+    return result
+
+
+def load_results(directory):
+    """读回 export_results() 导出的分析结果
+
+    :directory: 导出的目录
+    :returns: 各文件的分析结果的list
+    """
+    manifest = load_manifest(directory)
+    if 'logs' not in manifest:
+        return [load_result(directory)]
+
+    return [load_result(os.path.join(directory, log_dir)) for log_dir in manifest['logs']]
+
+
 def import_filters(module):
     """把module中的函数变成适合jinja2.env.filters的dict格式
 
@@ -604,23 +3349,129 @@ def import_filters(module):
     return my_filters
 
 
+def render_chart(args):
+    """在子进程中绘制一个处理时间图
+
+    :args: (x, y)，见 HtmlReport.generate_time_chart()
+    :returns: PNG图形的内容
+    """
+    return HtmlReport.generate_time_chart(*args)
+
+
+def template_environment(template_dir):
+    """模板目录共用的jinja2.Environment
+
+    第一次调用时创建并注册 filters 中的过滤器，之后各报告共用，模板只编译一次。
+    编译结果另外用文件缓存在 template_cache_dir 中，再次运行时也不用重新编译。
+
+    :template_dir: 模板目录
+    :returns: jinja2.Environment
+    """
+    env = template_environments.get(template_dir)
+    if env is None:
+        bytecode_cache = None
+        if template_cache_dir:
+            try:
+                if not os.path.isdir(template_cache_dir):
+                    # 只有本用户可以读写，别人不能放入伪造的编译结果
+                    os.makedirs(template_cache_dir, 0o700)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(template_cache_dir)
+            except OSError as e:
+                logging.warning(u'Template cache "{0}" is not used: {1}'.format(template_cache_dir, e))
+
+        env = template_environments[template_dir] = jinja2.Environment(
+            loader=jinja2.FileSystemLoader([template_dir], encoding='utf-8'),
+            bytecode_cache=bytecode_cache)
+        env.filters.update(import_filters(filters))
+
+    return env
+
+
+def default_template_cache_dir():
+    """用户的模板缓存目录，见 TEMPLATE_CACHE_DIRNAME """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, TEMPLATE_CACHE_DIRNAME)
+
+
+def set_template_cache(directory):
+    """设置模板编译结果的缓存目录，之后的 template_environment() 使用
+
+    :directory: 缓存目录，没有时创建。None表示不缓存
+    """
+    global template_cache_dir
+    template_cache_dir = directory
+    template_environments.clear()
+
+
+#: 模板目录 -> jinja2.Environment ，见 template_environment()
+template_environments = dict()
+
+#: 模板编译结果的缓存目录，None表示不缓存，见 set_template_cache()
+template_cache_dir = default_template_cache_dir()
+
+
+def render_to(f, template, encoding='utf-8', **context):
+    """用 jinja2.Template.generate() 边生成边写入f
+
+    生成的片段积累到 RENDER_BUFFER_SIZE 个再写，内存占用不随报告的大小增长。
+
+    :f: 文件对象
+    :template: jinja2.Template
+    :encoding: 写入前的编码。None表示直接写入unicode
+    :context: 模板的参数
+    :returns: 无
+    """
+    stream = template.stream(**context)
+    stream.enable_buffering(RENDER_BUFFER_SIZE)
+    stream.dump(f, encoding=encoding)
+
+
 class HtmlReport(object):
-    def __init__(self, output_dir):
+    def __init__(self, output_dir, profiler=None, chart_cache=None, jobs=1, interactive=False):
         """构造函数
 
         :output_dir: 存放报告的目录
+        :profiler: 统计生成图形、报告耗时的 profile_util.Profiler 。None表示不统计
+        :chart_cache: chart_util.ChartCache ，数据不变时不重新绘图。None表示不缓存
+        :jobs: 并行绘图的进程数，每个进程一次画一个图
+        :interactive: 为True时不画PNG图形，把时间序列以JSON嵌入报告，在浏览器中绘制
         :returns: 无
 
         """
         self.output_dir = output_dir
+        self.profiler = profiler
+        self.chart_cache = chart_cache
+        self.jobs = jobs
+        self.interactive = interactive
 
     @staticmethod
     def generate_time_chart(x, y):
-        # 生成处理需时的图
+        """生成处理需时的图
+
+        :x: 各状态块的开始时间，datetime64[ns]数组，已排序
+        :y: 各状态块的耗时（微秒）数组
+        :returns: PNG图形的内容
+        """
+        import pandas as pd
+        plt = chart_util.import_pyplot()
+        import matplotlib.dates as mdates
+        import matplotlib.ticker
+        from mpl_toolkits.axes_grid1 import make_axes_locatable
+
         fig, ax = plt.subplots()
-        ax.plot(
-            x, y,
-            marker='.', markersize=3, linestyle='')
+        if len(x) > CHART_MAX_POINTS:
+            # 点数远多于像素数，大部分点重叠，只画每个像素列的包络
+            columns = int(fig.get_figwidth() * fig.dpi)
+            centers, low, high, p90 = chart_util.envelope(x.view(np.int64), y, columns)
+            times = mdates.date2num(pd.to_datetime(centers.astype(np.int64)).to_pydatetime())
+            ax.fill_between(times, low, high, step='mid', color='C0', alpha=0.5, linewidth=0, label='min - max')
+            ax.plot(times, p90, color='C1', linewidth=0.8, drawstyle='steps-mid', label='90%')
+            ax.legend(loc='upper left', fontsize='small')
+            ax.xaxis_date()
+        else:
+            ax.plot(
+                x, y,
+                marker='.', markersize=3, linestyle='')
 
         ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
         ax.yaxis.set_major_formatter(matplotlib.ticker.StrMethodFormatter('{x:,.0f}'))
@@ -631,29 +3482,113 @@ class HtmlReport(object):
         ax_hist = divider.append_axes("right", 1.2, pad=0.1, sharey=ax)
         plt.setp(ax_hist.get_yticklabels(), visible=False)
         bins = sorted(set(ax.yaxis.get_majorticklocs()).union(ax.yaxis.get_minorticklocs()))
-        ax_hist.hist(y, bins=bins, orientation='horizontal')
+        # 先用numpy统计各区间的点数，只画各区间的柱
+        counts, bins = np.histogram(y, bins=bins)
+        ax_hist.hist(bins[:-1], bins=bins, weights=counts, orientation='horizontal')
         plt.xticks(rotation=30)
 
-        result = chart_util.get_data_uri(fig)
+        image = chart_util.get_image(fig)
         plt.close(fig)
-        return result
+        return image
 
     @staticmethod
-    def generate_images(result):
-        """生成需要的图形
+    def time_series(result):
+        """需要画图的时间序列
+
+        :result: 分析结果
+        :returns: 图形名 -> (x, y)，见 generate_time_chart() 。没有数据的图形不画，不在其中
         """
+        status = result['status']
+        if status.stats is not None or not len(status):
+            # 流式统计时没有每个状态块的耗时；日志中没有状态块（如只用规则统计的日志）时没有点可画
+            return dict()
+
+        x = (status.column('begin') * 1000).view('datetime64[ns]')
+        return {'status': (x, status.durations().astype(np.float64))}
+
+    @staticmethod
+    def series_json(x, y):
+        """交互式图形的数据
+
+        时间为相对于第一点的毫秒数，耗时为微秒数，都取整以减小报告。
+        点数超过 CHART_MAX_POINTS 时只保存 INTERACTIVE_CHART_COLUMNS 段的包络。
+
+        :x: 见 generate_time_chart()
+        :y: 见 generate_time_chart()
+        :returns: JSON串
+        """
+        def to_list(values):
+            return [None if np.isnan(v) else int(round(v)) for v in values]
+
+        if not len(x):
+            return None
+
+        x = x.view(np.int64)
+        series = {'t0': int(x[0] // 1000000)}
+        if len(x) > CHART_MAX_POINTS:
+            centers, low, high, p90 = chart_util.envelope(x, y, INTERACTIVE_CHART_COLUMNS)
+            series.update(
+                x=((centers - x[0]) // 1000000).astype(np.int64).tolist(),
+                low=to_list(low), high=to_list(high), p90=to_list(p90))
+        else:
+            series.update(
+                x=((x - x[0]) // 1000000).tolist(),
+                y=np.round(y).astype(np.int64).tolist())
 
-        images = dict()
-        images['status'] = HtmlReport.generate_time_chart(
-            result['status'].details['begin'],
-            (result['status'].details['end'] - result['status'].details['begin']) / pd.Timedelta('1us'))
+        return json.dumps(series, separators=(',', ':'))
+
+    def generate_images(self, results):
+        """生成各结果需要的图形
+
+        缓存中没有的图形，jobs大于1时由多个进程并行绘制。
+
+        :results: 分析结果的list
+        :returns: 和results一一对应的 图形名 -> data-uri串 的dict的list。
+            交互式时为 图形名 -> series_json() 的JSON串
+        """
+        images = [dict() for _ in results]
+        # 要绘制的图形，(结果序号, 图形名, 缓存的key, (x, y))
+        tasks = list()
+        for i, result in enumerate(results):
+            for name, (x, y) in self.time_series(result).iteritems():
+                if self.interactive:
+                    images[i][name] = self.series_json(x, y)
+                    continue
+
+                key = None
+                if self.chart_cache:
+                    key = self.chart_cache.key(name, (x, y), max_points=CHART_MAX_POINTS)
+                    image = self.chart_cache.get(key)
+                    if image is not None:
+                        images[i][name] = chart_util.to_data_uri(image)
+                        if self.profiler:
+                            self.profiler.get('chart cache hit').add(0, True)
+                        continue
+
+                tasks.append((i, name, key, (x, y)))
+
+        if self.jobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(self.jobs, len(tasks)))
+            try:
+                rendered = pool.map(render_chart, [task[-1] for task in tasks], chunksize=1)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            rendered = [render_chart(task[-1]) for task in tasks]
+
+        for (i, name, key, _), image in zip(tasks, rendered):
+            if self.chart_cache:
+                self.chart_cache.put(key, image)
+            images[i][name] = chart_util.to_data_uri(image)
 
         return images
 
-    def generate(self, result):
+    def generate(self, result, images=None):
         """生成报表
 
         :result: 分析结果
+        :images: generate_images() 已生成的图形。None表示在此生成
         :returns: 无
 
         """
@@ -663,53 +3598,383 @@ class HtmlReport(object):
             logging.info(u'  Creating directory "{0}"...'.format(self.output_dir))
             mkpath(self.output_dir)
 
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader([HTML_TEMPLATE_DIR], encoding='utf-8'))
-        env.filters.update(import_filters(filters))
+        mytemplate = template_environment(HTML_TEMPLATE_DIR).get_template(HTML_TEMPLATE_FILENAME)
+
+        if images is None:
+            with profile_util.time(self.profiler, 'chart'):
+                images = self.generate_images([result])[0]
+
+        context = dict(result, **report_context(result))
+
+        with profile_util.time(self.profiler, 'render:html'):
+            with open(os.path.join(self.output_dir, HTML_REPORT_FILENAME), 'wb') as f:
+                render_to(f, mytemplate, images=images, interactive=self.interactive, **context)
+
+        logging.info(u'  Done')
+
+    def generate_fleet(self, fleet, report_dirs):
+        """生成多个日志文件的汇总报表
+
+        :fleet: aggregate_results() 的结果
+        :report_dirs: 各文件报告所在的子目录，和fleet['gateways']一一对应
+        :returns: 无
 
-        mytemplate = env.get_template(HTML_TEMPLATE_FILENAME)
+        """
+        logging.info(u'Generating fleet html report in "{0}" ...'.format(self.output_dir))
 
-        with open(os.path.join(self.output_dir, HTML_REPORT_FILENAME), 'wb') as f:
-            f.write(
-                mytemplate.render(
-                    images=self.generate_images(result), **result).encode('utf-8')
-            )
+        if not os.path.exists(self.output_dir):
+            logging.info(u'  Creating directory "{0}"...'.format(self.output_dir))
+            mkpath(self.output_dir)
+
+        mytemplate = template_environment(HTML_TEMPLATE_DIR).get_template(HTML_FLEET_TEMPLATE_FILENAME)
+
+        with profile_util.time(self.profiler, 'render:html fleet'):
+            with open(os.path.join(self.output_dir, HTML_REPORT_FILENAME), 'wb') as f:
+                render_to(f, mytemplate, report_dirs=report_dirs, **fleet)
 
         logging.info(u'  Done')
 
 
 class TextReport(object):
+    def __init__(self, profiler=None):
+        """构造函数
+
+        :profiler: 统计生成报告耗时的 profile_util.Profiler 。None表示不统计
+        """
+        self.profiler = profiler
+
     def generate(self, result):
         """生成报表
 
         :result: 分析结果
+        :returns: 报表文本
+
+        """
+        mytemplate = template_environment(TEXT_TEMPLATE_DIR).get_template(TEXT_TEMPLATE_FILENAME)
+
+        with profile_util.time(self.profiler, 'render:text'):
+            return mytemplate.render(**dict(result, **report_context(result)))
+
+    def write(self, result, f):
+        """生成报表，边生成边写入f，不在内存中拼出整个报表
+
+        :result: 分析结果
+        :f: 可写入unicode的文件对象，如sys.stdout
         :returns: 无
 
         """
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader([TEXT_TEMPLATE_DIR], encoding='utf-8'))
-        env.filters.update(import_filters(filters))
+        mytemplate = template_environment(TEXT_TEMPLATE_DIR).get_template(TEXT_TEMPLATE_FILENAME)
+
+        with profile_util.time(self.profiler, 'render:text'):
+            render_to(f, mytemplate, encoding=None, **dict(result, **report_context(result)))
 
-        mytemplate = env.get_template(TEXT_TEMPLATE_FILENAME)
+    def generate_fleet(self, fleet):
+        """生成多个日志文件的汇总报表
 
-        return mytemplate.render(**result)
+        :fleet: aggregate_results() 的结果
+        :returns: 报表文本
+
+        """
+        mytemplate = template_environment(TEXT_TEMPLATE_DIR).get_template(TEXT_FLEET_TEMPLATE_FILENAME)
+
+        with profile_util.time(self.profiler, 'render:text fleet'):
+            return mytemplate.render(**fleet)
+
+    def write_fleet(self, fleet, f):
+        """同 generate_fleet() ，边生成边写入f，参数见 write()"""
+        mytemplate = template_environment(TEXT_TEMPLATE_DIR).get_template(TEXT_FLEET_TEMPLATE_FILENAME)
+
+        with profile_util.time(self.profiler, 'render:text fleet'):
+            render_to(f, mytemplate, encoding=None, **fleet)
+
+
+class FollowReport(object):
+    """跟踪模式的输出，每个连接事件、每次滚动统计各一行"""
+
+    #: 不同于报告中连接状态的事件名称
+    EVENT_NAMES = {
+        'connected' : u'连接成功',
+        'reset'     : u'网关重启',
+    }
+
+    def __init__(self, window):
+        """构造函数
+
+        :window: 滚动统计的时间窗口，分钟
+        """
+        self.window = window
+
+    def event(self, line_time, event, conn):
+        """连接事件
+
+        :line_time: 事件的时间
+        :event: 事件，连接的status或'reset'（网关重启时未断开）
+        :conn: 连接信息
+        :returns: 输出的文本
+        """
+        text = u'{time} {gw_id} #{conn_id} {cs_addr} {event}'.format(
+            time=filters.as_datetime(DateTime.to_datetime(line_time)),
+            event=self.EVENT_NAMES.get(event) or filters.conn_status(event),
+            **conn)
+        if conn['code']:
+            text += u' {code}: {reason}'.format(**conn)
+
+        return text
+
+    def status(self, stats):
+        """状态日志耗时的滚动统计
+
+        :stats: TgwLogFollower.follow() 给出的统计
+        :returns: 输出的文本
+        """
+        return u'{time} 最近{window}分钟状态日志: {count}次, 平均{mean}us, p90 {p90}us, 最长{max}us'.format(
+            time=filters.as_datetime(DateTime.to_datetime(stats['time'])),
+            window=self.window,
+            count=stats['count'],
+            mean=filters.thousands_sep(stats['mean'], 0),
+            p90=filters.thousands_sep(stats['p90'], 0),
+            max=filters.thousands_sep(stats['max']))
 
 
 def main(**args):
-    parser = TgwLogParser(
-        args['logfile'][0],
-        encoding=args['log_encoding'].split(','),
-        from_time=pd.to_datetime(args['from'] if args['from'] else '00:00:00').time(),
-        to_time=pd.to_datetime(args['to'] if args['to'] else '23:59:59').replace(microsecond=999999).time()
-    )
+    if not args['cprofile']:
+        return analyze(**args)
 
-    result = parser.parse()
+    # 只统计主进程，并行处理的子进程不在其中
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(analyze, **args)
+    finally:
+        profile.dump_stats(args['cprofile'])
+        logging.info(u'cProfile stats saved to "{0}"'.format(args['cprofile']))
 
-    if args['html_report']:
-        HtmlReport(args['output_dir']).generate(result)
-    else:
+
+def show_profile(profiler, json_filename):
+    """输出各段处理的耗时统计
+
+    :profiler: profile_util.Profiler
+    :json_filename: 同时保存为JSON的文件名。None表示不保存
+    :returns: 无
+    """
+    sys.stderr.write(profiler.report() + u"\n")
+
+    if json_filename:
+        with open(json_filename, 'wb') as f:
+            json.dump(profiler.to_dict(), f, indent=2, sort_keys=True)
+
+
+def show_timings(timings):
+    """输出 --timings 的各阶段耗时
+
+    :timings: 各阶段耗时的 profile_util.Profiler
+    :returns: 无
+    """
+    timings.get('total').add(timer() - IMPORT_BEGIN)
+    sys.stderr.write(timings.report(total_name='total') + u"\n")
+
+    startup = timings.sections['startup'].seconds
+    sys.stderr.write(u'Startup {0:.3f}s, budget {1:.3f}s{2}\n'.format(
+        startup, STARTUP_BUDGET, u' (over budget)' if startup > STARTUP_BUDGET else u''))
+    sys.stderr.write(u'Loaded modules: {0}\n'.format(u', '.join(
+        u'{0} {1}'.format(name, u'yes' if name in sys.modules else u'no') for name in HEAVY_MODULES)))
+
+
+def parse_time_arg(s, default):
+    """解释-f/--from、-t/--to参数的时间
+
+    :s: HH:MM、HH:MM:SS或HH:MM:SS.ffffff格式的时间。空表示用default
+    :default: 缺省的时间，datetime.time
+    :returns: datetime.time
+    """
+    if not s:
+        return default
+
+    for fmt in ('%H:%M:%S.%f', '%H:%M:%S', '%H:%M'):
+        try:
+            return datetime.datetime.strptime(s, fmt).time()
+        except ValueError:
+            pass
+
+    raise ValueError(u'"{0}" is invalid time, HH:MM or HH:MM:SS expected'.format(s))
+
+
+def analyze(**args):
+    timings = None
+    if args['timings']:
+        timings = Profiler()
+        timings.get('import').add(IMPORT_END - IMPORT_BEGIN)
+        timings.get('startup').add(timer() - IMPORT_BEGIN)
+
+    filenames = expand_log_files(args['logfile'])
+    if not filenames and (args['follow'] or not args['from_cache']):
+        logging.error(u'No log file to analyze')
+        return 1
+
+    rules = None
+    if args['rules']:
+        try:
+            rules = load_rules(args['rules'])
+        except (IOError, ValueError, KeyError, re.error) as e:
+            logging.error(u'Invalid rules file "{0}": {1}'.format(args['rules'], e))
+            return 1
+
+    baselines = None
+    if args['baseline']:
+        try:
+            baselines = anomaly.Baselines(args['baseline'])
+        except (IOError, EOFError, pickle.UnpicklingError) as e:
+            logging.error(u'Invalid baseline file "{0}": {1}'.format(args['baseline'], e))
+            return 1
+
+    parser_args = {
+        'rules'     : rules,
+        'encoding'  : args['log_encoding'].split(','),
+        'from_time' : parse_time_arg(args['from'], datetime.time(0, 0, 0)),
+        'to_time'   : parse_time_arg(args['to'], datetime.time(23, 59, 59)).replace(microsecond=999999),
+        'use_index' : args['use_index'],
+        'use_cache' : args['use_cache'],
+        'streaming' : args['streaming'],
+        'profile'   : bool(args['profile'] or args['profile_json']),
+    }
+    profiler = Profiler() if parser_args['profile'] else None
+    set_template_cache(None if args['no_template_cache'] else args['template_cache'] or default_template_cache_dir())
+
+    if args['follow']:
+        if len(filenames) > 1:
+            logging.warning(u'Only the first log file "{0}" is followed'.format(filenames[0]))
+
+        report = FollowReport(args['follow_window'])
+
+        def show(events, stats):
+            for event in events:
+                print(report.event(*event))
+            if stats:
+                print(report.status(stats))
+            sys.stdout.flush()
+
+        follower = TgwLogFollower(filenames[0], parser_args['encoding'], window=args['follow_window'] * 60)
+        follower.follow(show, interval=args['follow_interval'])
+        return 0
+
+    if not args['html_report']:
         args['text_report'] = True
 
+    if args['rotated']:
+        filenames = group_rotated(filenames)
+
+    if args['from_cache']:
+        if filenames:
+            logging.warning(u'Log files are ignored with --from-cache')
+
+        with profile_util.time(profiler, 'load'), profile_util.time(timings, 'load'):
+            results = load_results(args['from_cache'])
+        single = len(results) == 1
+    elif len(filenames) == 1:
+        with profile_util.time(timings, 'parse'):
+            results = [TgwLogParser(filenames[0], **parser_args).parse(jobs=args['jobs'])]
+        single = True
+    else:
+        # 多个文件：每个进程处理一个文件
+        with profile_util.time(timings, 'parse'):
+            results = [
+                result for result in parse_files(filenames, jobs=args['jobs'], **parser_args)
+                if result is not None
+            ]
+        single = False
+
+    for result in results:
+        profile = result.pop('profile', None)
+        if profiler and profile:
+            profiler.merge(profile)
+
+        with profile_util.time(profiler, 'timeline'):
+            result['timeline'] = build_timeline(result, args['bucket'])
+
+        with profile_util.time(profiler, 'anomaly'):
+            result['anomalies'] = detect_anomalies(result, baselines)
+
+    # 都和以前保存的基线比较之后再更新。读取导出的结果时已在分析日志时更新过
+    if baselines is not None and not args['from_cache'] and not args['no_update_baseline']:
+        for result in results:
+            version = gateway_version(result)
+            stats = normal_stats(result, result['anomalies'])
+            if version and stats is not None:
+                if not baselines.update(version, stats, result['summary'].get('identity')):
+                    logging.info(u'"{0}" is already in the baseline of version {1}'.format(
+                        result['summary']['filename'], version))
+            elif version:
+                logging.info(u'Baseline of version {0} is not updated with "{1}" in streaming mode'.format(
+                    version, result['summary']['filename']))
+        baselines.save()
+        logging.info(u'Baselines saved to "{0}"'.format(args['baseline']))
+
+    chart_cache = None
+    if args['html_report'] and not args['no_chart_cache'] and not args['interactive']:
+        chart_cache = chart_util.ChartCache(args['chart_cache'] or os.path.join(args['output_dir'], CHART_CACHE_DIRNAME))
+
+    if args['export']:
+        with profile_util.time(profiler, 'export'):
+            export_results(results, args['export'])
+        logging.info(u'Results exported to "{0}"'.format(args['export']))
+
+    with profile_util.time(timings, 'report'):
+        if single:
+            write_report(results[0], args, profiler, chart_cache)
+        else:
+            write_fleet_report(results, args, profiler, chart_cache)
+
+    if profiler:
+        show_profile(profiler, args['profile_json'])
+
+    if timings:
+        show_timings(timings)
+
+    return 0
+
+
+def write_report(result, args, profiler, chart_cache):
+    """生成一个日志文件的报告
+
+    :result: 分析结果
+    :args: 命令行参数
+    :profiler: 见 HtmlReport
+    :chart_cache: 见 HtmlReport
+    :returns: 无
+    """
+    if args['html_report']:
+        HtmlReport(args['output_dir'], profiler, chart_cache, interactive=args['interactive']).generate(result)
+
+    if args['text_report']:
+        TextReport(profiler).write(result, sys.stdout)
+        sys.stdout.write(u'\n')
+
+
+def write_fleet_report(results, args, profiler, chart_cache):
+    """生成多个日志文件各自的报告及汇总报告，参数见 write_report()"""
+    with profile_util.time(profiler, 'aggregate'):
+        fleet = aggregate_results(results, args['incident_window'])
+
+    if args['html_report']:
+        report_dirs = [report_dir_name(i, result['summary']['filename']) for i, result in enumerate(results)]
+        with profile_util.time(profiler, 'chart'):
+            all_images = HtmlReport(
+                args['output_dir'], profiler, chart_cache,
+                jobs=args['jobs'], interactive=args['interactive']).generate_images(results)
+
+        for report_dir, result, images in zip(report_dirs, results, all_images):
+            HtmlReport(
+                os.path.join(args['output_dir'], report_dir), profiler,
+                interactive=args['interactive']).generate(result, images)
+
+        HtmlReport(args['output_dir'], profiler).generate_fleet(fleet, report_dirs)
+
     if args['text_report']:
-        print(TextReport().generate(result))
+        for result in results:
+            TextReport(profiler).write(result, sys.stdout)
+            sys.stdout.write(u'\n\n')
+
+        TextReport(profiler).write_fleet(fleet, sys.stdout)
+        sys.stdout.write(u'\n')
 
 
 if __name__ == "__main__":
@@ -729,7 +3994,31 @@ TGW日志分析工具""")
     parser.add_argument('--text',  action="store_true", dest="text_report", default=False, help=u"生成文本报告")
     parser.add_argument('-f', '--from',  action="store", dest="from", help=u"只处理此时间之后的数据，HH:MM或HH:MM:SS格式")
     parser.add_argument('-t', '--to',  action="store", dest="to", help=u"只处理此时间之前的数据，HH:MM或HH:MM:SS格式")
-    parser.add_argument('logfile', nargs=1, help=u"TGW日志文件路径")
+    parser.add_argument('--index',  action="store_true", dest="use_index", default=False, help=u"使用并保存时间索引文件（日志文件名加" + INDEX_SUFFIX + u"），加快-f/--from的定位")
+    parser.add_argument('--cache',  action="store_true", dest="use_cache", default=False, help=u"使用并保存解析缓存（日志文件名加" + CACHE_SUFFIX + u"），再次分析变长的日志时只处理新增的部分")
+    parser.add_argument('--streaming',  action="store_true", dest="streaming", default=False, help=u"状态日志耗时流式统计，不保留每笔的耗时以节省内存。分位数为估计值，相对误差1%%，报告中没有处理时间图")
+    parser.add_argument('-j', '--jobs',  action="store", dest="jobs", type=int, default=1, help=u"并行处理日志的进程数，缺省为1。多个日志文件时每个进程处理一个文件")
+    parser.add_argument('--rotated',  action="store_true", dest="rotated", default=False, help=u"把同一日志轮转出的各文件（如tgw.log.2.gz、tgw.log.1、tgw.log）按时间顺序连成一个日志分析。压缩的日志（gzip、xz、zstd）总是边读边解压")
+    parser.add_argument('--follow',  action="store_true", dest="follow", default=False, help=u"跟踪日志文件的增长（类似tail -F），实时显示连接事件和状态日志耗时的滚动统计。Ctrl-C结束")
+    parser.add_argument('--window',  action="store", dest="follow_window", type=int, default=DEFAULT_FOLLOW_WINDOW, help=u"跟踪时滚动统计的时间窗口（分钟），缺省为" + unicode(DEFAULT_FOLLOW_WINDOW))
+    parser.add_argument('--interval',  action="store", dest="follow_interval", type=float, default=DEFAULT_FOLLOW_INTERVAL, help=u"跟踪时显示滚动统计的间隔（秒），缺省为" + unicode(DEFAULT_FOLLOW_INTERVAL))
+    parser.add_argument('--profile',  action="store_true", dest="profile", default=False, help=u"统计各分析器及解析、生成图形和报告各段的调用次数和耗时，结束时输出到标准错误")
+    parser.add_argument('--profile-json',  action="store", dest="profile_json", help=u"同--profile，并把统计结果保存为此JSON文件")
+    parser.add_argument('--timings',  action="store_true", dest="timings", default=False, help=u"结束时输出启动（导入模块、解释参数）、分析、生成报告各阶段的耗时、启动耗时是否超出预算，以及是否导入了pandas等较慢的模块")
+    parser.add_argument('--cprofile',  action="store", dest="cprofile", help=u"用cProfile统计主进程的函数调用，保存到此文件，可用pstats或snakeviz查看")
+    parser.add_argument('--rules',  action="store", dest="rules", default=None, help=u"规则文件（JSON），定义要另外统计的日志行，见README")
+    parser.add_argument('--bucket',  action="store", dest="bucket", type=timeline.parse_interval, default=DEFAULT_BUCKET, help=u"分时统计每个时间段的长度，如1s、1m、5m，报告中列出最慢、连接失败最多的时间段。缺省为" + unicode(DEFAULT_BUCKET))
+    parser.add_argument('--incident-window',  action="store", dest="incident_window", type=timeline.parse_interval, default=DEFAULT_INCIDENT_WINDOW, help=u"多个日志文件时，同一TCS地址的连接断开、失败相隔不超过此时长的归为一次事件，汇总报告中列出多个网关同时断线的事件。缺省为" + unicode(DEFAULT_INCIDENT_WINDOW))
+    parser.add_argument('--baseline',  action="store", dest="baseline", help=u"状态日志耗时的基线文件，按网关版本保存以前分析的正常耗时，用于找出耗时异常的时段，分析后更新。没有时以日志自身为基线")
+    parser.add_argument('--no-update-baseline',  action="store_true", dest="no_update_baseline", default=False, help=u"只用--baseline的基线，不更新")
+    parser.add_argument('--interactive',  action="store_true", dest="interactive", default=False, help=u"HTML报告中的图形在浏览器中绘制，可拖动放大、双击还原，不生成PNG图形")
+    parser.add_argument('--chart-cache',  action="store", dest="chart_cache", help=u"图形缓存目录，数据不变时不重新绘图。缺省为结果存放目录下的" + CHART_CACHE_DIRNAME)
+    parser.add_argument('--no-chart-cache',  action="store_true", dest="no_chart_cache", default=False, help=u"不使用图形缓存")
+    parser.add_argument('--template-cache',  action="store", dest="template_cache", help=u"报告模板编译结果的缓存目录。缺省为用户缓存目录（$XDG_CACHE_HOME或~/.cache）下的" + TEMPLATE_CACHE_DIRNAME)
+    parser.add_argument('--no-template-cache',  action="store_true", dest="no_template_cache", default=False, help=u"不缓存报告模板的编译结果")
+    parser.add_argument('--export',  action="store", dest="export", help=u"把各分析器的结果导出到此目录（有pyarrow时为Parquet，否则为压缩的npz），供其他工具分析或用--from-cache重新生成报告")
+    parser.add_argument('--from-cache',  action="store", dest="from_cache", help=u"不分析日志，读取--export导出到此目录的结果生成报告")
+    parser.add_argument('logfile', nargs='*', help=u"TGW日志文件路径。可以有多个，可以是通配符或目录，多个文件时另外生成汇总报告")
 
     args = parser.parse_args()
 
@@ -753,4 +4042,4 @@ TGW日志分析工具""")
     else:
         logging.basicConfig(level=logging.INFO, format=log_format)
 
-    main(**vars(args))
+    sys.exit(main(**vars(args)))
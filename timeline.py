@@ -0,0 +1,143 @@
+# vim: set fileencoding=utf-8 tabstop=4 expandtab shiftwidth=4 softtabstop=4:
+"""按固定时间段统计：每段的个数及数值的平均值、90%分位数、最大值；按时间相近程度聚类
+
+时间都是 DateTime.to_epoch() 格式的微秒整数，分段、分组都用numpy完成，不逐行处理。
+"""
+import re
+
+import numpy as np
+
+# 时间段长度的单位 -> 微秒数
+INTERVAL_UNITS = {'s': 1000000, 'm': 60 * 1000000, 'h': 3600 * 1000000}
+
+# 平均每段的值少于此数时，求分位数时整体排序，否则逐段部分排序
+PARTITION_MIN_BUCKET_SIZE = 1000
+
+re_interval = re.compile(r'^(?P<count>\d+)(?P<unit>[smh]?)$')
+
+
+def parse_interval(s):
+    """解释时间段长度，如'1s'、'1m'、'5m'、'1h'，没有单位时为秒
+
+    :s: 字符串
+    :returns: 微秒数
+    """
+    m = re_interval.match(s.strip().lower())
+    if not m or not int(m.group('count')):
+        raise ValueError(u'invalid interval: {0}'.format(s))
+
+    return int(m.group('count')) * INTERVAL_UNITS[m.group('unit') or 's']
+
+
+def format_interval(interval):
+    """parse_interval() 的逆运算，用尽量大的单位，如60000000 -> '1m'"""
+    for unit in ('h', 'm', 's'):
+        if interval % INTERVAL_UNITS[unit] == 0:
+            return '{0}{1}'.format(interval // INTERVAL_UNITS[unit], unit)
+
+    return '{0:g}s'.format(interval / 1e6)
+
+
+def bucket_counts(times, interval):
+    """各时间段中的个数
+
+    :times: 时间数组，不必排序
+    :interval: 时间段长度，微秒
+    :returns: (有值的各段的开始时间, 个数)，按时间排序
+    """
+    starts, counts = np.unique(np.asarray(times, dtype=np.int64) // interval, return_counts=True)
+    return starts * interval, counts
+
+
+def bucket_stats(times, values, interval):
+    """各时间段中values的个数、平均值、90%分位数和最大值
+
+    :times: 时间数组，不必排序
+    :values: 和times一一对应的数值数组
+    :interval: 时间段长度，微秒
+    :returns: dict: start 有值的各段的开始时间，按时间排序；count、mean、p90、max 各段的统计数组
+    """
+    buckets = np.asarray(times, dtype=np.int64) // interval
+    values = np.asarray(values, dtype=np.float64)
+    if len(buckets) > 1 and (buckets[1:] < buckets[:-1]).any():
+        order = np.argsort(buckets, kind='mergesort')
+        buckets = buckets[order]
+        values = values[order]
+
+    # 排序后同一段的值是连续的
+    starts, first, counts = np.unique(buckets, return_index=True, return_counts=True)
+    if not len(starts):
+        empty = np.array([], dtype=np.float64)
+        return {'start': starts, 'count': counts, 'mean': empty, 'p90': empty, 'max': empty}
+
+    # 和numpy.percentile()相同的线性插值
+    position = (counts - 1) * 0.9
+    below = position.astype(np.int64)
+    above = np.minimum(below + 1, counts - 1)
+    weight = position - below
+    if len(values) < len(starts) * PARTITION_MIN_BUCKET_SIZE:
+        # 段多而小，逐段处理太慢：按(段序号, 值的名次)整体排序，各段内即按值排序。
+        # buckets已排序，合成的键基本有序，排序很快
+        ranks = np.empty(len(values), dtype=np.int64)
+        ranks[np.argsort(values)] = np.arange(len(values))
+        groups = np.repeat(np.arange(len(starts), dtype=np.int64), counts)
+        ordered = values[np.argsort(groups * len(values) + ranks)]
+        p90 = ordered[first + below] * (1 - weight) + ordered[first + above] * weight
+    else:
+        # 段少而大，各段只做部分排序
+        p90 = np.empty(len(starts))
+        for i, (begin, count) in enumerate(zip(first, counts)):
+            ordered = np.partition(values[begin:begin + count], (below[i], above[i]))
+            p90[i] = ordered[below[i]] * (1 - weight[i]) + ordered[above[i]] * weight[i]
+
+    return {
+        'start' : starts * interval,
+        'count' : counts,
+        'mean'  : np.add.reduceat(values, first) / counts,
+        'p90'   : p90,
+        'max'   : np.maximum.reduceat(values, first),
+    }
+
+
+def cluster_events(keys, times, window):
+    """按键和时间聚类：同一键的事件按时间排序后，和前一个相隔不超过window的归入同一簇
+
+    排序后逐个和前一个比较（扫描线），不两两比较，事件很多时也只是一次排序。
+
+    :keys: 各事件的键，整数数组，如TCS地址的编码
+    :times: 各事件的时间数组
+    :window: 相隔的最长时间，微秒
+    :returns: (order, clusters, firsts)：order 按(键, 时间)排序后各事件的序号，
+        clusters 排序后各事件的簇号，从0开始递增，firsts 各簇第一个事件在排序后的位置
+    """
+    keys = np.asarray(keys)
+    times = np.asarray(times, dtype=np.int64)
+    order = np.lexsort((times, keys))
+    if not len(order):
+        return order, order, order
+
+    keys = keys[order]
+    times = times[order]
+    starts = np.empty(len(order), dtype=bool)
+    starts[0] = True
+    starts[1:] = (keys[1:] != keys[:-1]) | (times[1:] - times[:-1] > window)
+    return order, np.cumsum(starts) - 1, np.flatnonzero(starts)
+
+
+def align(*groups):
+    """把几组按时间段统计的结果对齐到所有出现过的时间段上
+
+    :groups: 各组的(各段开始时间, 列名 -> 数组 的dict)
+    :returns: (所有段的开始时间, 列名 -> 数组 的dict)，某组没有的段的值为0
+    """
+    all_starts = np.unique(np.concatenate([np.asarray(s, dtype=np.int64) for s, _ in groups]))
+
+    result = dict()
+    for group_starts, group_columns in groups:
+        positions = np.searchsorted(all_starts, group_starts)
+        for name, values in group_columns.iteritems():
+            column = np.zeros(len(all_starts), dtype=np.asarray(values).dtype)
+            column[positions] = values
+            result[name] = column
+
+    return all_starts, result